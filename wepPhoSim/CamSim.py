@@ -1,6 +1,8 @@
 import os, unittest
 import numpy as np
 
+from wepPhoSim.StageTimer import StageTimer
+
 class CamSim(object):
 
     def __init__(self, camTBinDegC=6.5650, camRotInRad=0, camDataDir=None):
@@ -18,6 +20,12 @@ class CamSim(object):
         self.camRotInRad = camRotInRad
         self.camDataDir = camDataDir
 
+        # Loaded distortion data: {distType: (mtime, data)}
+        self.camData = dict()
+
+        # Timer of stages
+        self.timer = StageTimer()
+
     def setCamDataDir(self, camDataDir):
         """
         
@@ -28,6 +36,18 @@ class CamSim(object):
         """
 
         self.camDataDir = camDataDir
+        self.camData = dict()
+
+    def setTimer(self, timer):
+        """
+        
+        Set the timer to record the time of stages.
+        
+        Arguments:
+            timer {[StageTimer]} -- StageTimer object.
+        """
+
+        self.timer = timer
 
     def setRotAngInRad(self, rotAngInRad):
         """
@@ -112,8 +132,14 @@ class CamSim(object):
         # Path to camera distortion parameter file
         dataFile = os.path.join(self.camDataDir, (distType + ".txt"))
 
-        # Read the distortion
-        data = np.loadtxt(dataFile, skiprows=1)
+        # Read the distortion. The file is read only once unless it is modified.
+        mtime = os.stat(dataFile).st_mtime_ns
+        if (distType not in self.camData) or (self.camData[distType][0] != mtime):
+            with self.timer.stage("CamSim.readData"):
+                self.camData[distType] = (mtime, np.loadtxt(dataFile, skiprows=1))
+        else:
+            self.timer.count("CamSim.dataCacheHit")
+        data = self.camData[distType][1]
 
         # Calculate the distortion (dx, dy, dz, rx, ry, rz)
         # Consider the "gravity projection" of camera surface
@@ -203,6 +229,16 @@ class CamSimTest(unittest.TestCase):
         absDiff = np.sum(np.abs(distortionInMn - distData[idx,-1]))
         self.assertTrue(absDiff < 1e-10)
 
+        # The distortion data is read only once
+        timer = StageTimer(enabled=True)
+        camSim.setTimer(timer)
+        data = camSim.camData[distType][1]
+        distortionInMn = camSim.getCamDistortionInMm(zAngleInRad, distType)
+        self.assertTrue(camSim.camData[distType][1] is data)
+        self.assertTrue(np.sum(np.abs(distortionInMn - distData[idx,-1])) < 1e-10)
+        self.assertEqual(timer.getReport()["counter"]["CamSim.dataCacheHit"], 1)
+        self.assertFalse("CamSim.readData" in timer.getReport()["stage"])
+
 if __name__ == "__main__":
 
     # Do the unit test
@@ -0,0 +1,290 @@
+import os, json, shutil, threading, unittest
+import numpy as np
+
+from wepPhoSim.FileTool import writeFileAtomically
+
+class CampaignState(object):
+
+    def __init__(self, stateFilePath):
+        """
+
+        Initiate the CampaignState object. This class records the state of a simulation campaign
+        (accumulated DOF, random number generator state, completed PhoSim outputs, and metrics of
+        each iteration) in a JSON file. The file is always replaced atomically, so it holds the last
+        consistent checkpoint even if the campaign crashes while writing. The records can be
+        written from several threads.
+
+        Arguments:
+            stateFilePath {[str]} -- State file path.
+        """
+
+        self.stateFilePath = stateFilePath
+        self.data = self.__getEmptyData()
+
+        # Lock to write the records from several threads
+        self.lock = threading.Lock()
+
+        if os.path.isfile(stateFilePath):
+            self.load()
+
+    def load(self):
+        """
+
+        Load the campaign state from the state file.
+        """
+
+        with open(self.stateFilePath, "r") as inFile:
+            self.data = json.load(inFile)
+
+    def save(self):
+        """
+
+        Save the campaign state to the state file atomically. The content is written to a
+        temporary file in the same directory first and then renamed to the state file.
+        """
+
+        writeFileAtomically(self.stateFilePath, lambda outFile: json.dump(self.data, outFile, indent=2),
+                            mode="w", sync=True)
+
+    def reset(self):
+        """
+
+        Reset the campaign state and remove the state file.
+        """
+
+        self.data = self.__getEmptyData()
+        if os.path.isfile(self.stateFilePath):
+            os.remove(self.stateFilePath)
+
+    def recordPhoSimOutput(self, iterNum, stage, outputFileList):
+        """
+
+        Record the completed PhoSim output of iteration.
+
+        Arguments:
+            iterNum {[int]} -- Iteration number.
+            stage {[str]} -- Stage name of PhoSim run (e.g. "opd", "star").
+            outputFileList {[list]} -- Output files or directories of PhoSim run.
+        """
+
+        with self.lock:
+            phoSimOutput = self.data["phoSimOutput"].setdefault(str(iterNum), dict())
+            phoSimOutput[stage] = list(outputFileList)
+
+            self.save()
+
+    def getPhoSimOutput(self, iterNum, stage):
+        """
+
+        Get the completed PhoSim output of iteration.
+
+        Arguments:
+            iterNum {[int]} -- Iteration number.
+            stage {[str]} -- Stage name of PhoSim run (e.g. "opd", "star").
+
+        Returns:
+            [list] -- Output files or directories of PhoSim run. None if the run is not completed
+                      or any output does not exist.
+        """
+
+        outputFileList = self.data["phoSimOutput"].get(str(iterNum), dict()).get(stage)
+        if (outputFileList is None):
+            return None
+
+        for outputFile in outputFileList:
+            if (not os.path.exists(outputFile)):
+                return None
+
+        return outputFileList
+
+    def recordIteration(self, iterNum, state, rngState=None):
+        """
+
+        Record the completed iteration.
+
+        Arguments:
+            iterNum {[int]} -- Iteration number.
+            state {[dict]} -- State of iteration (e.g. DOF and metrics). It should be serializable
+                              by JSON.
+
+        Keyword Arguments:
+            rngState {[tuple]} -- State of numpy random number generator from
+                                  np.random.get_state(). (default: {None})
+        """
+
+        iteration = dict()
+        iteration["state"] = state
+        iteration["rngState"] = None
+        if (rngState is not None):
+            iteration["rngState"] = self.__rngStateToList(rngState)
+
+        with self.lock:
+            self.data["iteration"][str(iterNum)] = iteration
+
+            self.save()
+
+    def isIterationDone(self, iterNum):
+        """
+
+        Check the iteration is completed or not.
+
+        Arguments:
+            iterNum {[int]} -- Iteration number.
+
+        Returns:
+            [bool] -- True if the iteration is completed.
+        """
+
+        return (str(iterNum) in self.data["iteration"])
+
+    def getIteration(self, iterNum):
+        """
+
+        Get the state of completed iteration.
+
+        Arguments:
+            iterNum {[int]} -- Iteration number.
+
+        Returns:
+            [dict] -- State of iteration. None if the iteration is not completed.
+        """
+
+        iteration = self.data["iteration"].get(str(iterNum))
+        if (iteration is None):
+            return None
+
+        return iteration["state"]
+
+    def getRngState(self, iterNum):
+        """
+
+        Get the state of numpy random number generator after the completed iteration.
+
+        Arguments:
+            iterNum {[int]} -- Iteration number.
+
+        Returns:
+            [tuple] -- State used in np.random.set_state(). None if not recorded.
+        """
+
+        iteration = self.data["iteration"].get(str(iterNum))
+        if (iteration is None) or (iteration["rngState"] is None):
+            return None
+
+        rngState = iteration["rngState"]
+
+        return (rngState[0], np.array(rngState[1], dtype=np.uint32), rngState[2], rngState[3],
+                rngState[4])
+
+    def getLastIterNum(self, beforeIterNum=None):
+        """
+
+        Get the number of last completed iteration.
+
+        Keyword Arguments:
+            beforeIterNum {[int]} -- Only the iterations before this number are considered.
+                                     (default: {None})
+
+        Returns:
+            [int] -- Number of last completed iteration. None if no iteration is completed.
+        """
+
+        iterNumList = [int(iterNum) for iterNum in self.data["iteration"].keys()]
+        if (beforeIterNum is not None):
+            iterNumList = [iterNum for iterNum in iterNumList if (iterNum < beforeIterNum)]
+
+        if (len(iterNumList) == 0):
+            return None
+
+        return max(iterNumList)
+
+    def __getEmptyData(self):
+        """
+
+        Get the empty campaign state.
+
+        Returns:
+            [dict] -- Empty campaign state.
+        """
+
+        return {"iteration": dict(), "phoSimOutput": dict()}
+
+    def __rngStateToList(self, rngState):
+        """
+
+        Change the state of numpy random number generator to be serializable by JSON.
+
+        Arguments:
+            rngState {[tuple]} -- State from np.random.get_state().
+
+        Returns:
+            [list] -- State of random number generator.
+        """
+
+        return [rngState[0], np.asarray(rngState[1]).tolist(), int(rngState[2]), int(rngState[3]),
+                float(rngState[4])]
+
+class CampaignStateTest(unittest.TestCase):
+
+    """
+    Test functions in CampaignState.
+    """
+
+    def setUp(self):
+
+        # Set the output dir
+        self.outputDir = os.path.join("..", "output", "tempCampaign")
+        os.makedirs(self.outputDir)
+
+        self.stateFilePath = os.path.join(self.outputDir, "campaign.json")
+
+    def tearDown(self):
+
+        shutil.rmtree(self.outputDir)
+
+    def testFunc(self):
+
+        campaignState = CampaignState(self.stateFilePath)
+        self.assertEqual(campaignState.getLastIterNum(), None)
+        self.assertFalse(campaignState.isIterationDone(0))
+
+        outputFilePath = os.path.join(self.outputDir, "opd_9006000_0.fits.gz")
+        open(outputFilePath, "w").close()
+        campaignState.recordPhoSimOutput(0, "opd", [outputFilePath])
+        self.assertEqual(campaignState.getPhoSimOutput(0, "opd"), [outputFilePath])
+        self.assertEqual(campaignState.getPhoSimOutput(0, "star"), None)
+
+        np.random.seed(6)
+        rngState = np.random.get_state()
+        ansValue = np.random.rand()
+        campaignState.recordIteration(0, {"dofInUm": [0, 1]}, rngState=rngState)
+        campaignState.recordIteration(2, {"dofInUm": [2, 3]})
+
+        # No temporary file is left
+        self.assertEqual(sorted(os.listdir(self.outputDir)),
+                         ["campaign.json", "opd_9006000_0.fits.gz"])
+
+        # Resume from the state file
+        campaignState = CampaignState(self.stateFilePath)
+        self.assertTrue(campaignState.isIterationDone(0))
+        self.assertEqual(campaignState.getIteration(2), {"dofInUm": [2, 3]})
+        self.assertEqual(campaignState.getIteration(1), None)
+        self.assertEqual(campaignState.getLastIterNum(), 2)
+        self.assertEqual(campaignState.getLastIterNum(beforeIterNum=2), 0)
+        self.assertEqual(campaignState.getRngState(2), None)
+
+        np.random.set_state(campaignState.getRngState(0))
+        self.assertEqual(np.random.rand(), ansValue)
+
+        # The output does not exist anymore
+        os.remove(outputFilePath)
+        self.assertEqual(campaignState.getPhoSimOutput(0, "opd"), None)
+
+        campaignState.reset()
+        self.assertFalse(os.path.exists(self.stateFilePath))
+        self.assertEqual(campaignState.getLastIterNum(), None)
+
+if __name__ == "__main__":
+
+    # Do the unit test
+    unittest.main()
@@ -0,0 +1,725 @@
+import os, json, shutil, unittest
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from wepPhoSim.CamSim import CamSim
+from wepPhoSim.CampaignState import CampaignState
+from wepPhoSim.PhosimCommu import PhosimCommu
+from wepPhoSim.SurrogateOpd import SurrogateOpd
+from wepPhoSim.TeleFacade import TeleFacade
+from wepPhoSim.OpdMetrology import OpdMetrology
+
+class ClosedLoopDriver(object):
+
+    def __init__(self, tele, opdMetr, skySim=None, dofUpdateFunc=None):
+        """
+
+        Initiate the ClosedLoopDriver object. This class runs the iterations of closed loop based
+        on the TeleFacade. In each iteration, the OPD metrology is calculated while the star images
+        are simulated, and the perturbation files of next iteration are prepared ahead of time.
+
+        Arguments:
+            tele {[TeleFacade]} -- TeleFacade object.
+            opdMetr {[OpdMetrology]} -- OpdMetrology object with the field points.
+
+        Keyword Arguments:
+            skySim {[SkySim]} -- SkySim object. The star images are not simulated if None.
+                                 (default: {None})
+            dofUpdateFunc {[function]} -- Function to get the DOF correction in um based on the
+                                          result of iteration. See setDofUpdateFunc().
+                                          (default: {None})
+        """
+
+        self.tele = tele
+        self.opdMetr = opdMetr
+        self.skySim = skySim
+        self.dofUpdateFunc = dofUpdateFunc
+
+        # Observation
+        self.obsId = 9006000
+        self.aFilter = "g"
+        self.wavelengthInNm = 500
+        self.zAngleInDeg = 0
+        self.rotAngInDeg = 0
+        self.seedNum = None
+
+        # Setting files of PhoSim
+        self.opdCmdSettingFile = None
+        self.opdInstSettingFile = None
+        self.starCmdSettingFile = None
+        self.starInstSettingFile = None
+
+        # Star simulation
+        self.boresight = (0, 0)
+        self.mjd = 59552.3
+        self.sedName = "sed_500.txt"
+        self.sensorName = None
+
+        # PhoSim resource
+        self.numPro = 1
+        self.numThread = 1
+
+        # Number of worker processes to calculate the metrics
+        self.numMetrWorker = 1
+
+        # Surrogate OPD model and the period of validation by PhoSim
+        self.surrogate = None
+        self.validationPeriod = None
+
+        # State of campaign in the run
+        self.campaignState = None
+
+        # Random number generator of the DOF update. Its state is checkpointed in each iteration.
+        self.randomState = np.random.RandomState()
+
+    def setObservation(self, obsId, aFilter, wavelengthInNm, zAngleInDeg=0, rotAngInDeg=0, seedNum=None):
+        """
+
+        Set the observation. The observation ID of each iteration is obsId + iteration number.
+
+        Arguments:
+            obsId {[int]} -- Observation ID of the first iteration.
+            aFilter {[str]} -- Active filter type ("u", "g", "r", "i", "z", "y").
+            wavelengthInNm {[float]} -- OPD source wavelength in nm.
+
+        Keyword Arguments:
+            zAngleInDeg {[float]} -- Zenith angle in degree. (default: {0})
+            rotAngInDeg {[float]} -- Camera rotation angle in degree. (default: {0})
+            seedNum {[int]} -- Random seed number of mirror surface error. (default: {None})
+        """
+
+        self.obsId = obsId
+        self.aFilter = aFilter
+        self.wavelengthInNm = wavelengthInNm
+        self.zAngleInDeg = zAngleInDeg
+        self.rotAngInDeg = rotAngInDeg
+        self.seedNum = seedNum
+
+    def setSettingFile(self, opdCmdSettingFile=None, opdInstSettingFile=None, starCmdSettingFile=None,
+                        starInstSettingFile=None):
+        """
+
+        Set the physical command and instance setting files of PhoSim.
+
+        Keyword Arguments:
+            opdCmdSettingFile {[str]} -- OPD physical command setting file. (default: {None})
+            opdInstSettingFile {[str]} -- OPD instance setting file. (default: {None})
+            starCmdSettingFile {[str]} -- Star physical command setting file. (default: {None})
+            starInstSettingFile {[str]} -- Star instance setting file. (default: {None})
+        """
+
+        self.opdCmdSettingFile = opdCmdSettingFile
+        self.opdInstSettingFile = opdInstSettingFile
+        self.starCmdSettingFile = starCmdSettingFile
+        self.starInstSettingFile = starInstSettingFile
+
+    def setStarSetting(self, boresight=(0, 0), mjd=59552.3, sedName="sed_500.txt", sensorName=None):
+        """
+
+        Set the star simulation.
+
+        Keyword Arguments:
+            boresight {[tuple]} -- Telescope boresight in (ra, decl). (default: {(0, 0)})
+            mjd {[float]} -- MJD of observation. (default: {59552.3})
+            sedName {[str]} -- The name of the SED file with a file path that is relative to the
+                               data directory in PhoSim. (default: {"sed_500.txt"})
+            sensorName {[str]} -- Sensor chip specification (e.g., all, R22_S11, R22_S11|R22_S12).
+                                  (default: {None})
+        """
+
+        self.boresight = boresight
+        self.mjd = mjd
+        self.sedName = sedName
+        self.sensorName = sensorName
+
+    def setPhoSimResource(self, numPro=1, numThread=1):
+        """
+
+        Set the resource of each PhoSim run.
+
+        Keyword Arguments:
+            numPro {int} -- Number of processors. (default: {1})
+            numThread {int} -- Number of threads. (default: {1})
+        """
+
+        self.numPro = int(numPro)
+        self.numThread = int(numThread)
+
+    def setMetrologyResource(self, numWorker=1):
+        """
+
+        Set the resource to calculate the metrics of iteration.
+
+        Keyword Arguments:
+            numWorker {int} -- Number of worker processes to calculate the PSSN of field points.
+                               Use the number of CPUs if None. The PSSN is calculated in this
+                               process if it is 1. (default: {1})
+        """
+
+        self.numMetrWorker = numWorker
+
+    def setDofUpdateFunc(self, dofUpdateFunc):
+        """
+
+        Set the function to update the degree of freedom (DOF). The function is called as
+        dofUpdateFunc(iterNum, metrics, starOutputDir, dofInUm) after each iteration and returns
+        the DOF correction in um to accumulate. Return None to keep the DOF. Draw the random
+        numbers from getRandomState() to reproduce the DOF when the campaign is resumed.
+
+        Arguments:
+            dofUpdateFunc {[function]} -- Function to get the DOF correction in um.
+        """
+
+        self.dofUpdateFunc = dofUpdateFunc
+
+    def setRandomSeed(self, seedNum=None):
+        """
+
+        Set the seed of random number generator used by the DOF update function.
+
+        Keyword Arguments:
+            seedNum {[int]} -- Random seed number. (default: {None})
+        """
+
+        self.randomState = np.random.RandomState(seedNum)
+
+    def getRandomState(self):
+        """
+
+        Get the random number generator used by the DOF update function. Its state is recorded
+        in each iteration and restored when the campaign is resumed, so the resumed run draws
+        the same numbers as the uninterrupted run. The global numpy random number generator is
+        not restored.
+
+        Returns:
+            [RandomState] -- Random number generator.
+        """
+
+        return self.randomState
+
+    def setSurrogate(self, surrogate, validationPeriod=None):
+        """
+
+        Set the surrogate OPD model. The OPD maps of iterations are synthesized by the model
+        instead of the PhoSim, and the star images are not simulated. The iterations whose number
+        is a multiple of validation period are run by the PhoSim, and the metrics of surrogate
+        model are recorded as "surrogateMetrics" in the state to compare.
+
+        Arguments:
+            surrogate {[SurrogateOpd]} -- SurrogateOpd object with the same field points as the
+                                          OpdMetrology object. Use the PhoSim in all iterations
+                                          if None.
+
+        Keyword Arguments:
+            validationPeriod {[int]} -- Period of iterations run by the PhoSim. The PhoSim is not
+                                        run if None. (default: {None})
+
+        Raises:
+            ValueError -- The number of field points is different from the OpdMetrology object.
+        """
+
+        if (surrogate is not None) and (surrogate.getNumOfField() != len(self.opdMetr.fieldX)):
+            raise ValueError("The surrogate model should have %d field points." % len(self.opdMetr.fieldX))
+
+        self.surrogate = surrogate
+        self.validationPeriod = validationPeriod
+
+    def getIterDir(self, outputDir, iterNum):
+        """
+
+        Get the directory of iteration.
+
+        Arguments:
+            outputDir {[str]} -- Output directory.
+            iterNum {[int]} -- Iteration number.
+
+        Returns:
+            [str] -- Directory of iteration.
+        """
+
+        return os.path.join(outputDir, "iter%d" % iterNum)
+
+    def calcMetrics(self, opdFileList=None, opdMapList=None):
+        """
+
+        Calculate the PSSN, effective FWHM, and dm5 of field points and their values on the
+        Gaussian quadrature (GQ). The PSSN of field points is calculated in batch. See
+        setMetrologyResource() for the number of worker processes.
+
+        Keyword Arguments:
+            opdFileList {[list]} -- OPD FITS files in the order of field points. (default: {None})
+            opdMapList {[list/ ndarray]} -- OPD maps in the order of field points. This is used if
+                                            the OPD FITS files are None. (default: {None})
+
+        Returns:
+            [dict] -- Metrics of iteration.
+        """
+
+        wavelengthInUm = self.wavelengthInNm*1e-3
+
+        if (opdFileList is not None):
+            opdMapList = None
+
+        pssn = self.opdMetr.calcPSSNinBatch(wavelengthInUm, opdMapList=opdMapList,
+                                            opdFitsFileList=opdFileList,
+                                            numWorker=self.numMetrWorker)[0]
+
+        fwhmEff = self.opdMetr.calcFWHMeff(pssn)
+        dm5 = self.opdMetr.calcDm5(pssn)
+
+        # Only the GQ field points have the weighting ratio
+        numGQ = len(self.opdMetr.wt)
+
+        metrics = dict()
+        metrics["pssn"] = pssn.tolist()
+        metrics["fwhmEff"] = fwhmEff.tolist()
+        metrics["dm5"] = dm5.tolist()
+        if (numGQ > 0):
+            metrics["gqPssn"] = float(self.opdMetr.calcGQvalue(pssn[0:numGQ]))
+            metrics["gqFwhmEff"] = float(self.opdMetr.calcGQvalue(fwhmEff[0:numGQ]))
+            metrics["gqDm5"] = float(self.opdMetr.calcGQvalue(dm5[0:numGQ]))
+
+        return metrics
+
+    def run(self, outputDir, numIter, startIter=0, resume=True):
+        """
+
+        Run the iterations of closed loop. The state of each iteration is written to the
+        "checkpoint.json" in the directory of iteration and recorded in the campaign state file
+        "campaign.json" in the output directory. When resumed, the completed iterations and
+        PhoSim runs are skipped, and the DOF and random number generator state are restored from
+        the last completed iteration.
+
+        Arguments:
+            outputDir {[str]} -- Output directory.
+            numIter {[int]} -- Number of iterations.
+
+        Keyword Arguments:
+            startIter {int} -- Number of the first iteration. (default: {0})
+            resume {bool} -- Resume from the campaign state file. Start over if False.
+                             (default: {True})
+
+        Returns:
+            [list] -- State of iterations.
+        """
+
+        self.campaignState = CampaignState(os.path.join(outputDir, "campaign.json"))
+        if (not resume):
+            self.campaignState.reset()
+
+        # Iterations to run
+        iterNumList = list(range(startIter, startIter+numIter))
+        runIterNumList = [iterNum for iterNum in iterNumList
+                            if (not self.campaignState.isIterationDone(iterNum))]
+
+        if (len(runIterNumList) > 0):
+            self.__restoreState(runIterNumList[0])
+
+            with ThreadPoolExecutor(max_workers=2) as executor:
+
+                # Prepare the perturbation files of first iteration
+                pertFuture = executor.submit(self.__preparePert, outputDir, runIterNumList[0])
+
+                for ii, iterNum in enumerate(runIterNumList):
+
+                    pertCmdFilePath = pertFuture.result()
+
+                    # Prepare the perturbation files of next iteration ahead of time
+                    if (ii < len(runIterNumList)-1):
+                        pertFuture = executor.submit(self.__preparePert, outputDir,
+                                                     runIterNumList[ii+1])
+
+                    self.__runIteration(executor, outputDir, iterNum, pertCmdFilePath)
+
+        stateList = [self.campaignState.getIteration(iterNum) for iterNum in iterNumList]
+
+        return stateList
+
+    def __restoreState(self, iterNum):
+        """
+
+        Restore the DOF and random number generator state from the last completed iteration
+        before the iteration.
+
+        Arguments:
+            iterNum {[int]} -- Iteration number to run.
+        """
+
+        lastIterNum = self.campaignState.getLastIterNum(beforeIterNum=iterNum)
+        if (lastIterNum is None):
+            return
+
+        state = self.campaignState.getIteration(lastIterNum)
+        self.tele.setDofInUm(np.array(state["nextDofInUm"], dtype=float))
+
+        rngState = self.campaignState.getRngState(lastIterNum)
+        if (rngState is not None):
+            self.randomState.set_state(rngState)
+
+    def __preparePert(self, outputDir, iterNum):
+        """
+
+        Prepare the perturbation files of iteration.
+
+        Arguments:
+            outputDir {[str]} -- Output directory.
+            iterNum {[int]} -- Iteration number.
+
+        Returns:
+            [str] -- Perturbation command file path.
+        """
+
+        iterDir = self.getIterDir(outputDir, iterNum)
+        os.makedirs(iterDir, exist_ok=True)
+
+        pertCmdFilePath = self.tele.writePertBaseOnConfigFile(iterDir, zAngleInDeg=self.zAngleInDeg,
+                                    rotAngInDeg=self.rotAngInDeg, seedNum=self.seedNum)
+
+        return pertCmdFilePath
+
+    def __runIteration(self, executor, outputDir, iterNum, pertCmdFilePath):
+        """
+
+        Run one iteration of closed loop.
+
+        Arguments:
+            executor {[ThreadPoolExecutor]} -- Executor to run the star simulation.
+            outputDir {[str]} -- Output directory.
+            iterNum {[int]} -- Iteration number.
+            pertCmdFilePath {[str]} -- Perturbation command file path.
+
+        Returns:
+            [dict] -- State of iteration.
+        """
+
+        iterDir = self.getIterDir(outputDir, iterNum)
+        obsId = self.obsId + iterNum
+        dofInUm = np.array(self.tele.dofInUm, dtype=float)
+
+        # Write the accumulated DOF file
+        self.tele.writeAccDofFile(iterDir)
+
+        # Predict the OPD by the surrogate model
+        surrogateMetrics = None
+        if (self.surrogate is not None):
+            zk = self.surrogate.getZk(dofInUm)
+            surrogateMetrics = self.calcMetrics(opdMapList=self.surrogate.getOpdMapsFromZk(zk))
+            surrogateMetrics["zk"] = zk.tolist()
+
+        opdFileList = None
+        starOutputDir = None
+        if (surrogateMetrics is not None) and (not self.__isValidationIter(iterNum)):
+            metrics = surrogateMetrics
+            surrogateMetrics = None
+        else:
+            # Start the star simulation
+            starFuture = None
+            if (self.skySim is not None):
+                starFuture = executor.submit(self.__runStarSim, iterNum, iterDir, obsId, pertCmdFilePath)
+
+            # Run the OPD simulation
+            opdFileList = self.__runOpdSim(iterNum, iterDir, obsId, pertCmdFilePath)
+
+            # Calculate the metrology while the star images are simulated
+            metrics = self.calcMetrics(opdFileList=opdFileList)
+
+            if (starFuture is not None):
+                starOutputDir = starFuture.result()
+
+        # Update the DOF
+        if (self.dofUpdateFunc is not None):
+            dofCorrInUm = self.dofUpdateFunc(iterNum, metrics, starOutputDir, dofInUm.copy())
+            if (dofCorrInUm is not None):
+                self.tele.accDofInUm(np.array(dofCorrInUm, dtype=float))
+
+        # Checkpoint the iteration
+        state = dict()
+        state["iterNum"] = iterNum
+        state["obsId"] = obsId
+        state["dofInUm"] = dofInUm.tolist()
+        state["nextDofInUm"] = np.array(self.tele.dofInUm, dtype=float).tolist()
+        state["metrics"] = metrics
+        state["surrogateMetrics"] = surrogateMetrics
+        state["opdFileList"] = opdFileList
+        state["starOutputDir"] = starOutputDir
+
+        self.__writeCheckpoint(iterDir, state)
+        self.campaignState.recordIteration(iterNum, state, rngState=self.randomState.get_state())
+
+        return state
+
+    def __isValidationIter(self, iterNum):
+        """
+
+        Check the iteration is run by the PhoSim to validate the surrogate model.
+
+        Arguments:
+            iterNum {[int]} -- Iteration number.
+
+        Returns:
+            [bool] -- True if the iteration is run by the PhoSim.
+        """
+
+        return (self.validationPeriod is not None) and (iterNum % int(self.validationPeriod) == 0)
+
+    def __runOpdSim(self, iterNum, iterDir, obsId, pertCmdFilePath):
+        """
+
+        Run the OPD simulation. The run is skipped if it was completed in the campaign.
+
+        Arguments:
+            iterNum {[int]} -- Iteration number.
+            iterDir {[str]} -- Directory of iteration.
+            obsId {[int]} -- Observation ID.
+            pertCmdFilePath {[str]} -- Perturbation command file path.
+
+        Returns:
+            [list] -- OPD FITS files in the order of field points.
+        """
+
+        opdFileList = self.campaignState.getPhoSimOutput(iterNum, "opd")
+        if (opdFileList is not None):
+            return opdFileList
+
+        cmdFilePath = self.tele.writeCmdFile(iterDir, cmdSettingFile=self.opdCmdSettingFile,
+                                             pertFilePath=pertCmdFilePath, cmdFileName="opd.cmd")
+        instFilePath = self.tele.writeOpdInstFile(iterDir, self.opdMetr, obsId, self.aFilter,
+                                    self.wavelengthInNm, instSettingFile=self.opdInstSettingFile,
+                                    instFileName="opd.inst")
+
+        imgDir = os.path.join(iterDir, "opdImg")
+        logFilePath = os.path.join(iterDir, "phosimOpd.log")
+        self.__runPhoSim(instFilePath, cmdFilePath, imgDir, 0, logFilePath)
+
+        opdFileList = []
+        for idx in range(len(self.opdMetr.fieldX)):
+            opdFileList.append(os.path.join(imgDir, "opd_%d_%d.fits.gz" % (obsId, idx)))
+
+        self.campaignState.recordPhoSimOutput(iterNum, "opd", opdFileList)
+
+        return opdFileList
+
+    def __runStarSim(self, iterNum, iterDir, obsId, pertCmdFilePath):
+        """
+
+        Run the star simulation. The run is skipped if it was completed in the campaign.
+
+        Arguments:
+            iterNum {[int]} -- Iteration number.
+            iterDir {[str]} -- Directory of iteration.
+            obsId {[int]} -- Observation ID.
+            pertCmdFilePath {[str]} -- Perturbation command file path.
+
+        Returns:
+            [str] -- Directory of star images.
+        """
+
+        outputList = self.campaignState.getPhoSimOutput(iterNum, "star")
+        if (outputList is not None):
+            return outputList[0]
+
+        cmdFilePath = self.tele.writeCmdFile(iterDir, cmdSettingFile=self.starCmdSettingFile,
+                                             pertFilePath=pertCmdFilePath, cmdFileName="star.cmd")
+        instFilePath = self.tele.writeStarInstFile(iterDir, self.skySim, obsId, self.aFilter,
+                                    boresight=self.boresight, rot=self.rotAngInDeg, mjd=self.mjd,
+                                    sedName=self.sedName, wfSensorOn=True,
+                                    instSettingFile=self.starInstSettingFile,
+                                    instFileName="star.inst")
+
+        imgDir = os.path.join(iterDir, "starImg")
+        logFilePath = os.path.join(iterDir, "phosimStar.log")
+        self.__runPhoSim(instFilePath, cmdFilePath, imgDir, 1, logFilePath, sensorName=self.sensorName)
+
+        self.campaignState.recordPhoSimOutput(iterNum, "star", [imgDir])
+
+        return imgDir
+
+    def __runPhoSim(self, instFilePath, cmdFilePath, imgDir, e2ADC, logFilePath, sensorName=None):
+        """
+
+        Run the PhoSim with its own work directory to be able to run at the same time as other
+        PhoSim runs.
+
+        Arguments:
+            instFilePath {[str]} -- Instance catalog file path.
+            cmdFilePath {[str]} -- Command file path.
+            imgDir {[str]} -- Output image directory.
+            e2ADC {[int]} -- Whether to generate amplifier images (1 = true, 0 = false).
+            logFilePath {[str]} -- Log file path.
+
+        Keyword Arguments:
+            sensorName {[str]} -- Sensor chip specification. (default: {None})
+        """
+
+        workDir = imgDir + "Work"
+        os.makedirs(imgDir, exist_ok=True)
+        os.makedirs(workDir, exist_ok=True)
+
+        argList = self.tele.getPhoSimArgList(instFilePath, cmdFilePath=cmdFilePath, numPro=self.numPro,
+                                numThread=self.numThread, outputDir=imgDir, sensorName=sensorName,
+                                e2ADC=e2ADC, workDir=workDir)
+        try:
+            self.tele.runPhoSimByArgList(argList, logFilePath=logFilePath)
+        finally:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    def __writeCheckpoint(self, iterDir, state):
+        """
+
+        Write the state of iteration to the checkpoint file.
+
+        Arguments:
+            iterDir {[str]} -- Directory of iteration.
+            state {[dict]} -- State of iteration.
+        """
+
+        checkpointFilePath = os.path.join(iterDir, "checkpoint.json")
+        with open(checkpointFilePath, "w") as outFile:
+            json.dump(state, outFile, indent=2)
+
+class ClosedLoopDriverTest(unittest.TestCase):
+
+    """
+    Test functions in ClosedLoopDriver.
+    """
+
+    def setUp(self):
+
+        # Set the output dir
+        self.outputDir = os.path.join("..", "output", "tempClosedLoop")
+        os.makedirs(self.outputDir)
+
+        # Fake PhoSim that copies the OPD map for each OPD source
+        self.phosimDir = os.path.join(self.outputDir, "phosim")
+        os.makedirs(os.path.join(self.phosimDir, "data", "sky"))
+
+        opdFitsFile = os.path.abspath(os.path.join("..", "testData", "testOpdFunc",
+                                                   "sim6_iter0_opd0.fits.gz"))
+
+        content = "import os, shutil, sys\n"
+        content += "args = sys.argv[1:]\n"
+        content += "outputDir = args[args.index(\"-o\") + 1]\n"
+        content += "lines = open(args[0]).readlines()\n"
+        content += "obsId = [int(l.split()[1]) for l in lines if l.startswith(\"Opsim_obshistid\")][0]\n"
+        content += "for line in [l for l in lines if l.startswith(\"opd \")]:\n"
+        content += "    opdFileName = \"opd_%d_%d.fits.gz\" % (obsId, int(line.split()[1]))\n"
+        content += "    shutil.copy(\"%s\", os.path.join(outputDir, opdFileName))\n" % opdFitsFile
+
+        fid = open(os.path.join(self.phosimDir, "phosim.py"), "w")
+        fid.write(content)
+        fid.close()
+
+        self.configFilePath = os.path.join("..", "data", "telescopeConfig", "GT.inst")
+        self.camDataDir = os.path.join("..", "data", "camera")
+
+    def tearDown(self):
+
+        shutil.rmtree(self.outputDir)
+
+    def testFunc(self):
+
+        tele = TeleFacade(cam=CamSim(), phoSimCommu=PhosimCommu())
+        tele.setConfigFile(self.configFilePath)
+        tele.setSubSysConfigFile(camDataDir=self.camDataDir, phosimDir=self.phosimDir)
+
+        opdMetr = OpdMetrology()
+        opdMetr.setFieldXYinDeg(np.array([0, 0.2]), np.array([0, 0.2]))
+        opdMetr.setWeightingRatio(np.array([0.5, 0.5]))
+
+        dofUpdateFunc = lambda iterNum, metrics, starOutputDir, dofInUm: np.ones(50)*(iterNum+1)
+        driver = ClosedLoopDriver(tele, opdMetr, dofUpdateFunc=dofUpdateFunc)
+        driver.setObservation(9006000, "g", 500, zAngleInDeg=27.0912, rotAngInDeg=10)
+
+        stateList = driver.run(self.outputDir, 2)
+        self.assertEqual(len(stateList), 2)
+        self.assertEqual(stateList[1]["obsId"], 9006001)
+        self.assertEqual(stateList[1]["dofInUm"][0], 1)
+        self.assertEqual(stateList[1]["nextDofInUm"][0], 3)
+        self.assertEqual(tele.dofInUm[49], 3)
+
+        ansPssn = np.loadtxt(os.path.join("..", "testData", "testOpdFunc", "sim6_iter0_PSSN.txt"))
+        pssn = stateList[0]["metrics"]["pssn"]
+        self.assertEqual(len(pssn), 2)
+        self.assertAlmostEqual(pssn[0], ansPssn[0, 0], places=6)
+        self.assertAlmostEqual(stateList[0]["metrics"]["gqPssn"], pssn[0])
+
+        driver.setMetrologyResource(numWorker=2)
+        metrics = driver.calcMetrics(opdFileList=stateList[0]["opdFileList"])
+        self.assertTrue(np.allclose(metrics["pssn"], pssn, rtol=0, atol=1e-12))
+        driver.setMetrologyResource(numWorker=1)
+
+        iterDir = driver.getIterDir(self.outputDir, 1)
+        self.assertTrue(os.path.isfile(os.path.join(iterDir, "pert.cmd")))
+        self.assertTrue(os.path.isfile(os.path.join(iterDir, "pert.mat")))
+        self.assertFalse(os.path.exists(os.path.join(iterDir, "opdImgWork")))
+
+        with open(os.path.join(iterDir, "checkpoint.json"), "r") as inFile:
+            state = json.load(inFile)
+        self.assertEqual(state, stateList[1])
+
+        # Resume the campaign: the completed iterations are skipped
+        opdFilePath = stateList[1]["opdFileList"][0]
+        mtime = os.stat(opdFilePath).st_mtime_ns
+        tele.setDofInUm(np.zeros(50))
+        stateList = driver.run(self.outputDir, 3)
+        self.assertEqual(os.stat(opdFilePath).st_mtime_ns, mtime)
+        self.assertEqual(stateList[2]["dofInUm"][0], 3)
+        self.assertEqual(stateList[2]["nextDofInUm"][0], 6)
+
+        # The finished OPD run of an unfinished iteration is reused
+        os.remove(os.path.join(self.phosimDir, "phosim.py"))
+        campaignState = CampaignState(os.path.join(self.outputDir, "campaign.json"))
+        campaignState.recordPhoSimOutput(3, "opd", stateList[2]["opdFileList"])
+        stateList = driver.run(self.outputDir, 1, startIter=3)
+        self.assertEqual(stateList[0]["dofInUm"][0], 6)
+
+        self.assertRaises(RuntimeError, driver.run, self.outputDir, 1, resume=False)
+
+        # Run the iterations by the surrogate model without the PhoSim
+        baseZk = opdMetr.getZkFromOpd(opdFitsFile=stateList[0]["opdFileList"][0])[0][3:]
+        surrogate = SurrogateOpd(np.zeros((2, 19, 50)), np.array([baseZk, baseZk]), np.zeros(50))
+        self.assertRaises(ValueError, driver.setSurrogate,
+                          SurrogateOpd(np.zeros((1, 19, 50)), np.array([baseZk]), np.zeros(50)))
+
+        driver.setSurrogate(surrogate)
+        tele.setDofInUm(np.zeros(50))
+        stateList = driver.run(os.path.join(self.outputDir, "surrogate"), 2, resume=False)
+        self.assertEqual(stateList[1]["opdFileList"], None)
+        self.assertEqual(stateList[1]["dofInUm"][0], 1)
+        self.assertTrue(np.allclose(stateList[1]["metrics"]["zk"], [baseZk, baseZk]))
+        self.assertTrue(0 < stateList[1]["metrics"]["gqPssn"] <= 1)
+
+    def testResumeRandomDof(self):
+
+        opdMetr = OpdMetrology()
+        opdMetr.setFieldXYinDeg(np.array([0]), np.array([0]))
+
+        def runCampaign(outputDir, numIter, resume=True):
+
+            # New objects as in a restarted process
+            tele = TeleFacade(cam=CamSim(), phoSimCommu=PhosimCommu())
+            tele.setConfigFile(self.configFilePath)
+            tele.setSubSysConfigFile(camDataDir=self.camDataDir, phosimDir=self.phosimDir)
+
+            driver = ClosedLoopDriver(tele, opdMetr)
+            driver.setObservation(9006000, "g", 500, seedNum=6)
+            driver.setRandomSeed(3)
+            driver.setDofUpdateFunc(lambda iterNum, metrics, starOutputDir, dofInUm:
+                                    driver.getRandomState().rand(50))
+
+            return driver.run(outputDir, numIter, resume=resume)
+
+        # Interrupt the campaign after the iteration 0 and resume it
+        resumeDir = os.path.join(self.outputDir, "resume")
+        runCampaign(resumeDir, 1, resume=False)
+        resumeStateList = runCampaign(resumeDir, 3)
+
+        stateList = runCampaign(os.path.join(self.outputDir, "uninterrupted"), 3, resume=False)
+        for iterNum in range(3):
+            self.assertEqual(resumeStateList[iterNum]["nextDofInUm"], stateList[iterNum]["nextDofInUm"])
+        self.assertNotEqual(stateList[1]["nextDofInUm"], stateList[2]["nextDofInUm"])
+
+if __name__ == "__main__":
+
+    # Do the unit test
+    unittest.main()
@@ -0,0 +1,77 @@
+import os, json, shutil, tempfile, unittest
+import numpy as np
+
+def writeFileAtomically(filePath, writeFunc, mode="wb", sync=False):
+    """
+
+    Write the file atomically. The content is written to a temporary file in the same
+    directory first and then renamed to the file, so the readers never see a partial file.
+    The temporary file is removed if the writing fails.
+
+    Arguments:
+        filePath {[str]} -- File path.
+        writeFunc {[function]} -- Function called as writeFunc(outFile) to write the content.
+
+    Keyword Arguments:
+        mode {str} -- Mode to open the temporary file. (default: {"wb"})
+        sync {bool} -- Flush the content to the disk before the renaming. (default: {False})
+    """
+
+    fileDir = os.path.dirname(os.path.abspath(filePath))
+    os.makedirs(fileDir, exist_ok=True)
+
+    fd, tempFilePath = tempfile.mkstemp(dir=fileDir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as outFile:
+            writeFunc(outFile)
+            if (sync):
+                outFile.flush()
+                os.fsync(outFile.fileno())
+        os.replace(tempFilePath, filePath)
+    except BaseException:
+        if os.path.exists(tempFilePath):
+            os.remove(tempFilePath)
+        raise
+
+class FileToolTest(unittest.TestCase):
+
+    """
+    Test functions in FileTool.
+    """
+
+    def setUp(self):
+
+        # Set the output dir
+        self.outputDir = os.path.join("..", "output", "tempFileTool")
+        os.makedirs(self.outputDir)
+
+    def tearDown(self):
+
+        shutil.rmtree(self.outputDir)
+
+    def testFunc(self):
+
+        filePath = os.path.join(self.outputDir, "array.npy")
+        array = np.arange(6).reshape(2, 3)
+        writeFileAtomically(filePath, lambda outFile: np.save(outFile, array))
+        self.assertTrue(np.array_equal(np.load(filePath), array))
+
+        jsonFilePath = os.path.join(self.outputDir, "sub", "data.json")
+        writeFileAtomically(jsonFilePath, lambda outFile: json.dump({"a": 1}, outFile), mode="w",
+                            sync=True)
+        with open(jsonFilePath, "r") as inFile:
+            self.assertEqual(json.load(inFile), {"a": 1})
+
+        # The old file is kept and the temporary file is removed if the writing fails
+        def failWrite(outFile):
+            outFile.write(b"partial")
+            raise ValueError("Test")
+
+        self.assertRaises(ValueError, writeFileAtomically, filePath, failWrite)
+        self.assertTrue(np.array_equal(np.load(filePath), array))
+        self.assertEqual(sorted(os.listdir(self.outputDir)), ["array.npy", "sub"])
+
+if __name__ == "__main__":
+
+    # Do the unit test
+    unittest.main()
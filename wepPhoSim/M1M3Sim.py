@@ -33,6 +33,9 @@ class M1M3Sim(MirrorSim):
 
         super(M1M3Sim, self).__init__((Ri, R3i), (R, R3), surf=surf, mirrorDataDir=mirrorDataDir)
 
+        # Fitted thermal deformation bases: {(FEAfileName, gridFileName): (data, gridData, bases)}
+        self.tempCorrBasis = dict()
+
     def getActForce(self, actForceFileName="M1M3_1um_156_force.DAT"):
         """
 
@@ -45,7 +48,8 @@ class M1M3Sim(MirrorSim):
             [ndarray] -- Actuator forces in N.
         """
 
-        forceInN = self.getMirrorData(actForceFileName)
+        # Copy the cached data, so the caller can change it
+        forceInN = self.getMirrorData(actForceFileName).copy()
 
         return forceInN
 
@@ -145,37 +149,17 @@ class M1M3Sim(MirrorSim):
         # Data needed to determine thermal deformation
         data = self.getMirrorData(FEAfileName, skiprows=1)
 
-        # These are the normalized coordinates
-
-        # In the original XLS file (thermal FEA model), max(x)=164.6060 in,
-        # while 4.18m = 164.5669 in for real mirror. These two numbers do not match.
-        # The data here has normalized the dimension (x, y) already.
-        # n.b. these may not have been normalized correctly, b/c max(tx)=1.0
-        tx = data[:, 0]
-        ty = data[:, 1]
-
-        # Below are in M1M3 coordinate system, and in micron
-
-        # Do the fitting in the normalized coordinate
-        bx, by = self.__getMirCoor(gridFileName=gridFileName)[2:4]
-        R = self.RinM[0]
-        normX = bx/R
-        normY = by/R
-
-        # Fit the bulk
-        tbdz = self.__fitData(tx, ty, data[:, 2], normX, normY)
-
-        # Fit the x-grad
-        txdz = self.__fitData(tx, ty, data[:, 3], normX, normY)
-
-        # Fit the y-grad
-        tydz = self.__fitData(tx, ty, data[:, 4], normX, normY)
-
-        # Fit the z-grad
-        tzdz = self.__fitData(tx, ty, data[:, 5], normX, normY)
-
-        # Fit the r-gradß
-        trdz = self.__fitData(tx, ty, data[:, 6], normX, normY)
+        # The fitted thermal bases only depend on the data. Reuse them if the data is not reloaded.
+        key = (FEAfileName, gridFileName)
+        gridData = self.getMirrorData(gridFileName)
+        basis = self.tempCorrBasis.get(key)
+        if (basis is not None) and (basis[0] is data) and (basis[1] is gridData):
+            tbdz, txdz, tydz, tzdz, trdz = basis[2]
+            self.timer.count("M1M3Sim.tempCorrBasisCacheHit")
+        else:
+            with self.timer.stage("M1M3Sim.fitTempCorrBasis"):
+                tbdz, txdz, tydz, tzdz, trdz = self.__fitTempCorrBasis(data, gridFileName)
+            self.tempCorrBasis[key] = (data, gridData, (tbdz, txdz, tydz, tzdz, trdz))
 
         # Get the temprature correction
         tempCorrInUm = M1M3TBulk*tbdz + M1M3TxGrad*txdz + M1M3TyGrad*tydz + M1M3TzGrad*tzdz + \
@@ -217,9 +201,10 @@ class M1M3Sim(MirrorSim):
 
         # Add 5% force error (self.M1M3ForceError). This is for iteration 0 only.
         # This means from -5% to +5% of original actuator's force.
-        np.random.seed(seedNum)
+        # Use its own generator to keep the global random state of the caller.
+        randomState = np.random.RandomState(seedNum)
         nActuator = len(LUTforce)
-        myu = (1 + 2*(np.random.rand(nActuator) - 0.5)*M1M3ForceError)*LUTforce
+        myu = (1 + 2*(randomState.rand(nActuator) - 0.5)*M1M3ForceError)*LUTforce
 
         # Balance forces along z-axis
         # This statement is intentionally to make the force balance.
@@ -282,29 +267,26 @@ class M1M3Sim(MirrorSim):
 
         return resInMmInZemax, bxInMmInZemax, byInMmInZemax, zcInMmInZemax
 
-    def writeMirZkAndGridResInZemax(self, resFile=[], surfaceGridN=200, gridFileName="M1M3_1um_156_grid.DAT",
-                                    numTerms=28, writeZcInMnToFilePath=None):
+    def getMirZkAndGridResInZemax(self, surfaceGridN=200, gridFileName="M1M3_1um_156_grid.DAT", numTerms=28):
         """
         
-        Write the grid residue in mm of mirror surface after the fitting with Zk under the Zemax
-        coordinate.
+        Get the fitted Zk and grid residue in mm of mirror surface under the Zemax coordinate 
+        without writing any file.
         
         Keyword Arguments:
-            resFile {[list]} -- File path to save the grid surface residue map ([M1filePath, M3filePath]). 
-                                (default: {[]]})
             surfaceGridN {int} -- Surface grid number. (default: {200})
             gridFileName {str} -- File name of bending mode data. (default: {"M1M3_1um_156_grid.DAT"})
             numTerms {int} -- Number of Zernike terms to fit. (default: {28})
-            writeZcInMnToFilePath {[str]} -- File path to write the fitted zk in mm. (default: {None})
         
         Returns:
+            [ndarray] -- Fitted zk in mm in Zemax coordinate.
             [str] -- Grid residue map related data of M1.
             [str] -- Grid residue map related data of M3.
         """
 
         # Get the residure map
-        resInMmInZemax, bxInMmInZemax, byInMmInZemax = self.getMirrorResInMmInZemax(gridFileName=gridFileName,
-                                                 numTerms=numTerms, writeZcInMnToFilePath=writeZcInMnToFilePath)[0:3]
+        resInMmInZemax, bxInMmInZemax, byInMmInZemax, zcInMmInZemax = self.getMirrorResInMmInZemax(
+                                                        gridFileName=gridFileName, numTerms=numTerms)
 
         # Get the mirror node
         idx1, idx3 = self.__getMirCoor(gridFileName=gridFileName)[0:2]
@@ -320,7 +302,7 @@ class M1M3Sim(MirrorSim):
         # Content: (z, dx, dy, dxdy)
         contentM1 = self._MirrorSim__gridSampInMnInZemax(resInMmInZemax[idx1], bxInMmInZemax[idx1], 
                                                          byInMmInZemax[idx1], innerRinMm, outerRinMm, 
-                                                         surfaceGridN, surfaceGridN, resFile=resFile[0])
+                                                         surfaceGridN, surfaceGridN)
 
         # Grid sample map for M3
 
@@ -333,7 +315,42 @@ class M1M3Sim(MirrorSim):
         # Content: (z, dx, dy, dxdy)
         contentM3 = self._MirrorSim__gridSampInMnInZemax(resInMmInZemax[idx3], bxInMmInZemax[idx3], 
                                                          byInMmInZemax[idx3], innerRinMm, outerRinMm, 
-                                                         surfaceGridN, surfaceGridN, resFile=resFile[1])
+                                                         surfaceGridN, surfaceGridN)
+
+        return zcInMmInZemax, contentM1, contentM3
+
+    def writeMirZkAndGridResInZemax(self, resFile=[], surfaceGridN=200, gridFileName="M1M3_1um_156_grid.DAT",
+                                    numTerms=28, writeZcInMnToFilePath=None):
+        """
+        
+        Write the grid residue in mm of mirror surface after the fitting with Zk under the Zemax
+        coordinate.
+        
+        Keyword Arguments:
+            resFile {[list]} -- File path to save the grid surface residue map ([M1filePath, M3filePath]). 
+                                (default: {[]]})
+            surfaceGridN {int} -- Surface grid number. (default: {200})
+            gridFileName {str} -- File name of bending mode data. (default: {"M1M3_1um_156_grid.DAT"})
+            numTerms {int} -- Number of Zernike terms to fit. (default: {28})
+            writeZcInMnToFilePath {[str]} -- File path to write the fitted zk in mm. (default: {None})
+        
+        Returns:
+            [str] -- Grid residue map related data of M1.
+            [str] -- Grid residue map related data of M3.
+        """
+
+        # Get the fitted zk and residure map
+        zcInMmInZemax, contentM1, contentM3 = self.getMirZkAndGridResInZemax(surfaceGridN=surfaceGridN, 
+                                                        gridFileName=gridFileName, numTerms=numTerms)
+
+        # Save the file of fitted Zk
+        if (writeZcInMnToFilePath is not None):
+            np.savetxt(writeZcInMnToFilePath, zcInMmInZemax)
+
+        # Write the surface residue data into the file
+        for filePath, content in zip(resFile, [contentM1, contentM3]):
+            if (filePath is not None):
+                self.writeToFile(filePath, content)
 
         return contentM1, contentM3
 
@@ -395,6 +412,58 @@ class M1M3Sim(MirrorSim):
 
         return nodeM1, nodeM3, bx, by, bz
 
+    def __fitTempCorrBasis(self, data, gridFileName):
+        """
+        
+        Fit the thermal deformation bases of bulk temperature and temperature gradients on the 
+        mirror grid.
+        
+        Arguments:
+            data {[ndarray]} -- Thermal finite element analysis (FEA) model data.
+            gridFileName {str} -- File name of bending mode data.
+        
+        Returns:
+            [ndarray] -- Deformation in um for the bulk temperature.
+            [ndarray] -- Deformation in um for the x-gradient.
+            [ndarray] -- Deformation in um for the y-gradient.
+            [ndarray] -- Deformation in um for the z-gradient.
+            [ndarray] -- Deformation in um for the r-gradient.
+        """
+
+        # These are the normalized coordinates
+
+        # In the original XLS file (thermal FEA model), max(x)=164.6060 in,
+        # while 4.18m = 164.5669 in for real mirror. These two numbers do not match.
+        # The data here has normalized the dimension (x, y) already.
+        # n.b. these may not have been normalized correctly, b/c max(tx)=1.0
+        tx = data[:, 0]
+        ty = data[:, 1]
+
+        # Below are in M1M3 coordinate system, and in micron
+
+        # Do the fitting in the normalized coordinate
+        bx, by = self.__getMirCoor(gridFileName=gridFileName)[2:4]
+        R = self.RinM[0]
+        normX = bx/R
+        normY = by/R
+
+        # Fit the bulk
+        tbdz = self.__fitData(tx, ty, data[:, 2], normX, normY)
+
+        # Fit the x-grad
+        txdz = self.__fitData(tx, ty, data[:, 3], normX, normY)
+
+        # Fit the y-grad
+        tydz = self.__fitData(tx, ty, data[:, 4], normX, normY)
+
+        # Fit the z-grad
+        tzdz = self.__fitData(tx, ty, data[:, 5], normX, normY)
+
+        # Fit the r-gradß
+        trdz = self.__fitData(tx, ty, data[:, 6], normX, normY)
+
+        return tbdz, txdz, tydz, tzdz, trdz
+
     def __fitData(self, dataX, dataY, data, x, y):
         """
 
@@ -558,6 +627,13 @@ class M1M3SimTest(unittest.TestCase):
         ansRandSurfInM = np.loadtxt(ansFilePath)
         self.assertLess(np.sum(np.abs(randSurfInM-ansRandSurfInM)), 1e-10)
 
+        # The global random state is not changed
+        rngState = np.random.get_state()
+        M1M3.genMirSurfRandErr(zAngleInRadian, seedNum=iSim)
+        value = np.random.rand()
+        np.random.set_state(rngState)
+        self.assertEqual(np.random.rand(), value)
+
         printthzInUm = printthzInM*1e6
         randSurfInUm = randSurfInM*1e6
         mirrorSurfInUm = printthzInUm + randSurfInUm + tempCorrInUm
@@ -36,7 +36,8 @@ class M2Sim(MirrorSim):
             [ndarray] -- Actuator forces in N.
         """
 
-        forceInN = self.getMirrorData(actForceFileName)
+        # Copy the cached data, so the caller can change it
+        forceInN = self.getMirrorData(actForceFileName).copy()
 
         return forceInN
 
@@ -150,27 +151,25 @@ class M2Sim(MirrorSim):
 
         return resInMmInZemax, bxInMmInZemax, byInMmInZemax, zcInMmInZemax
 
-    def writeMirZkAndGridResInZemax(self, resFile=None, surfaceGridN=200, gridFileName="M2_1um_grid.DAT",
-                                    numTerms=28, writeZcInMnToFilePath=None):
+    def getMirZkAndGridResInZemax(self, surfaceGridN=200, gridFileName="M2_1um_grid.DAT", numTerms=28):
         """
 
-        Write the grid residue in mm of mirror surface after the fitting with Zk under the Zemax
-        coordinate.
+        Get the fitted Zk and grid residue in mm of mirror surface under the Zemax coordinate 
+        without writing any file.
 
         Keyword Arguments:
-            resFile {[str]} -- File path to save the grid surface residue map. (default: {None})
             surfaceGridN {int} -- Surface grid number. (default: {200})
             gridFileName {str} -- File name of bending mode data. (default: {"M2_1um_grid.DAT"})
             numTerms {int} -- Number of Zernike terms to fit. (default: {28})
-            writeZcInMnToFilePath {[str]} -- File path to write the fitted zk in mm. (default: {None})
 
         Returns:
+            [ndarray] -- Fitted zk in mm in Zemax coordinate.
             [str] -- Grid residue map related data.
         """
 
         # Get the residure map
-        resInMmInZemax, bxInMmInZemax, byInMmInZemax = self.getMirrorResInMmInZemax(gridFileName=gridFileName,
-                                                 numTerms=numTerms, writeZcInMnToFilePath=writeZcInMnToFilePath)[0:3]
+        resInMmInZemax, bxInMmInZemax, byInMmInZemax, zcInMmInZemax = self.getMirrorResInMmInZemax(
+                                                        gridFileName=gridFileName, numTerms=numTerms)
 
         # Change the unit from m to mm
         innerRinMm = self.RiInM * 1e3
@@ -180,7 +179,39 @@ class M2Sim(MirrorSim):
         # Content header: (NUM_X_PIXELS, NUM_Y_PIXELS, delta x, delta y)
         # Content: (z, dx, dy, dxdy)
         content = self._MirrorSim__gridSampInMnInZemax(resInMmInZemax, bxInMmInZemax, byInMmInZemax, innerRinMm,
-                                                        outerRinMm, surfaceGridN, surfaceGridN, resFile=resFile)
+                                                        outerRinMm, surfaceGridN, surfaceGridN)
+
+        return zcInMmInZemax, content
+
+    def writeMirZkAndGridResInZemax(self, resFile=None, surfaceGridN=200, gridFileName="M2_1um_grid.DAT",
+                                    numTerms=28, writeZcInMnToFilePath=None):
+        """
+
+        Write the grid residue in mm of mirror surface after the fitting with Zk under the Zemax
+        coordinate.
+
+        Keyword Arguments:
+            resFile {[str]} -- File path to save the grid surface residue map. (default: {None})
+            surfaceGridN {int} -- Surface grid number. (default: {200})
+            gridFileName {str} -- File name of bending mode data. (default: {"M2_1um_grid.DAT"})
+            numTerms {int} -- Number of Zernike terms to fit. (default: {28})
+            writeZcInMnToFilePath {[str]} -- File path to write the fitted zk in mm. (default: {None})
+
+        Returns:
+            [str] -- Grid residue map related data.
+        """
+
+        # Get the fitted zk and residure map
+        zcInMmInZemax, content = self.getMirZkAndGridResInZemax(surfaceGridN=surfaceGridN, 
+                                                    gridFileName=gridFileName, numTerms=numTerms)
+
+        # Save the file of fitted Zk
+        if (writeZcInMnToFilePath is not None):
+            np.savetxt(writeZcInMnToFilePath, zcInMmInZemax)
+
+        # Write the surface residue data into the file
+        if (resFile is not None):
+            self.writeToFile(resFile, content)
 
         return content
 
@@ -228,6 +259,7 @@ class M2SimTest(unittest.TestCase):
 
         forceInN = M2.getActForce()
         self.assertEqual(forceInN.shape, (156, 156))
+        self.assertTrue(forceInN.flags.writeable)
 
         zAngleInDeg = 27.0912
         zAngleInRadian = zAngleInDeg/180*np.pi
@@ -264,6 +296,12 @@ class M2SimTest(unittest.TestCase):
         self.assertLess(np.sum(np.abs(content[0,:]-ansContent[0,:])), 1e-9)
         self.assertLess(np.sum(np.abs(content[1:,0]-ansContent[1:,0])), 1e-9)
 
+        zcInMm, resContent = M2.getMirZkAndGridResInZemax(numTerms=numTerms)
+        self.assertTrue(np.all(zcInMm == zcInMmInZemax))
+        resFileObj = open(resFile, "r")
+        self.assertEqual(resContent, resFileObj.read())
+        resFileObj.close()
+
         writeToResMapFilePath = os.path.join("..", "output", "M2resMap.png")
         M2.showMirResMap(numTerms=numTerms, resFile=resFile, writeToResMapFilePath=writeToResMapFilePath)
         self.assertTrue(os.path.isfile(writeToResMapFilePath))
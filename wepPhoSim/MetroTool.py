@@ -1,10 +1,161 @@
+import os, hashlib, threading
 import numpy as np
 import scipy.special as sp
+from collections import OrderedDict
 
 from lsst.ts.wep.cwfs.Tool import padArray, extractArray
+from wepPhoSim.FftBackend import FftBackend
+from wepPhoSim.FileTool import writeFileAtomically
+
+class ArrayCache(object):
+
+    def __init__(self, maxSize=32, cacheDir=None):
+        """
+        
+        Initiate the ArrayCache object. This class memoizes the arrays calculated from the 
+        parameters with the least recently used (LRU) bound. The arrays can be persisted in the 
+        directory to be reused by other processes. The cached arrays are read-only.
+        
+        Keyword Arguments:
+            maxSize {int} -- Maximum number of arrays kept in memory. (default: {32})
+            cacheDir {[str]} -- Directory to persist the arrays. The arrays are not persisted if 
+                                None. (default: {None})
+        """
+
+        self.maxSize = int(maxSize)
+        self.cacheDir = cacheDir
+
+        # Cached arrays: {key: array}
+        self.data = OrderedDict()
+
+        # Lock to access the cache from several threads
+        self.lock = threading.Lock()
+
+        # Number of cache hits and misses
+        self.numHit = 0
+        self.numMiss = 0
+
+    def config(self, maxSize=32, cacheDir=None):
+        """
+        
+        Configure the cache. The arrays in memory are kept up to the new size.
+        
+        Keyword Arguments:
+            maxSize {int} -- Maximum number of arrays kept in memory. (default: {32})
+            cacheDir {[str]} -- Directory to persist the arrays. (default: {None})
+        """
+
+        with self.lock:
+            self.maxSize = int(maxSize)
+            self.cacheDir = cacheDir
+            self.__trim()
+
+    def clear(self):
+        """
+        
+        Clear the arrays in memory. The persisted arrays are kept.
+        """
+
+        with self.lock:
+            self.data = OrderedDict()
+            self.numHit = 0
+            self.numMiss = 0
+
+    def get(self, key, func, *args):
+        """
+        
+        Get the cached array. The array is calculated by func(*args) if it is not in the cache.
+        
+        Arguments:
+            key {[tuple]} -- Parameters that determine the array.
+            func {[function]} -- Function to calculate the array.
+            *args -- Arguments of function.
+        
+        Returns:
+            [ndarray] -- Read-only array.
+        """
+
+        with self.lock:
+            array = self.data.get(key)
+            if (array is not None):
+                self.data.move_to_end(key)
+                self.numHit += 1
+                return array
+
+            self.numMiss += 1
+            cacheDir = self.cacheDir
+
+        # Load the persisted array or calculate it
+        filePath = None
+        if (cacheDir is not None):
+            fileName = "%s.npy" % hashlib.md5(repr(key).encode()).hexdigest()
+            filePath = os.path.join(cacheDir, fileName)
+
+        if (filePath is not None) and (os.path.isfile(filePath)):
+            array = np.load(filePath)
+        else:
+            array = func(*args)
+            if (filePath is not None):
+                writeFileAtomically(filePath, lambda outFile: np.save(outFile, array))
+
+        array.setflags(write=False)
+
+        with self.lock:
+            self.data[key] = array
+            self.__trim()
+
+        return array
+
+    def __trim(self):
+        """
+        
+        Remove the least recently used arrays over the maximum size.
+        """
+
+        while (len(self.data) > max(self.maxSize, 0)):
+            self.data.popitem(last=False)
+
+# Cache of atmosphere MTF shared by calc_pssn() and psf2eAtmW()
+mtfAtmCache = ArrayCache()
+
+# Cache of atmospheric PSS of perfect telescope used in calc_pssn()
+pssAtmCache = ArrayCache(maxSize=128)
+
+# FFT backend used if the backend is not assigned in the function call
+fftBackend = FftBackend()
+
+def setFftBackend(backend):
+    """
+    
+    Set the FFT backend used by default in this module.
+    
+    Arguments:
+        backend {[FftBackend]} -- FftBackend object.
+    """
+
+    global fftBackend
+    fftBackend = backend
+
+def getFftBackend(backend=None):
+    """
+    
+    Get the FFT backend.
+    
+    Keyword Arguments:
+        backend {[FftBackend]} -- FftBackend object. Use the default backend of this module if 
+                                  None. (default: {None})
+    
+    Returns:
+        [FftBackend] -- FftBackend object.
+    """
+
+    if (backend is None):
+        backend = fftBackend
+
+    return backend
 
 def calc_pssn(array, wlum, aType="opd", D=8.36, r0inmRef=0.1382, zen=0, pmask=0, imagedelta=0, 
-              fno=1.2335, debugLevel=0):
+              fno=1.2335, debugLevel=0, backend=None):
     """
     
     Calculate the normalized point source sensitivity (PSSN).
@@ -26,11 +177,14 @@ def calc_pssn(array, wlum, aType="opd", D=8.36, r0inmRef=0.1382, zen=0, pmask=0,
         imagedelta {float} -- Only needed when psf is used. use 0 for opd. (default: {0})
         fno {float} -- Only needed when psf is used. use 0 for opd. (default: {1.2335})
         debugLevel {int} -- Debug level. The higher value gives more information. (default: {0})
+        backend {[FftBackend]} -- FFT backend. Use the default backend if None. (default: {None})
     
     Returns:
         [float] -- PSSN value.
     """
 
+    backend = getFftBackend(backend)
+
     # Only needed for psf: pmask, imagedelta, fno
 
     # THE INTERNAL RESOLUTION THAT FFTS OPERATE ON IS VERY IMPORTANT
@@ -69,7 +223,7 @@ def calc_pssn(array, wlum, aType="opd", D=8.36, r0inmRef=0.1382, zen=0, pmask=0,
         k = fno*wlum/imagedelta
 
     # Get the modulation transfer function with the van Karman power spectrum
-    mtfa = createMTFatm(D, m, k, wlum, zen, r0inmRef, model="vonK")
+    mtfa = getMTFatm(D, m, k, wlum, zen, r0inmRef, model="vonK")
 
     # Get the pupil function 
     if (aType == "opd"):
@@ -83,30 +237,9 @@ def calc_pssn(array, wlum, aType="opd", D=8.36, r0inmRef=0.1382, zen=0, pmask=0,
         # padArray(pmask, m)
         iad = pmask
 
-    # OPD --> PSF --> OTF --> OTF' (OTF + atmosphere) --> PSF'
-    # Check with Bo that we could get OTF' or PSF' from PhoSim or not directly.
-    # The above question might not be a concern in the simulation.
-    # However, for the real image, it loooks like this is hard to do
-    # What should be the standard way to judge the PSSN in the real telescope?
-
-    # OPD is zero for perfect telescope
-    opdt = np.zeros((m, m))
-
-    # OPD to PSF
-    psft = opd2psf(opdt, iad, wlum, imagedelta=imagedelta, sensorFactor=1, fno=fno, 
-                   debugLevel=debugLevel)
-    
-    # PSF to optical transfer function (OTF)
-    otft = psf2otf(psft)
-
-    # Add atmosphere to perfect telescope
-    otfa = otft*mtfa
-
-    # OTF to PSF
-    psfa = otf2psf(otfa)
-
-    # Atmospheric PSS (point spread sensitivity) = 1/neff_atm
-    pssa = np.sum(psfa**2)
+    # Atmospheric PSS (point spread sensitivity) = 1/neff_atm of perfect telescope
+    pssa, psftSum = getPSSatm(iad, wlum, D, m, k, zen, r0inmRef, imagedelta=imagedelta, fno=fno, 
+                              backend=backend)
 
     # Calculate PSF with error (atmosphere + system)
     if (aType == "opd"):
@@ -123,7 +256,7 @@ def calc_pssn(array, wlum, aType="opd", D=8.36, r0inmRef=0.1382, zen=0, pmask=0,
             else:
                 array2D = array[ii, :, :].squeeze()
            
-            psfei = opd2psf(array2D, iad, wlum, debugLevel=debugLevel)
+            psfei = opd2psf(array2D, iad, wlum, debugLevel=debugLevel, backend=backend)
             
             if (ii == 0):
                 psfe = psfei
@@ -147,20 +280,14 @@ def calc_pssn(array, wlum, aType="opd", D=8.36, r0inmRef=0.1382, zen=0, pmask=0,
             psfe = padArray(array, mk)
 
         # Do the normalization of PSF
-        psfe = psfe/np.sum(psfe)*np.sum(psft)
-
-    # OTF with system error
-    otfe = psf2otf(psfe)
-
-    # Add the atmosphere error
-    # OTF with system and atmosphere errors
-    otftot = otfe*mtfa
+        psfe = backend.castArray(psfe/np.sum(psfe)*psftSum)
 
-    # PSF with system and atmosphere errors
-    psftot = otf2psf(otftot)
+    # PSF --> OTF with system error --> OTF with system and atmosphere errors --> PSF with system 
+    # and atmosphere errors
+    psftot = backend.applyMtf(psfe, mtfa)
 
     # atmospheric + error PSS
-    pss = np.sum(psftot**2)
+    pss = np.sum(psftot**2, dtype=float)
 
     # normalized PSS
     pssn = pss/pssa
@@ -170,6 +297,189 @@ def calc_pssn(array, wlum, aType="opd", D=8.36, r0inmRef=0.1382, zen=0, pmask=0,
 
     return pssn
 
+def calc_pssn_batch(opdStack, wlum, D=8.36, r0inmRef=0.1382, zen=0, chunkSize=16, backend=None):
+    """
+    
+    Calculate the normalized point source sensitivity (PSSN) of a stack of optical path 
+    difference (OPD) maps. Unlike calc_pssn(), each map is an independent field point. The FFT 
+    chain runs along the stack axis in chunks, and the atmospheric MTF and PSS of perfect 
+    telescope come from the cache.
+    
+    Arguments:
+        opdStack {[ndarray]} -- OPD maps in microns in the shape of (nOpd, m, m). The piston and 
+                                tilts should be removed and the values outside of pupil should 
+                                be zeros.
+        wlum {[float]} -- Wavelength in microns.
+    
+    Keyword Arguments:
+        D {float} -- Side length of OPD image in meter. (default: {8.36})
+        r0inmRef {float} -- Fidicial atmosphere r0 @ 500nm in meter. (default: {0.1382})
+        zen {float} -- Telescope zenith angle in degree. (default: {0})
+        chunkSize {int} -- Number of OPD maps transformed at a time. (default: {16})
+        backend {[FftBackend]} -- FFT backend. Use the default backend if None. (default: {None})
+    
+    Returns:
+        [ndarray] -- PSSN values.
+    """
+
+    backend = getFftBackend(backend)
+
+    # Make sure all NaN in OPD to be 0
+    opdStack = np.array(opdStack, dtype=float)
+    if (opdStack.ndim == 2):
+        opdStack = opdStack[np.newaxis, :, :]
+    opdStack[np.isnan(opdStack)] = 0
+
+    numOpd = opdStack.shape[0]
+    m = max(opdStack.shape[1:])
+    k = 1
+
+    # Get the modulation transfer function with the van Karman power spectrum
+    mtfa = getMTFatm(D, m, k, wlum, zen, r0inmRef, model="vonK")
+
+    # Pupil functions and atmospheric PSS of perfect telescope
+    pupil = (opdStack != 0)
+    pssa = np.array([getPSSatm(pupil[ii], wlum, D, m, k, zen, r0inmRef, backend=backend)[0] 
+                     for ii in range(numOpd)])
+
+    axes = (-2, -1)
+    pss = np.zeros(numOpd)
+    for start in range(0, numOpd, int(chunkSize)):
+        end = start + int(chunkSize)
+
+        # OPD to PSF
+        z = backend.castArray(pupil[start:end]) * \
+            np.exp(-2j * np.pi * backend.castArray(opdStack[start:end]) / wlum)
+        z = backend.fft2(z)
+        psfe = np.absolute(z**2)
+        psfe = psfe/np.sum(psfe, axis=axes, keepdims=True)
+
+        # PSF to OTF, add the atmosphere, and back to PSF
+        psftot = backend.applyMtf(psfe, mtfa)
+
+        # atmospheric + error PSS
+        pss[start:end] = np.sum(psftot**2, axis=axes, dtype=float)
+
+    # normalized PSS
+    pssn = pss/pssa
+
+    return pssn
+
+def getPSSatm(pupil, wlum, D, m, k, zen, r0inmRef, imagedelta=0, fno=1.2335, backend=None):
+    """
+    
+    Get the atmospheric point source sensitivity (PSS) of perfect telescope from the cache. The 
+    PSS only depends on the pupil mask, wavelength, and atmosphere, and is calculated by 
+    calcPSSatm() only if it is not in the cache.
+    
+    Arguments:
+        pupil {[ndarray]} -- Pupil mask.
+        wlum {[float]} -- Wavelength in microns.
+        D {[float]} -- Side length of OPD image in meter.
+        m {[int]} -- Dimension of OPD image in pixel.
+        k {[float]} -- Magnification ratio used in creating MTF.
+        zen {[float]} -- Telescope zenith angle in degree.
+        r0inmRef {[float]} -- Fidicial atmosphere r0 @ 500nm in meter.
+    
+    Keyword Arguments:
+        imagedelta {float} -- Pixel size in um. Use 0 for opd. (default: {0})
+        fno {float} -- F-number. (default: {1.2335})
+        backend {[FftBackend]} -- FFT backend. Use the default backend if None. (default: {None})
+    
+    Returns:
+        [float] -- Atmospheric PSS.
+        [float] -- Sum of PSF of perfect telescope.
+    """
+
+    backend = getFftBackend(backend)
+
+    pupil = np.ascontiguousarray(pupil)
+    pupilHash = hashlib.md5(pupil.tobytes()).hexdigest()
+
+    key = ("pssAtm", pupilHash, pupil.shape, str(pupil.dtype), float(wlum), float(D), float(m), 
+           float(k), float(zen), float(r0inmRef), float(imagedelta), float(fno), 
+           bool(backend.singlePrecision))
+    pssAtm = pssAtmCache.get(key, calcPSSatm, pupil, wlum, D, m, k, zen, r0inmRef, imagedelta, fno, 
+                             backend)
+
+    return pssAtm[0], pssAtm[1]
+
+def calcPSSatm(pupil, wlum, D, m, k, zen, r0inmRef, imagedelta=0, fno=1.2335, backend=None):
+    """
+    
+    Calculate the atmospheric point source sensitivity (PSS) of perfect telescope.
+    
+    Arguments:
+        pupil {[ndarray]} -- Pupil mask.
+        wlum {[float]} -- Wavelength in microns.
+        D {[float]} -- Side length of OPD image in meter.
+        m {[int]} -- Dimension of OPD image in pixel.
+        k {[float]} -- Magnification ratio used in creating MTF.
+        zen {[float]} -- Telescope zenith angle in degree.
+        r0inmRef {[float]} -- Fidicial atmosphere r0 @ 500nm in meter.
+    
+    Keyword Arguments:
+        imagedelta {float} -- Pixel size in um. Use 0 for opd. (default: {0})
+        fno {float} -- F-number. (default: {1.2335})
+        backend {[FftBackend]} -- FFT backend. Use the default backend if None. (default: {None})
+    
+    Returns:
+        [ndarray] -- Atmospheric PSS and sum of PSF of perfect telescope.
+    """
+
+    backend = getFftBackend(backend)
+
+    # Get the modulation transfer function with the van Karman power spectrum
+    mtfa = getMTFatm(D, m, k, wlum, zen, r0inmRef, model="vonK")
+
+    # OPD --> PSF --> OTF --> OTF' (OTF + atmosphere) --> PSF'
+    # Check with Bo that we could get OTF' or PSF' from PhoSim or not directly.
+    # The above question might not be a concern in the simulation.
+    # However, for the real image, it loooks like this is hard to do
+    # What should be the standard way to judge the PSSN in the real telescope?
+
+    # OPD is zero for perfect telescope
+    opdt = np.zeros((m, m))
+
+    # OPD to PSF
+    psft = opd2psf(opdt, pupil, wlum, imagedelta=imagedelta, sensorFactor=1, fno=fno, 
+                   backend=backend)
+    
+    # PSF to optical transfer function (OTF), add atmosphere to perfect telescope, and OTF to PSF
+    psfa = backend.applyMtf(psft, mtfa)
+
+    # Atmospheric PSS (point spread sensitivity) = 1/neff_atm
+    pssa = np.sum(psfa**2, dtype=float)
+
+    return np.array([pssa, np.sum(psft, dtype=float)])
+
+def getMTFatm(D, m, k, wlum, zen, r0inmRef, model="vonK"):
+    """
+    
+    Get the modulation transfer function (MTF) for atmosphere from the cache. The MTF is 
+    created by createMTFatm() only if it is not in the cache. Use mtfAtmCache.config() to set 
+    the size of cache and the directory to persist the MTF.
+    
+    Arguments:
+        D {[float]} -- Side length of optical path difference (OPD) image in m.
+        m {[int]} -- Dimension of OPD image in pixel.
+        k {[int]} -- Use a k-times bigger array to pad the MTF. Use k=1 for the same size.
+        wlum {[float]} -- Wavelength in um.
+        zen {[float]} -- Telescope zenith angle in degree.
+        r0inmRef {[float]} -- Reference r0 in meter at the wavelength of 0.5 um.
+    
+    Keyword Arguments:
+        model {str} -- Kolmogorov power spectrum ("Kolm") or van Karman power spectrum ("vonK"). 
+                       (default: {"vonK"})
+    
+    Returns:
+        [ndarray] -- Read-only MTF at specific atmosphere model.
+    """
+
+    key = ("mtfAtm", float(D), float(m), float(k), float(wlum), float(zen), float(r0inmRef), model)
+
+    return mtfAtmCache.get(key, createMTFatm, D, m, k, wlum, zen, r0inmRef, model)
+
 def createMTFatm(D, m, k, wlum, zen, r0inmRef, model="vonK"):
     """
     
@@ -243,15 +553,22 @@ def atmSF(D, m, wlum, zen, r0inmRef, model):
     # Frequency resolution in 1/rad
     dr = D / (m - 1)
 
-    # Atmosphere r
-    r = dr * np.sqrt((x - m0)**2 + (y - m0)**2)
+    # The structure function only depends on the radius. Evaluate it on the unique squared 
+    # radii in pixel and look up the values on the grid.
+    r2Grid = ((x - m0)**2 + (y - m0)**2).astype(int)
+    r2 = np.flatnonzero(np.bincount(r2Grid.ravel()))
+
+    # Atmosphere r except the center
+    r2 = r2[r2 != 0]
+    r = dr * np.sqrt(r2)
 
-    # Calculate the structure function
+    # Calculate the structure function. It is 0 at the center.
+    sfaR = np.zeros(r2Grid.max() + 1)
 
     # Kolmogorov power spectrum
     if (model == "Kolm"):
         # D(r) = 6.88 * (r/r0)^(5/3) in p.117, Chap. 11 of PhoSim referece
-        sfa = 6.88 * (r / r0a)**(5 / 3)
+        sfaR[r2] = 6.88 * (r / r0a)**(5 / 3)
 
     # van Karman power spectrum
     elif (model == "vonK"):
@@ -264,17 +581,13 @@ def atmSF(D, m, wlum, zen, r0inmRef, model):
                 (24 / 5 * sp.gamma(6 / 5))**(5 / 6) * (r0a / L0)**(-5 / 3)
        
         # Modified bessel of 2nd/3rd kind
+        # At the center, sfa_k=Inf, 0*Inf=Nan. If it is not 0, everything will be nan after 
+        # ifft2.
         sfa_k = sp.kv(5 / 6, (2 * np.pi / L0 * r))
         
-        sfa = sfa_c * (2**(-1 / 6) * sp.gamma(5 / 6) - (2 * np.pi / L0 * r)**(5 / 6) * sfa_k)
-
-        # If we don't do below, everything will be nan after ifft2
-        # midp = r.shape[0]/2+1
-        # 1e-2 is to avoid x.49999 be rounded to x
-        midp = int(np.rint(0.5 * (r.shape[0] - 1) + 1e-2))
+        sfaR[r2] = sfa_c * (2**(-1 / 6) * sp.gamma(5 / 6) - (2 * np.pi / L0 * r)**(5 / 6) * sfa_k)
 
-        # At this single point, sfa_k=Inf, 0*Inf=Nan;
-        sfa[midp, midp] = 0
+    sfa = sfaR[r2Grid]
 
     return sfa
 
@@ -305,7 +618,7 @@ def r0Wz(r0inmRef, zen, wlum):
     return r0a
 
 def psf2eAtmW(array, wlum, aType="opd", D=8.36, pmask=0, r0inmRef=0.1382,
-              sensorFactor=1, zen=0, imagedelta=0.2, fno=1.2335, debugLevel=0):
+              sensorFactor=1, zen=0, imagedelta=0.2, fno=1.2335, debugLevel=0, backend=None):
     """
     
     Calculate the ellipticity with the error of atmosphere and weighting function.
@@ -325,6 +638,7 @@ def psf2eAtmW(array, wlum, aType="opd", D=8.36, pmask=0, r0inmRef=0.1382,
         imagedelta {float} -- Only needed when psf is used. 1 pixel = 0.2 arcsec. (default: {0.2})
         fno {float} -- ? Check with Bo. (default: {1.2335})
         debugLevel {int} -- Debug level. The higher value gives more information. (default: {0})
+        backend {[FftBackend]} -- FFT backend. Use the default backend if None. (default: {None})
     
     Returns:
         [float] -- Ellipticity.
@@ -336,6 +650,8 @@ def psf2eAtmW(array, wlum, aType="opd", D=8.36, pmask=0, r0inmRef=0.1382,
     # Unlike calc_pssn(), here imagedelta needs to be provided for type='opd'
     # because the ellipticity calculation operates on psf.
 
+    backend = getFftBackend(backend)
+
     # Get the k value
     k = fno*wlum/imagedelta
     
@@ -343,22 +659,17 @@ def psf2eAtmW(array, wlum, aType="opd", D=8.36, pmask=0, r0inmRef=0.1382,
     if aType == "opd":
         m = array.shape[0]/sensorFactor
         psfe = opd2psf(array, 0, wlum, imagedelta=imagedelta, sensorFactor=sensorFactor, 
-                       fno=fno, debugLevel=debugLevel)
+                       fno=fno, debugLevel=debugLevel, backend=backend)
     else:
         m = max(pmask.shape)
         psfe = array
 
-    # Opitcal transfer function (OTF) of system error
-    otfe = psf2otf(psfe)
-
     # Modulation transfer function (MTF) with atmosphere
-    mtfa = createMTFatm(D, m, k, wlum, zen, r0inmRef)
+    mtfa = getMTFatm(D, m, k, wlum, zen, r0inmRef)
 
-    # OTF with system and atmosphere errors
-    otf = otfe*mtfa
-
-    # PSF with system and atmosphere errors
-    psf = otf2psf(otf)
+    # Opitcal transfer function (OTF) of system error --> OTF with system and atmosphere errors 
+    # --> PSF with system and atmosphere errors
+    psf = backend.applyMtf(psfe, mtfa)
 
     if (debugLevel >= 3):
         print("Below from the Gaussian weigting function on ellipticity.")
@@ -497,7 +808,8 @@ def createAtm(wlum, fwhminarcsec, gridsize, pixinum, oversample, model="Gau", de
     
     return z
 
-def opd2psf(opd, pupil, wavelength, imagedelta=0, sensorFactor=1, fno=1.2335, debugLevel=0):
+def opd2psf(opd, pupil, wavelength, imagedelta=0, sensorFactor=1, fno=1.2335, debugLevel=0, 
+            backend=None):
     """
     
     Optical path difference (OPD) to point spread function (PSF).
@@ -514,6 +826,7 @@ def opd2psf(opd, pupil, wavelength, imagedelta=0, sensorFactor=1, fno=1.2335, de
                                 imagedelta != 0. (default: {1})
         fno {float} -- ? Check with Bo. Only need this if imagedelta=0. (default: {1.2335})
         debugLevel {int} -- Debug level. The higher value gives more information. (default: {0})
+        backend {[FftBackend]} -- FFT backend. Use the default backend if None. (default: {None})
     
     Returns:
         [ndarray] -- Normalized PSF.
@@ -569,8 +882,9 @@ def opd2psf(opd, pupil, wavelength, imagedelta=0, sensorFactor=1, fno=1.2335, de
             print("padding = %8.6f." % padding)
 
     # If imagedelta = 0, we don't do any padding, and go with below
-    z = pupil * np.exp(-2j * np.pi * opd / wavelength)
-    z = np.fft.fftshift(np.fft.fft2(np.fft.fftshift(z), s=z.shape))
+    backend = getFftBackend(backend)
+    z = backend.castArray(pupil) * np.exp(-2j * np.pi * backend.castArray(opd) / wavelength)
+    z = backend.fft2(z)
     z = np.absolute(z**2)
 
     # Normalize the PSF
@@ -587,7 +901,7 @@ def opd2psf(opd, pupil, wavelength, imagedelta=0, sensorFactor=1, fno=1.2335, de
 
     return z
 
-def psf2otf(psf):
+def psf2otf(psf, backend=None):
     """
     
     Point spread function (PSF) to optical transfer function (OTF).
@@ -595,15 +909,18 @@ def psf2otf(psf):
     Arguments:
         psf {[ndarray]} -- Point spread function.
     
+    Keyword Arguments:
+        backend {[FftBackend]} -- FFT backend. Use the default backend if None. (default: {None})
+    
     Returns:
         [ndarray] -- Optacal transfer function.
     """
     
-    otf = np.fft.fftshift(np.fft.fft2(np.fft.fftshift(psf), s=psf.shape))
+    otf = getFftBackend(backend).fft2(psf)
     
     return otf
 
-def otf2psf(otf):
+def otf2psf(otf, backend=None):
     """
     
     Optical transfer function (OTF) to point spread function (PSF.
@@ -611,11 +928,14 @@ def otf2psf(otf):
     Arguments:
         otf {[ndarray]} -- Optical transfer function.
     
+    Keyword Arguments:
+        backend {[FftBackend]} -- FFT backend. Use the default backend if None. (default: {None})
+    
     Returns:
         [ndarray] -- Point spread function.
     """
 
-    psf = np.absolute(np.fft.fftshift(np.fft.ifft2(np.fft.fftshift(otf), s=otf.shape)))
+    psf = np.absolute(getFftBackend(backend).ifft2(otf))
 
     return psf
 
@@ -1,4 +1,4 @@
-import os, unittest
+import os, time, unittest
 import numpy as np
 from scipy.interpolate import Rbf
 import matplotlib
@@ -7,6 +7,7 @@ matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 
 from lsst.ts.wep.cwfs.Tool import ZernikeFit, ZernikeEval
+from wepPhoSim.StageTimer import StageTimer
 
 class MirrorSim(object):
     
@@ -30,6 +31,12 @@ class MirrorSim(object):
 
         self.mirrorDataDir = mirrorDataDir
 
+        # Loaded mirror data: {(dataFileName, skiprows): (mtime, data)}
+        self.mirrorData = dict()
+
+        # Timer of stages
+        self.timer = StageTimer()
+
     def setMirrorDataDir(self, mirrorDataDir):
         """
         
@@ -40,11 +47,25 @@ class MirrorSim(object):
         """
 
         self.mirrorDataDir = mirrorDataDir
+        self.mirrorData = dict()
+
+    def setTimer(self, timer):
+        """
+        
+        Set the timer to record the time of stages.
+        
+        Arguments:
+            timer {[StageTimer]} -- StageTimer object.
+        """
+
+        self.timer = timer
 
     def getMirrorData(self, dataFileName, skiprows=0):
         """
         
-        Get the mirror data.
+        Get the mirror data. The data file is read only once unless it is modified. The returned 
+        data is read-only because it is shared by the calls. The public getters of mirror data 
+        (e.g. getActForce() and getLUTforce()) return the copy.
         
         Arguments:
             dataFileName {[str]} -- Data file name.
@@ -56,9 +77,19 @@ class MirrorSim(object):
             [ndarray] -- Mirror data.
         """
 
-        data = np.loadtxt(os.path.join(self.mirrorDataDir, dataFileName), skiprows=skiprows)
+        dataFilePath = os.path.join(self.mirrorDataDir, dataFileName)
+        mtime = os.stat(dataFilePath).st_mtime_ns
+
+        key = (dataFileName, skiprows)
+        if (key not in self.mirrorData) or (self.mirrorData[key][0] != mtime):
+            with self.timer.stage("MirrorSim.readData"):
+                data = np.loadtxt(dataFilePath, skiprows=skiprows)
+            data.setflags(write=False)
+            self.mirrorData[key] = (mtime, data)
+        else:
+            self.timer.count("MirrorSim.dataCacheHit")
 
-        return data
+        return self.mirrorData[key][1]
 
     def setSurfAlongZ(self, surfAlongZinUm):
         """
@@ -102,12 +133,12 @@ class MirrorSim(object):
         # The specific zenith angle is larger than the listed angle range
         if (zangleInDeg >= ruler.max()):
             # Use the biggest listed zenith angle data instead
-            lutForce = lut[1:, -1]
+            lutForce = lut[1:, -1].copy()
 
         # The specific zenith angle is smaller than the listed angle range
         elif (zangleInDeg <= ruler.min()):
             # Use the smallest listed zenith angle data instead
-            lutForce = lut[1:, 0]
+            lutForce = lut[1:, 0].copy()
 
         # The specific zenith angle is in the listed angle range
         else:
@@ -148,7 +179,8 @@ class MirrorSim(object):
         """
 
         # Radial basis function approximation/interpolation of surface
-        Ff = Rbf(xfInMm, yfInMm, zfInMm)
+        with self.timer.stage("MirrorSim.rbfSolve"):
+            Ff = Rbf(xfInMm, yfInMm, zfInMm)
 
         # Number of grid points on x-, y-axis. 
         # Alway extend 2 points on each side
@@ -175,6 +207,9 @@ class MirrorSim(object):
         # Write four numbers for the header line
         content = "%d %d %.9E %.9E\n" % (NUM_X_PIXELS, NUM_Y_PIXELS, delx, dely)
 
+        # Time the grid sampling
+        startTime = time.perf_counter()
+
         #  Write the rows and columns
         for jj in range(1, NUM_X_PIXELS + 1):
             for ii in range(1, NUM_Y_PIXELS + 1):
@@ -226,14 +261,30 @@ class MirrorSim(object):
 
                 content += "%.9E %.9E %.9E %.9E\n" % (z, dx, dy, dxdy)
 
+        if (self.timer.enabled):
+            self.timer.addStageTime("MirrorSim.gridSample", time.perf_counter() - startTime)
+
         # Write the surface residue data into the file
         if (resFile is not None):
-            outid = open(resFile, "w");
-            outid.write(content)
-            outid.close()
+            self.writeToFile(resFile, content)
 
         return content
 
+    def writeToFile(self, filePath, content):
+        """
+        
+        Write the content to the file.
+        
+        Arguments:
+            filePath {[str]} -- File path.
+            content {[str]} -- Content to write.
+        """
+
+        with self.timer.stage("MirrorSim.writeFile"):
+            outid = open(filePath, "w")
+            outid.write(content)
+            outid.close()
+
     def __showResMap(self, zfInMm, xfInMm, yfInMm, outerRinMm, resFile=None, writeToResMapFilePath=None):
         """
         
@@ -325,7 +376,8 @@ class MirrorSim(object):
 
         # Get the surface change along the z-axis in the basis of Zk
         # It is noticed that the x and y coordinates are normalized for the fitting 
-        zc = ZernikeFit(surf, x, y, numTerms)
+        with self.timer.stage("MirrorSim.zernikeFit"):
+            zc = ZernikeFit(surf, x, y, numTerms)
 
         # Residue of fitting
         res = surf - ZernikeEval(zc, x, y)
@@ -346,6 +398,9 @@ class MirrorSim(object):
     def getMirrorResInMmInZemax(self):
         raise NotImplementedError("Should have the child class implemented this.")
 
+    def getMirZkAndGridResInZemax(self):
+        raise NotImplementedError("Should have the child class implemented this.")
+
     def writeMirZkAndGridResInZemax(self):
         raise NotImplementedError("Should have the child class implemented this.")
 
@@ -399,6 +454,11 @@ class MirrorSimTest(unittest.TestCase):
         ansLutForce = (oriLutForce[:,1]+oriLutForce[:,2])/2
         self.assertLess(np.sum(np.abs(LUTforce-ansLutForce)), 1e-10)
 
+        # The cached data is read-only but the returned forces are not
+        self.assertFalse(oriLutForce.flags.writeable)
+        for zangleInDeg in [-1, 1.5, 91]:
+            self.assertTrue(mirror.getLUTforce(zangleInDeg, LUTfileName).flags.writeable)
+
 if __name__ == "__main__":
 
     # Do the unit test
@@ -1,14 +1,19 @@
-import os, unittest
+import os, shutil, unittest
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from astropy.io import fits
 import matplotlib
 # Must be before importing matplotlib.pyplot or pylab!
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 
-from lsst.ts.wep.cwfs.Tool import ZernikeAnnularFit, ZernikeEval
 from lsst.ts.wep.SourceProcessor import SourceProcessor
-from wepPhoSim.MetroTool import calc_pssn, psf2eAtmW
+from wepPhoSim.MetroTool import calc_pssn, calc_pssn_batch, psf2eAtmW, setFftBackend, \
+                               getFftBackend
+from wepPhoSim.FftBackend import FftBackend
+from wepPhoSim.OpdReader import OpdReader
+from wepPhoSim.ZernikeFitter import ZernikeFitter
+from wepPhoSim.StageTimer import StageTimer
 
 class OpdMetrology(object):
 
@@ -22,6 +27,38 @@ class OpdMetrology(object):
         self.fieldX = np.array([])
         self.fieldY = np.array([])
 
+        # Timer of stages
+        self.timer = StageTimer()
+
+        # Reader of OPD FITS file
+        self.opdReader = OpdReader()
+
+        # Fitter of annular Zk with the cached basis
+        self.zkFitter = ZernikeFitter()
+
+    def setTimer(self, timer):
+        """
+        
+        Set the timer to record the time of stages.
+        
+        Arguments:
+            timer {[StageTimer]} -- StageTimer object.
+        """
+
+        self.timer = timer
+
+    def setOpdReader(self, opdReader):
+        """
+        
+        Set the reader of OPD FITS file. Use the reader with the cache directory to decompress 
+        each FITS file only once.
+        
+        Arguments:
+            opdReader {[OpdReader]} -- OpdReader object.
+        """
+
+        self.opdReader = opdReader
+
     def setWeightingRatio(self, wt):
         """
         
@@ -184,7 +221,8 @@ class OpdMetrology(object):
 
         # Get the OPD data (PhoSim OPD unit: um)
         if (opdFitsFile is not None):
-            opd = fits.getdata(opdFitsFile)
+            with self.timer.stage("OpdMetrology.readOpd"):
+                opd = np.array(self.opdReader.readOpd(opdFitsFile))
         elif (opdMap is not None):
             opd = opdMap.copy()
 
@@ -193,16 +231,45 @@ class OpdMetrology(object):
             raise RuntimeError("The x, y dimensions of OPD are different.")
 
         # x-, y-coordinate in the OPD image
-        opdSize = opd.shape[0]
-        opdGrid1d = np.linspace(-1, 1, opdSize)
-        opdx, opdy = np.meshgrid(opdGrid1d, opdGrid1d)
+        opdx, opdy = self.zkFitter.getGrid(opd.shape[0])
 
-        # Fit the OPD map with Zk and write into the file
-        idx = (opd != 0)
-        zk = ZernikeAnnularFit(opd[idx], opdx[idx], opdy[idx], znTerms, obscuration)
+        # Fit the OPD map with Zk by the cached basis
+        with self.timer.stage("OpdMetrology.zernikeFit"):
+            zk = self.zkFitter.fit(opd, znTerms=znTerms, obscuration=obscuration)
 
         return zk, opd, opdx, opdy
 
+    def getZkFromOpdStack(self, opdStack, znTerms=22, obscuration=0.61):
+        """
+        
+        Get the wavefront error of the stack of optical path difference (OPD) maps in the basis 
+        of annular Zernike polynomials. The maps sharing the same pupil are fitted by one matrix 
+        product.
+        
+        Arguments:
+            opdStack {[ndarray]} -- OPD maps in the shape of (nOpd, N, N).
+        
+        Keyword Arguments:
+            znTerms {int} -- Number of terms of annular Zk (z1-z22 by default). (default: {22})
+            obscuration {float} -- Obscuration of annular Zernike polynomial. (default: {0.61})
+        
+        Returns:
+            [ndarray] -- Annular Zernike polynomials in the shape of (nOpd, znTerms). For PhoSim 
+                         OPD, the unit is um.
+        
+        Raises:
+            RuntimeError -- The x, y dimensions of OPD are different.
+        """
+
+        opdStack = np.asarray(opdStack)
+        if (opdStack.shape[1] != opdStack.shape[2]):
+            raise RuntimeError("The x, y dimensions of OPD are different.")
+
+        with self.timer.stage("OpdMetrology.zernikeFit"):
+            zk = self.zkFitter.fitStack(opdStack, znTerms=znTerms, obscuration=obscuration)
+
+        return zk
+
     def rmPTTfromOPD(self, opdFitsFile=None, opdMap=None):
         """
         
@@ -227,11 +294,41 @@ class OpdMetrology(object):
         # Find the index that the value of OPD is not 0
         idx = (opd != 0)
 
-        # Remove the PTT
-        opd[idx] -= ZernikeEval(zk, opdx[idx], opdy[idx])
+        # Remove the PTT. The annular Zk without obscuration is the Zk.
+        opd[idx] -= self.zkFitter.getBasis(idx, 3, 0).dot(zk)
 
         return opd, opdx, opdy
 
+    def rmPTTfromOpdStack(self, opdStack):
+        """
+        
+        Remove the afftection of piston (z1), x-tilt (z2), and y-tilt (z3) from a stack of 
+        optical path difference (OPD) maps. The maps sharing the same pupil are fitted by one 
+        matrix product with the cached Zk basis.
+        
+        Arguments:
+            opdStack {[ndarray]} -- OPD maps in the shape of (nOpd, N, N).
+        
+        Returns:
+            [ndarray] -- OPD maps after removing the affection of z1-z3.
+        
+        Raises:
+            RuntimeError -- The x, y dimensions of OPD are different.
+        """
+
+        opdStack = np.array(opdStack, dtype=float)
+        if (opdStack.shape[1] != opdStack.shape[2]):
+            raise RuntimeError("The x, y dimensions of OPD are different.")
+
+        # Remove the PTT. The annular Zk without obscuration is the Zk.
+        for idx, idxList in self.zkFitter.groupByPupil(opdStack):
+            opd = opdStack[idxList]
+            zk = opd[:, idx].dot(self.zkFitter.getPinv(idx, 3, 0).T)
+            opd[:, idx] -= zk.dot(self.zkFitter.getBasis(idx, 3, 0).T)
+            opdStack[idxList] = opd
+
+        return opdStack
+
     def addFieldXYbyCamPos(self, sensorName, xInpixel, yInPixel, folderPath2FocalPlane):
         """
         
@@ -280,10 +377,68 @@ class OpdMetrology(object):
         opdRmPTT = self.rmPTTfromOPD(opdFitsFile=opdFitsFile, opdMap=opdMap)[0]
 
         # Calculate the normalized point source sensitivity (PSSN)
-        pssn = calc_pssn(opdRmPTT, wavelengthInUm, zen=zen, debugLevel=debugLevel)
+        with self.timer.stage("OpdMetrology.calcPSSN"):
+            pssn = calc_pssn(opdRmPTT, wavelengthInUm, zen=zen, debugLevel=debugLevel)
 
         return pssn
 
+    def calcPSSNinBatch(self, wavelengthInUm, opdMapList=None, opdFitsFileList=None, zen=0, 
+                        numWorker=1):
+        """
+        
+        Calculate the normalized point source sensitivity (PSSN) of field points based on the 
+        stack of optical path difference (OPD) maps. The stack can be split into the chunks 
+        calculated in the worker processes.
+        
+        Arguments:
+            wavelengthInUm {[float]} -- Wavelength in microns.
+        
+        Keyword Arguments:
+            opdMapList {[list/ ndarray]} -- OPD maps in the shape of (nField, N, N). 
+                                            (default: {None})
+            opdFitsFileList {[list]} -- OPD FITS files. This is used if the OPD maps are None. 
+                                        (default: {None})
+            zen {float} -- Telescope zenith angle in degree. (default: {0})
+            numWorker {int} -- Number of worker processes. Use the number of CPUs if None. The 
+                               stack is calculated in this process if it is 1. (default: {1})
+        
+        Returns:
+            [ndarray] -- PSSN of field points.
+            [float] -- PSSN on Gaussian quadrature (GQ). The weighting ratio applies to the first 
+                       field points. None if there is no weighting ratio or the number of field 
+                       points is less than the length of weighting ratio.
+        """
+
+        if (opdMapList is None):
+            with self.timer.stage("OpdMetrology.readOpd"):
+                opdMapList = self.opdReader.readOpdStack(opdFitsFileList)
+
+        # Remove PTT (piston, x-tilt, y-tilt) for all field points
+        opdRmPTT = self.rmPTTfromOpdStack(opdMapList)
+
+        if (numWorker is None):
+            numWorker = os.cpu_count()
+        numWorker = min(int(numWorker), len(opdRmPTT))
+
+        # Calculate the normalized point source sensitivity (PSSN)
+        with self.timer.stage("OpdMetrology.calcPSSNinBatch"):
+            if (numWorker <= 1):
+                pssn = calc_pssn_batch(opdRmPTT, wavelengthInUm, zen=zen)
+            else:
+                # The workers use the same FFT backend as this process
+                backend = getFftBackend()
+                with ProcessPoolExecutor(max_workers=numWorker) as executor:
+                    futureList = [executor.submit(calc_pssn_batch, opdChunk, wavelengthInUm, 
+                                                  zen=zen, backend=backend) 
+                                    for opdChunk in np.array_split(opdRmPTT, numWorker)]
+                    pssn = np.concatenate([future.result() for future in futureList])
+
+        gqPssn = None
+        if (len(self.wt) > 0) and (len(pssn) >= len(self.wt)):
+            gqPssn = self.calcGQvalue(pssn[0:len(self.wt)])
+
+        return pssn, gqPssn
+
     def calcFWHMeff(self, pssn):
         """
         
@@ -346,10 +501,114 @@ class OpdMetrology(object):
         opdRmPTT = self.rmPTTfromOPD(opdFitsFile=opdFitsFile, opdMap=opdMap)[0]
 
         # Calculate the ellipticity
-        elli = psf2eAtmW(opdRmPTT, wavelengthInUm, zen=zen, debugLevel=debugLevel)[0]
+        with self.timer.stage("OpdMetrology.calcEllip"):
+            elli = psf2eAtmW(opdRmPTT, wavelengthInUm, zen=zen, debugLevel=debugLevel)[0]
 
         return elli
 
+    def calcImageQuality(self, wavelengthInUm, opdFitsFile=None, opdMap=None, zen=0, debugLevel=0):
+        """
+        
+        Calculate the normalized point source sensitivity (PSSN), effective full width at half 
+        maximum (FWHM), loss of limiting depth (dm5), and ellipticity together. The OPD is read 
+        and the piston and tilts are removed only once for all metrics.
+        
+        Arguments:
+            wavelengthInUm {[float]} -- Wavelength in microns.
+        
+        Keyword Arguments:
+            opdFitsFile {[str]} -- OPD FITS file. (default: {None})
+            opdMap {[ndarray]} -- OPD map data. (default: {None})
+            zen {float} -- Telescope zenith angle in degree. (default: {0})
+            debugLevel {int} -- Debug level. The higher value gives more information. (default: {0})
+        
+        Returns:
+            [float] -- PSSN.
+            [float] -- Effective FWHM.
+            [float] -- dm5.
+            [float] -- Ellipticity.
+        """
+
+        # Remove the affection of piston (z1), x-tilt (z2), and y-tilt (z3) from OPD map.
+        opdRmPTT = self.rmPTTfromOPD(opdFitsFile=opdFitsFile, opdMap=opdMap)[0]
+
+        # The PSF of ellipticity is sampled by the pixel size and can not be shared with PSSN, 
+        # but both use the cached atmosphere MTF.
+        with self.timer.stage("OpdMetrology.calcPSSN"):
+            pssn = calc_pssn(opdRmPTT, wavelengthInUm, zen=zen, debugLevel=debugLevel)
+
+        with self.timer.stage("OpdMetrology.calcEllip"):
+            elli = psf2eAtmW(opdRmPTT, wavelengthInUm, zen=zen, debugLevel=debugLevel)[0]
+
+        fwhmEff = self.calcFWHMeff(pssn)
+        dm5 = self.calcDm5(pssn)
+
+        return pssn, fwhmEff, dm5, elli
+
+    def calcPSSNandEllip(self, wavelengthInUm, opdFitsFileList=None, opdMapList=None, zen=0, 
+                         numWorker=1):
+        """
+        
+        Calculate the normalized point source sensitivity (PSSN) and ellipticity of field 
+        points. The field points can be distributed to the worker processes, and each worker 
+        reads its own OPD FITS file. The values are the same as calcPSSN() and calcEllip(). The 
+        stage time of workers is merged into the timer, but the read counters of the OPD reader 
+        in the workers are not.
+        
+        Arguments:
+            wavelengthInUm {[float]} -- Wavelength in microns.
+        
+        Keyword Arguments:
+            opdFitsFileList {[list]} -- OPD FITS files in the order of field points. 
+                                        (default: {None})
+            opdMapList {[list/ ndarray]} -- OPD maps in the order of field points. This is used 
+                                            if the OPD FITS files are None. (default: {None})
+            zen {float} -- Telescope zenith angle in degree. (default: {0})
+            numWorker {int} -- Number of worker processes. Use the number of CPUs if None. The 
+                               field points are calculated in this process if it is 1. 
+                               (default: {1})
+        
+        Returns:
+            [ndarray] -- PSSN of field points.
+            [ndarray] -- Ellipticity of field points.
+        """
+
+        if (opdFitsFileList is not None):
+            taskList = [(opdFitsFile, None) for opdFitsFile in opdFitsFileList]
+        else:
+            taskList = [(None, opdMap) for opdMap in opdMapList]
+
+        if (numWorker is None):
+            numWorker = os.cpu_count()
+        numWorker = min(int(numWorker), len(taskList))
+
+        # The workers use the same FFT backend as this process
+        backend = getFftBackend()
+
+        if (numWorker <= 1):
+            resultList = [calcFieldPSSNandEllip(self, wavelengthInUm, opdFitsFile, opdMap, zen, 
+                                                backend) 
+                            for opdFitsFile, opdMap in taskList]
+        else:
+            # Only the reader and fitter are sent to the workers once
+            initargs = (self.opdReader, self.zkFitter, self.timer.enabled)
+            with self.timer.stage("OpdMetrology.calcPSSNandEllipInPool"), \
+                 ProcessPoolExecutor(max_workers=numWorker, initializer=initFieldWorker, 
+                                     initargs=initargs) as executor:
+                futureList = [executor.submit(calcFieldPSSNandEllipInWorker, wavelengthInUm, 
+                                              opdFitsFile, opdMap, zen, backend) 
+                                for opdFitsFile, opdMap in taskList]
+                resultList = []
+                for future in futureList:
+                    pssn, elli, stageData, counterData = future.result()
+                    self.timer.merge(stageData, counterData)
+                    resultList.append((pssn, elli))
+
+        pssn = np.array([result[0] for result in resultList])
+        elli = np.array([result[1] for result in resultList])
+
+        return pssn, elli
+
     def calcGQvalue(self, valueList):
         """
         
@@ -477,6 +736,80 @@ class OpdMetrology(object):
 
         return fieldXinDegList, fieldYinDeglist
 
+def calcFieldPSSNandEllip(opdMetr, wavelengthInUm, opdFitsFile, opdMap, zen, backend):
+    """
+    
+    Calculate the normalized point source sensitivity (PSSN) and ellipticity of one field 
+    point. This is used in the worker process of OpdMetrology.calcPSSNandEllip().
+    
+    Arguments:
+        opdMetr {[OpdMetrology]} -- OpdMetrology object.
+        wavelengthInUm {[float]} -- Wavelength in microns.
+        opdFitsFile {[str]} -- OPD FITS file. Use the OPD map if None.
+        opdMap {[ndarray]} -- OPD map data.
+        zen {[float]} -- Telescope zenith angle in degree.
+        backend {[FftBackend]} -- FFT backend.
+    
+    Returns:
+        [float] -- PSSN.
+        [float] -- Ellipticity.
+    """
+
+    # Remove the affection of piston (z1), x-tilt (z2), and y-tilt (z3) from OPD map.
+    opdRmPTT = opdMetr.rmPTTfromOPD(opdFitsFile=opdFitsFile, opdMap=opdMap)[0]
+
+    with opdMetr.timer.stage("OpdMetrology.calcPSSN"):
+        pssn = calc_pssn(opdRmPTT, wavelengthInUm, zen=zen, backend=backend)
+
+    with opdMetr.timer.stage("OpdMetrology.calcEllip"):
+        elli = psf2eAtmW(opdRmPTT, wavelengthInUm, zen=zen, backend=backend)[0]
+
+    return pssn, elli
+
+def initFieldWorker(opdReader, zkFitter, timerEnabled):
+    """
+    
+    Initiate the worker process of OpdMetrology.calcPSSNandEllip() with the OPD reader and 
+    Zernike fitter.
+    
+    Arguments:
+        opdReader {[OpdReader]} -- OpdReader object.
+        zkFitter {[ZernikeFitter]} -- ZernikeFitter object.
+        timerEnabled {[bool]} -- Record the stage time or not.
+    """
+
+    global fieldMetr
+    fieldMetr = OpdMetrology()
+    fieldMetr.setOpdReader(opdReader)
+    fieldMetr.zkFitter = zkFitter
+    fieldMetr.setTimer(StageTimer(enabled=timerEnabled))
+
+def calcFieldPSSNandEllipInWorker(wavelengthInUm, opdFitsFile, opdMap, zen, backend):
+    """
+    
+    Calculate the normalized point source sensitivity (PSSN) and ellipticity of one field 
+    point in the worker process.
+    
+    Arguments:
+        wavelengthInUm {[float]} -- Wavelength in microns.
+        opdFitsFile {[str]} -- OPD FITS file. Use the OPD map if None.
+        opdMap {[ndarray]} -- OPD map data.
+        zen {[float]} -- Telescope zenith angle in degree.
+        backend {[FftBackend]} -- FFT backend.
+    
+    Returns:
+        [float] -- PSSN.
+        [float] -- Ellipticity.
+        [dict] -- Stage time recorded in this call.
+        [dict] -- Counters recorded in this call.
+    """
+
+    fieldMetr.timer.reset()
+    pssn, elli = calcFieldPSSNandEllip(fieldMetr, wavelengthInUm, opdFitsFile, opdMap, zen, 
+                                       backend)
+
+    return pssn, elli, fieldMetr.timer.stageData, fieldMetr.timer.counterData
+
 class OpdMetrologyTest(unittest.TestCase):
     
     """
@@ -535,6 +868,11 @@ class OpdMetrologyTest(unittest.TestCase):
         zkRmPTT = metr.getZkFromOpd(opdMap=opdRmPTT)[0]
         self.assertLess(np.sum(np.abs(zkRmPTT[0:3])), 5e-2)
 
+        opdMap = fits.getdata(opdFilePath)
+        zkStack = metr.getZkFromOpdStack(np.array([opdMap, opdMap*2]))
+        self.assertTrue(np.allclose(zkStack[0], zk))
+        self.assertTrue(np.allclose(zkStack[1], 2*zk))
+
         sensorName = "R22_S11"
         xInpixel = 4000
         yInPixel = 4072
@@ -552,6 +890,22 @@ class OpdMetrologyTest(unittest.TestCase):
         allData = np.loadtxt(ansAllDataFilePath)
         self.assertAlmostEqual(pssn, allData[0,0])
 
+        opdMap = fits.getdata(opdFilePath)
+        pssnList, gqPssn = metr.calcPSSNinBatch(wavelengthInUm, opdMapList=[opdMap, opdMap*0.5])
+        self.assertEqual(len(pssnList), 2)
+        self.assertAlmostEqual(pssnList[0], allData[0,0])
+        self.assertAlmostEqual(pssnList[1], metr.calcPSSN(wavelengthInUm, opdMap=opdMap*0.5))
+        self.assertEqual(gqPssn, None)
+
+        metr.setWeightingRatio(np.array([0.25, 0.75]))
+        pssnList, gqPssn = metr.calcPSSNinBatch(wavelengthInUm, opdFitsFileList=[opdFilePath])
+        self.assertEqual(gqPssn, None)
+        pssnList, gqPssn = metr.calcPSSNinBatch(wavelengthInUm, opdMapList=[opdMap, opdMap*0.5])
+        self.assertAlmostEqual(gqPssn, 0.25*pssnList[0] + 0.75*pssnList[1])
+        poolPssnList = metr.calcPSSNinBatch(wavelengthInUm, opdMapList=[opdMap, opdMap*0.5], 
+                                            numWorker=2)[0]
+        self.assertTrue(np.allclose(poolPssnList, pssnList, rtol=0, atol=1e-12))
+
         fwhm = metr.calcFWHMeff(pssn)
         self.assertAlmostEqual(fwhm, allData[1,0])
 
@@ -565,6 +919,60 @@ class OpdMetrologyTest(unittest.TestCase):
         allElli = np.loadtxt(ansElliFilePath)
         self.assertAlmostEqual(elli, allElli[0])
 
+        pssn, fwhm, dm5, elli = metr.calcImageQuality(wavelengthInUm, opdFitsFile=opdFilePath)
+        self.assertAlmostEqual(pssn, allData[0,0])
+        self.assertAlmostEqual(fwhm, allData[1,0])
+        self.assertAlmostEqual(dm5, allData[2,0])
+        self.assertAlmostEqual(elli, allElli[0])
+
+        # The result does not depend on the FFT backend
+        setFftBackend(FftBackend(name="scipy", workers=2, useRfft=True))
+        try:
+            pssn = metr.calcPSSN(wavelengthInUm, opdFitsFile=opdFilePath)
+            self.assertAlmostEqual(pssn, allData[0,0])
+            elli = metr.calcEllip(wavelengthInUm, opdFitsFile=opdFilePath)
+            self.assertAlmostEqual(elli, allElli[0])
+
+            # Error bound of the single precision
+            setFftBackend(FftBackend(name="scipy", singlePrecision=True))
+            pssn = metr.calcPSSN(wavelengthInUm, opdFitsFile=opdFilePath)
+            self.assertAlmostEqual(pssn, allData[0,0], delta=1e-6)
+            elli = metr.calcEllip(wavelengthInUm, opdFitsFile=opdFilePath)
+            self.assertAlmostEqual(elli, allElli[0], delta=1e-6)
+        finally:
+            setFftBackend(FftBackend())
+
+        # Decompressed OPD in the cache gives the same values
+        cacheDir = os.path.join("..", "output", "tempOpdCache")
+        metr.setOpdReader(OpdReader(cacheDir=cacheDir))
+        try:
+            pssnList, elliList = metr.calcPSSNandEllip(wavelengthInUm, 
+                                                       opdFitsFileList=[opdFilePath, opdFilePath])
+            pssnList, gqPssn = metr.calcPSSNinBatch(wavelengthInUm, opdFitsFileList=[opdFilePath])
+            self.assertEqual(metr.opdReader.numMiss, 1)
+            self.assertEqual(metr.opdReader.numHit, 2)
+            self.assertAlmostEqual(pssnList[0], allData[0,0])
+            self.assertAlmostEqual(elliList[1], allElli[0])
+        finally:
+            shutil.rmtree(cacheDir)
+        metr.setOpdReader(OpdReader())
+
+        # Field points in the worker processes give the same values as the serial calculation
+        metr.setTimer(StageTimer(enabled=True))
+        pssnList, elliList = metr.calcPSSNandEllip(wavelengthInUm, 
+                                                   opdFitsFileList=[opdFilePath, opdFilePath], 
+                                                   numWorker=2)
+        self.assertEqual(metr.timer.getReport()["stage"]["OpdMetrology.calcPSSN"]["count"], 2)
+        metr.setTimer(StageTimer())
+        pssn = metr.calcPSSN(wavelengthInUm, opdFitsFile=opdFilePath)
+        elli = metr.calcEllip(wavelengthInUm, opdFitsFile=opdFilePath)
+        self.assertEqual(pssnList.tolist(), [pssn, pssn])
+        self.assertEqual(elliList.tolist(), [elli, elli])
+
+        pssnList, elliList = metr.calcPSSNandEllip(wavelengthInUm, opdMapList=[opdMap, opdMap*0.5])
+        self.assertEqual(pssnList[0], pssn)
+        self.assertEqual(elliList[1], metr.calcEllip(wavelengthInUm, opdMap=opdMap*0.5))
+
         metr.setDefaultLsstGQ()
         valueList = allData[0, 0:31]
         GQvalue = metr.calcGQvalue(valueList)
@@ -0,0 +1,303 @@
+import os, hashlib, pickle, re, shutil, threading, unittest
+import numpy as np
+from astropy.io import fits
+from concurrent.futures import ThreadPoolExecutor
+
+from wepPhoSim.FileTool import writeFileAtomically
+
+class OpdReader(object):
+
+    def __init__(self, cacheDir=None, mmap=True, maxCacheSizeInMb=None):
+        """
+
+        Initiate the OpdReader object. This class reads the optical path difference (OPD) FITS
+        file (e.g. opd_<obsId>_<n>.fits.gz). The FITS file is decompressed only once into the
+        .npy file in the cache directory, and the later reads load the .npy file by memory
+        mapping. The cached file is renewed if the FITS file is newer.
+
+        The cache directory is not cleaned automatically without the size limit. Call
+        clearCache() at the end of each campaign if the cache directory is shared.
+
+        Keyword Arguments:
+            cacheDir {[str]} -- Directory of the decompressed OPD. The FITS file is read every
+                                time if None. (default: {None})
+            mmap {bool} -- Load the cached OPD by memory mapping. The OPD is read-only in this
+                           case. (default: {True})
+            maxCacheSizeInMb {[float]} -- Maximum total size of decompressed OPD files in MB. The
+                                          oldest files are removed when it is exceeded. There is
+                                          no limit if None. (default: {None})
+        """
+
+        self.cacheDir = cacheDir
+        self.mmap = mmap
+        self.maxCacheSizeInMb = maxCacheSizeInMb
+
+        # Number of reads from the cache and FITS file
+        self.numHit = 0
+        self.numMiss = 0
+
+        # Lock to count the reads from several threads
+        self.lock = threading.Lock()
+
+    def getCacheFilePath(self, opdFitsFile):
+        """
+
+        Get the path of decompressed OPD file in the cache directory. The file name contains
+        the hash of absolute path of FITS file, so the files of the same name in different
+        iterations do not collide.
+
+        Arguments:
+            opdFitsFile {[str]} -- OPD FITS file.
+
+        Returns:
+            [str] -- Path of .npy file. None if there is no cache directory.
+        """
+
+        if (self.cacheDir is None):
+            return None
+
+        absPath = os.path.abspath(opdFitsFile)
+        pathHash = hashlib.md5(absPath.encode()).hexdigest()[0:12]
+
+        fileName = os.path.basename(absPath)
+        for ext in (".gz", ".fits"):
+            if fileName.endswith(ext):
+                fileName = fileName[:-len(ext)]
+
+        return os.path.join(self.cacheDir, "%s_%s.npy" % (fileName, pathHash))
+
+    def readOpd(self, opdFitsFile):
+        """
+
+        Read the OPD.
+
+        Arguments:
+            opdFitsFile {[str]} -- OPD FITS file.
+
+        Returns:
+            [ndarray] -- OPD map in the native byte order. It is read-only if it is loaded by
+                         memory mapping.
+        """
+
+        cacheFilePath = self.getCacheFilePath(opdFitsFile)
+
+        if (cacheFilePath is not None) and (os.path.isfile(cacheFilePath)) and \
+           (os.path.getmtime(cacheFilePath) >= os.path.getmtime(opdFitsFile)):
+            with self.lock:
+                self.numHit += 1
+            if (self.mmap):
+                return np.load(cacheFilePath, mmap_mode="r")
+            else:
+                return np.load(cacheFilePath)
+
+        with self.lock:
+            self.numMiss += 1
+
+        # FITS data is in the big-endian byte order
+        opd = fits.getdata(opdFitsFile)
+        opd = opd.astype(opd.dtype.newbyteorder("="))
+
+        if (cacheFilePath is not None):
+            writeFileAtomically(cacheFilePath, lambda outFile: np.save(outFile, opd))
+            if (self.maxCacheSizeInMb is not None):
+                self.__limitCacheSize(keepFilePath=cacheFilePath)
+
+        return opd
+
+    def readOpdStack(self, opdFitsFileList, numThread=1):
+        """
+
+        Read the OPD of field points into one array.
+
+        Arguments:
+            opdFitsFileList {[list]} -- OPD FITS files in the order of field points.
+
+        Keyword Arguments:
+            numThread {int} -- Number of threads to read the files. (default: {1})
+
+        Returns:
+            [ndarray] -- OPD maps in the shape of (nField, N, N).
+        """
+
+        if (numThread <= 1) or (len(opdFitsFileList) <= 1):
+            opdList = [self.readOpd(opdFitsFile) for opdFitsFile in opdFitsFileList]
+        else:
+            with ThreadPoolExecutor(max_workers=numThread) as executor:
+                opdList = list(executor.map(self.readOpd, opdFitsFileList))
+
+        return np.stack(opdList)
+
+    def clearCache(self):
+        """
+
+        Remove the decompressed OPD files in the cache directory. Other files in the directory
+        are kept.
+        """
+
+        for filePath in self.__getCacheFileList():
+            os.remove(filePath)
+
+    def __getstate__(self):
+        """
+
+        Get the state to pickle. The lock is not pickled, so the object can be sent to the
+        worker processes.
+
+        Returns:
+            [dict] -- State to pickle.
+        """
+
+        state = self.__dict__.copy()
+        state["lock"] = None
+
+        return state
+
+    def __setstate__(self, state):
+        """
+
+        Set the state from pickle.
+
+        Arguments:
+            state {[dict]} -- Pickled state.
+        """
+
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __getCacheFileList(self):
+        """
+
+        Get the decompressed OPD files in the cache directory.
+
+        Returns:
+            [list] -- File paths.
+        """
+
+        if (self.cacheDir is None) or (not os.path.isdir(self.cacheDir)):
+            return []
+
+        # The file name is <FITS file name>_<hash of FITS file path>.npy
+        return [os.path.join(self.cacheDir, fileName) for fileName in os.listdir(self.cacheDir)
+                if re.match(r"^.+_[0-9a-f]{12}\.npy$", fileName)]
+
+    def __limitCacheSize(self, keepFilePath=None):
+        """
+
+        Remove the oldest decompressed OPD files until the total size is in the limit.
+
+        Keyword Arguments:
+            keepFilePath {[str]} -- File not to remove. (default: {None})
+        """
+
+        # (modification time, size, file path)
+        fileInfoList = []
+        for filePath in self.__getCacheFileList():
+            try:
+                fileStat = os.stat(filePath)
+            except FileNotFoundError:
+                continue
+            fileInfoList.append((fileStat.st_mtime_ns, fileStat.st_size, filePath))
+
+        totalSize = sum([fileInfo[1] for fileInfo in fileInfoList])
+        maxSize = self.maxCacheSizeInMb*1024**2
+        for mtime, size, filePath in sorted(fileInfoList):
+            if (totalSize <= maxSize):
+                break
+
+            if (filePath == keepFilePath):
+                continue
+
+            try:
+                os.remove(filePath)
+            except FileNotFoundError:
+                pass
+            totalSize -= size
+
+class OpdReaderTest(unittest.TestCase):
+
+    """
+    Test functions in OpdReader.
+    """
+
+    def setUp(self):
+
+        self.opdFitsFile = os.path.join("..", "testData", "testOpdFunc", "sim6_iter0_opd0.fits.gz")
+
+        # Set the output dir
+        self.outputDir = os.path.join("..", "output", "tempOpdReader")
+        os.makedirs(self.outputDir)
+
+    def tearDown(self):
+
+        shutil.rmtree(self.outputDir)
+
+    def testFunc(self):
+
+        ansOpd = fits.getdata(self.opdFitsFile)
+
+        opdReader = OpdReader()
+        self.assertEqual(opdReader.getCacheFilePath(self.opdFitsFile), None)
+        opd = opdReader.readOpd(self.opdFitsFile)
+        self.assertTrue(np.array_equal(opd, ansOpd))
+        self.assertTrue(opd.dtype.isnative)
+
+        cacheDir = os.path.join(self.outputDir, "cache")
+        opdReader = OpdReader(cacheDir=cacheDir)
+        cacheFilePath = opdReader.getCacheFilePath(self.opdFitsFile)
+        self.assertTrue(os.path.basename(cacheFilePath).startswith("sim6_iter0_opd0_"))
+
+        opd = opdReader.readOpd(self.opdFitsFile)
+        self.assertTrue(os.path.isfile(cacheFilePath))
+        self.assertEqual((opdReader.numHit, opdReader.numMiss), (0, 1))
+
+        opd = opdReader.readOpd(self.opdFitsFile)
+        self.assertEqual((opdReader.numHit, opdReader.numMiss), (1, 1))
+        self.assertTrue(isinstance(opd, np.memmap))
+        self.assertFalse(opd.flags.writeable)
+        self.assertTrue(np.array_equal(opd, ansOpd))
+
+        # The FITS file of the same name in another directory does not use the cache
+        newOpdFitsFile = os.path.join(self.outputDir, os.path.basename(self.opdFitsFile))
+        shutil.copyfile(self.opdFitsFile, newOpdFitsFile)
+        self.assertNotEqual(opdReader.getCacheFilePath(newOpdFitsFile), cacheFilePath)
+
+        opdStack = opdReader.readOpdStack([self.opdFitsFile, newOpdFitsFile], numThread=2)
+        self.assertEqual(opdStack.shape, (2,) + ansOpd.shape)
+        self.assertTrue(np.array_equal(opdStack[1], ansOpd))
+        self.assertEqual((opdReader.numHit, opdReader.numMiss), (2, 2))
+
+        # The cache is renewed if the FITS file is newer
+        newTime = os.path.getmtime(opdReader.getCacheFilePath(newOpdFitsFile)) + 10
+        os.utime(newOpdFitsFile, (newTime, newTime))
+        opdReader.readOpd(newOpdFitsFile)
+        self.assertEqual((opdReader.numHit, opdReader.numMiss), (2, 3))
+
+        # Only the decompressed OPD files are removed
+        otherFilePath = os.path.join(cacheDir, "other.npy")
+        np.save(otherFilePath, ansOpd)
+        opdReader.clearCache()
+        self.assertEqual(os.listdir(cacheDir), ["other.npy"])
+
+        # The oldest file is removed when the cache size is over the limit
+        fileSizeInMb = os.path.getsize(otherFilePath)/1024**2
+        opdReader = OpdReader(cacheDir=cacheDir, maxCacheSizeInMb=2.5*fileSizeInMb)
+        opdReader.readOpd(self.opdFitsFile)
+        opdReader.readOpd(newOpdFitsFile)
+        self.assertTrue(os.path.isfile(cacheFilePath))
+        os.utime(cacheFilePath, (0, 0))
+        anotherOpdFitsFile = os.path.join(self.outputDir, "another.fits.gz")
+        shutil.copyfile(self.opdFitsFile, anotherOpdFitsFile)
+        opdReader.readOpd(anotherOpdFitsFile)
+        self.assertFalse(os.path.isfile(cacheFilePath))
+        self.assertTrue(os.path.isfile(opdReader.getCacheFilePath(anotherOpdFitsFile)))
+        self.assertTrue(os.path.isfile(otherFilePath))
+
+        # The reader can be sent to the worker processes
+        newOpdReader = pickle.loads(pickle.dumps(opdReader))
+        self.assertEqual(newOpdReader.numMiss, opdReader.numMiss)
+        self.assertTrue(np.array_equal(newOpdReader.readOpd(anotherOpdFitsFile), ansOpd))
+
+if __name__ == "__main__":
+
+    # Do the unit test
+    unittest.main()
@@ -0,0 +1,422 @@
+import os, queue, shutil, unittest
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from wepPhoSim.PhosimCommu import PhosimCommu
+
+class PhoSimScheduler(object):
+
+    def __init__(self, phoSimCommu, numWorker=None):
+        """
+
+        Initiate the PhoSimScheduler object. This class splits one PhoSim run into several
+        PhoSim jobs and runs them in parallel.
+
+        Arguments:
+            phoSimCommu {[PhosimCommu]} -- PhosimCommu object.
+
+        Keyword Arguments:
+            numWorker {[int]} -- Number of PhoSim jobs run at the same time. Use the number of
+                                 CPU if None. (default: {None})
+        """
+
+        self.phoSimCommu = phoSimCommu
+
+        if (numWorker is None):
+            numWorker = os.cpu_count()
+        self.numWorker = int(numWorker)
+
+    def setNumWorker(self, numWorker):
+        """
+
+        Set the number of PhoSim jobs run at the same time.
+
+        Arguments:
+            numWorker {[int]} -- Number of workers.
+
+        Raises:
+            ValueError -- Number of workers < 1.
+        """
+
+        if (int(numWorker) < 1):
+            raise ValueError("The number of workers should be >= 1.")
+
+        self.numWorker = int(numWorker)
+
+    def splitSensors(self, sensorNameList, numShard):
+        """
+
+        Split the sensors into shards. The order of sensors is kept and the empty shard is
+        removed.
+
+        Arguments:
+            sensorNameList {[list]} -- List of sensor name (e.g. ["R22_S11", "R22_S12"]).
+            numShard {[int]} -- Number of shards.
+
+        Returns:
+            [list] -- List of shards. Each shard is a list of sensor name.
+
+        Raises:
+            ValueError -- Number of shards < 1.
+        """
+
+        if (int(numShard) < 1):
+            raise ValueError("The number of shards should be >= 1.")
+
+        shardList = []
+        for shard in np.array_split(np.arange(len(sensorNameList)), int(numShard)):
+            if (len(shard) > 0):
+                shardList.append([sensorNameList[ii] for ii in shard])
+
+        return shardList
+
+    def getShardSensorName(self, shard):
+        """
+
+        Get the sensor chip specification of shard used in PhoSim argument list.
+
+        Arguments:
+            shard {[list]} -- List of sensor name.
+
+        Returns:
+            [str] -- Sensor chip specification (e.g., R22_S11, R22_S11|R22_S12).
+        """
+
+        return "|".join(shard)
+
+    def getCpuSlots(self, numCpuPerJob, cpuList=None):
+        """
+
+        Divide the CPUs into slots. Each running PhoSim job occupies one slot, so that the
+        concurrent jobs do not compete for the same CPUs.
+
+        Arguments:
+            numCpuPerJob {[int]} -- Number of CPUs for each job.
+
+        Keyword Arguments:
+            cpuList {[list]} -- CPU indexes to use. Use the CPUs available to current process
+                                if None. (default: {None})
+
+        Returns:
+            [list] -- List of CPU slots. Each slot is a list of CPU index.
+
+        Raises:
+            ValueError -- Not enough CPUs for one job.
+        """
+
+        if (cpuList is None):
+            cpuList = sorted(os.sched_getaffinity(0))
+
+        numSlot = len(cpuList)//int(numCpuPerJob)
+        if (numSlot < 1):
+            raise ValueError("Only %d CPUs for %d CPUs per job." % (len(cpuList), numCpuPerJob))
+
+        cpuSlotList = [list(cpuList[ii*numCpuPerJob:(ii+1)*numCpuPerJob]) for ii in range(numSlot)]
+
+        return cpuSlotList
+
+    def runJobs(self, argStringList):
+        """
+
+        Run the PhoSim jobs in parallel by the argument strings.
+
+        Arguments:
+            argStringList {[list]} -- List of arguments to run the PhoSim.
+
+        Raises:
+            RuntimeError -- Some PhoSim jobs failed.
+        """
+
+        futureList = self.__submitJobs(self.phoSimCommu.runPhoSim,
+                                       [dict(argstring=argString) for argString in argStringList])
+        self.__checkJobs(futureList)
+
+    def runArgListJobs(self, argListList, logFilePathList=None, env=None, numCpuPerJob=None,
+                       niceness=None):
+        """
+
+        Run the PhoSim jobs in parallel by the argument lists without the shell.
+
+        Arguments:
+            argListList {[list]} -- List of argument list to run the PhoSim.
+
+        Keyword Arguments:
+            logFilePathList {[list]} -- List of log file path. (default: {None})
+            env {[dict]} -- Environment variables. (default: {None})
+            numCpuPerJob {[int]} -- Number of CPUs each job is bound to. The job is not bound
+                                    to any CPU if None. (default: {None})
+            niceness {[int]} -- Increment of the niceness of jobs. (default: {None})
+
+        Raises:
+            RuntimeError -- Some PhoSim jobs failed.
+        """
+
+        if (logFilePathList is None):
+            logFilePathList = [None]*len(argListList)
+
+        # Each running job takes one CPU slot and gives it back when done
+        slotQueue = None
+        if (numCpuPerJob is not None):
+            slotQueue = queue.Queue()
+            for cpuSlot in self.getCpuSlots(numCpuPerJob):
+                slotQueue.put(cpuSlot)
+
+        def runJob(argList, logFilePath):
+
+            cpuSlot = None
+            if (slotQueue is not None):
+                cpuSlot = slotQueue.get()
+
+            try:
+                self.phoSimCommu.runPhoSimByArgList(argList, env=env, logFilePath=logFilePath,
+                                                    cpuList=cpuSlot, niceness=niceness)
+            finally:
+                if (slotQueue is not None):
+                    slotQueue.put(cpuSlot)
+
+        kwargsList = [dict(argList=argList, logFilePath=logFilePath)
+                      for argList, logFilePath in zip(argListList, logFilePathList)]
+        futureList = self.__submitJobs(runJob, kwargsList)
+        self.__checkJobs(futureList)
+
+    def __submitJobs(self, func, kwargsList):
+        """
+
+        Submit the jobs to the thread pool and wait for all jobs to finish.
+
+        Arguments:
+            func {[function]} -- Function to run the job.
+            kwargsList {[list]} -- List of keyword arguments of each job.
+
+        Returns:
+            [list] -- List of finished futures.
+        """
+
+        numWorker = max(min(self.numWorker, len(kwargsList)), 1)
+        with ThreadPoolExecutor(max_workers=numWorker) as executor:
+            futureList = [executor.submit(func, **kwargs) for kwargs in kwargsList]
+
+        return futureList
+
+    def __checkJobs(self, futureList):
+        """
+
+        Check the finished jobs.
+
+        Arguments:
+            futureList {[list]} -- List of finished futures.
+
+        Raises:
+            RuntimeError -- Some PhoSim jobs failed.
+        """
+
+        # Collect the failed jobs after all jobs are done
+        errMsgList = []
+        for future in futureList:
+            error = future.exception()
+            if (error is not None):
+                errMsgList.append(str(error))
+
+        if (len(errMsgList) > 0):
+            raise RuntimeError("%d PhoSim job(s) failed:\n%s" % (len(errMsgList), "\n".join(errMsgList)))
+
+    def runSensorShards(self, instFilePath, sensorNameList, outputDir, numShard=None, cmdFilePath=None,
+                        numProc=1, numThread=1, instrument="lsst", e2ADC=1, logFilePath=None,
+                        keepWorkDir=False, numCpuPerJob=None, niceness=None):
+        """
+
+        Split the sensors into shards, run one PhoSim job for each shard in parallel with its own
+        work directory, and merge the outputs into the output directory.
+
+        Arguments:
+            instFilePath {[str]} -- Instance catalog file path.
+            sensorNameList {[list]} -- List of sensor name (e.g. ["R22_S11", "R22_S12"]).
+            outputDir {[str]} -- Output image directory.
+
+        Keyword Arguments:
+            numShard {[int]} -- Number of shards. Use the number of workers if None.
+                                (default: {None})
+            cmdFilePath {[str]} -- Command file to modify the default physics. (default: {None})
+            numProc {int} -- Number of processors for each PhoSim job. (default: {1})
+            numThread {int} -- Number of threads for each PhoSim job. (default: {1})
+            instrument {str} -- Instrument site directory. (default: {"lsst"})
+            e2ADC {int} -- Whether to generate amplifier images (1 = true, 0 = false). (default: {1})
+            logFilePath {[str]} -- Log file path for PhoSim calculation log. The shard index is
+                                   added to the file name. (default: {None})
+            keepWorkDir {bool} -- Keep the work directories of shards or not. (default: {False})
+            numCpuPerJob {[int]} -- Number of CPUs each shard is bound to. (default: {None})
+            niceness {[int]} -- Increment of the niceness of shards. (default: {None})
+
+        Returns:
+            [list] -- Merged output file paths.
+        """
+
+        if (numShard is None):
+            numShard = self.numWorker
+        shardList = self.splitSensors(sensorNameList, numShard)
+
+        # Prepare the arguments of each shard
+        argListList = []
+        logFilePathList = []
+        shardOutputDirList = []
+        shardWorkDirList = []
+        for ii, shard in enumerate(shardList):
+
+            shardOutputDir = os.path.join(outputDir, "shard%d" % ii)
+            shardWorkDir = os.path.join(outputDir, "shardWork%d" % ii)
+            for aDir in (shardOutputDir, shardWorkDir):
+                os.makedirs(aDir, exist_ok=True)
+
+            shardLogFilePath = None
+            if (logFilePath is not None):
+                fileName, fileExt = os.path.splitext(logFilePath)
+                shardLogFilePath = "%s_shard%d%s" % (fileName, ii, fileExt)
+
+            argList = self.phoSimCommu.getPhoSimArgList(instFilePath, extraCommand=cmdFilePath,
+                                numProc=numProc, numThread=numThread, outputDir=shardOutputDir,
+                                instrument=instrument, sensorName=self.getShardSensorName(shard),
+                                e2ADC=e2ADC, workDir=shardWorkDir)
+
+            argListList.append(argList)
+            logFilePathList.append(shardLogFilePath)
+            shardOutputDirList.append(shardOutputDir)
+            shardWorkDirList.append(shardWorkDir)
+
+        # Run the shards
+        self.runArgListJobs(argListList, logFilePathList=logFilePathList,
+                            numCpuPerJob=numCpuPerJob, niceness=niceness)
+
+        # Merge the outputs
+        outputFileList = self.mergeOutputs(shardOutputDirList, outputDir)
+
+        # Remove the work directories
+        if (not keepWorkDir):
+            for shardWorkDir in shardWorkDirList:
+                shutil.rmtree(shardWorkDir)
+
+        return outputFileList
+
+    def mergeOutputs(self, shardOutputDirList, outputDir, rmShardDir=True):
+        """
+
+        Merge the outputs of shards into the output directory.
+
+        Arguments:
+            shardOutputDirList {[list]} -- List of output directory of shard.
+            outputDir {[str]} -- Output directory to merge into.
+
+        Keyword Arguments:
+            rmShardDir {bool} -- Remove the output directory of shard after the merge.
+                                 (default: {True})
+
+        Returns:
+            [list] -- Merged output file paths.
+
+        Raises:
+            RuntimeError -- The output file exists already.
+        """
+
+        # Check the file name conflict before moving any file
+        srcFileList = []
+        dstFileList = []
+        for shardOutputDir in shardOutputDirList:
+            for fileName in sorted(os.listdir(shardOutputDir)):
+                dstFilePath = os.path.join(outputDir, fileName)
+                if os.path.exists(dstFilePath) or (dstFilePath in dstFileList):
+                    raise RuntimeError("The output file exists already: %s." % dstFilePath)
+
+                srcFileList.append(os.path.join(shardOutputDir, fileName))
+                dstFileList.append(dstFilePath)
+
+        # Move the files
+        os.makedirs(outputDir, exist_ok=True)
+        for srcFilePath, dstFilePath in zip(srcFileList, dstFileList):
+            shutil.move(srcFilePath, dstFilePath)
+
+        if (rmShardDir):
+            for shardOutputDir in shardOutputDirList:
+                shutil.rmtree(shardOutputDir)
+
+        return dstFileList
+
+class PhoSimSchedulerTest(unittest.TestCase):
+
+    """
+    Test functions in PhoSimScheduler.
+    """
+
+    def setUp(self):
+
+        # Set the output dir
+        self.outputDir = os.path.join("..", "output", "tempScheduler")
+        os.makedirs(self.outputDir)
+
+        # Fake PhoSim that writes one file for each sensor
+        self.phosimDir = os.path.join(self.outputDir, "phosim")
+        os.makedirs(self.phosimDir)
+
+        content = "import os, sys\n"
+        content += "args = sys.argv[1:]\n"
+        content += "outputDir = args[args.index(\"-o\") + 1]\n"
+        content += "workDir = args[args.index(\"-w\") + 1]\n"
+        content += "assert os.path.isdir(workDir)\n"
+        content += "for sensor in args[args.index(\"-s\") + 1].split(\"|\"):\n"
+        content += "    open(os.path.join(outputDir, \"lsst_e_%s.fits\" % sensor), \"w\").close()\n"
+
+        fid = open(os.path.join(self.phosimDir, "phosim.py"), "w")
+        fid.write(content)
+        fid.close()
+
+        self.instFilePath = os.path.join(self.outputDir, "temp.inst")
+        open(self.instFilePath, "w").close()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.outputDir)
+
+    def testFunc(self):
+
+        phoSimCommu = PhosimCommu(phosimDir=self.phosimDir)
+        scheduler = PhoSimScheduler(phoSimCommu, numWorker=2)
+        self.assertEqual(scheduler.numWorker, 2)
+
+        self.assertRaises(ValueError, scheduler.setNumWorker, 0)
+        scheduler.setNumWorker(3)
+        self.assertEqual(scheduler.numWorker, 3)
+
+        sensorNameList = ["R22_S11", "R22_S12", "R22_S10", "R22_S21", "R22_S01"]
+        shardList = scheduler.splitSensors(sensorNameList, 2)
+        self.assertEqual(shardList, [["R22_S11", "R22_S12", "R22_S10"], ["R22_S21", "R22_S01"]])
+        self.assertEqual(len(scheduler.splitSensors(sensorNameList[0:2], 3)), 2)
+
+        self.assertEqual(scheduler.getShardSensorName(["R22_S11"]), "R22_S11")
+        self.assertEqual(scheduler.getShardSensorName(shardList[1]), "R22_S21|R22_S01")
+
+        cpuSlotList = scheduler.getCpuSlots(2, cpuList=[0, 1, 2, 3, 4])
+        self.assertEqual(cpuSlotList, [[0, 1], [2, 3]])
+        self.assertRaises(ValueError, scheduler.getCpuSlots, 2, cpuList=[0])
+
+        logFilePath = os.path.join(self.outputDir, "phosim.log")
+        outputFileList = scheduler.runSensorShards(self.instFilePath, sensorNameList, self.outputDir,
+                                                   numShard=3, logFilePath=logFilePath,
+                                                   numCpuPerJob=1, niceness=1)
+        self.assertTrue(os.path.isfile(os.path.join(self.outputDir, "phosim_shard2.log")))
+        self.assertEqual(len(outputFileList), len(sensorNameList))
+        self.assertFalse(os.path.join(self.outputDir, "phosim_shard0.log") in outputFileList)
+        for sensor in sensorNameList:
+            outputFilePath = os.path.join(self.outputDir, "lsst_e_%s.fits" % sensor)
+            self.assertTrue(os.path.isfile(outputFilePath))
+
+        self.assertFalse(os.path.exists(os.path.join(self.outputDir, "shard0")))
+        self.assertFalse(os.path.exists(os.path.join(self.outputDir, "shardWork0")))
+
+        self.assertRaises(RuntimeError, scheduler.runSensorShards, self.instFilePath,
+                          sensorNameList[0:1], self.outputDir, numShard=1)
+
+        scheduler.phoSimCommu.setPhoSimDir(self.outputDir)
+        self.assertRaises(RuntimeError, scheduler.runJobs, ["-v"])
+
+if __name__ == "__main__":
+
+    # Do the unit test
+    unittest.main()
@@ -1,6 +1,8 @@
-import os, subprocess, unittest
+import os, queue, re, shutil, signal, subprocess, threading, time, unittest
 import numpy as np
 
+from wepPhoSim.StageTimer import StageTimer
+
 class PhosimCommu(object):
 
     def __init__(self, phosimDir=None):
@@ -14,6 +16,9 @@ class PhosimCommu(object):
         
         self.phosimDir = phosimDir
 
+        # Timer of stages
+        self.timer = StageTimer()
+
     def setPhoSimDir(self, phosimDir):
         """
         
@@ -25,6 +30,17 @@ class PhosimCommu(object):
 
         self.phosimDir = phosimDir
 
+    def setTimer(self, timer):
+        """
+        
+        Set the timer to record the time of stages.
+        
+        Arguments:
+            timer {[StageTimer]} -- StageTimer object.
+        """
+
+        self.timer = timer
+
     def getFilterId(self, aFilter):
         """
         
@@ -275,6 +291,58 @@ class PhosimCommu(object):
 
         return content
 
+    def writeStarCatalog(self, filePath, starId, ra, dec, magNorm, sedName, chunkSize=100000, mode="a"):
+        """
+        
+        Write the star sources into the instance catalog file. The lines are the same as 
+        generateStar() with the default keyword arguments, but the columns are formatted in bulk 
+        and written in chunks to support the catalog of large number of stars.
+        
+        Arguments:
+            filePath {[str]} -- File path to write.
+            starId {[list/ ndarray]} -- Star ID.
+            ra {[list/ ndarray]} -- The right ascension of the center of the object in decimal degrees.
+            dec {[list/ ndarray]} -- The declination of the center of the object in decimal degrees.
+            magNorm {[list/ ndarray]} -- The normalization of the flux of the object in AB magnitudes.
+            sedName {[str]} -- The name of the SED file with a file path that is relative to the 
+                               data directory in PhoSim.
+        
+        Keyword Arguments:
+            chunkSize {int} -- Number of stars formatted and written at a time. (default: {100000})
+            mode {[str]} -- Overwrite ("w") or append ("a") the file. (default: {"a"})
+        
+        Returns:
+            [int] -- Number of written stars.
+        
+        Raises:
+            ValueError -- Lengths of star columns are different.
+        """
+
+        if mode not in ("w", "a"):
+            raise ValueError("Mode: %s is not supported." % mode)
+
+        # Check the lengths of columns
+        numStar = len(starId)
+        if (len(ra) != numStar) or (len(dec) != numStar) or (len(magNorm) != numStar):
+            raise ValueError("Lengths of star ID, ra, dec, and magNorm should be the same.")
+
+        # Line format. The constant part follows generateStar().
+        tail = " ../sky/%s 0.0 0.0 0.0 0.0 0.0 0.0 star 0.0 none none \n" % sedName
+        lineFormat = "object %2d\t%9.6f\t%9.6f %9.6f" + tail.replace("%", "%%")
+
+        with self.timer.stage("PhosimCommu.writeStarCatalog"):
+            fid = open(filePath, mode)
+            for start in range(0, numStar, int(chunkSize)):
+                end = start + int(chunkSize)
+
+                # Python scalars are much faster to format than numpy scalars
+                columns = [np.asarray(column[start:end]).tolist() for column in (starId, ra, dec, magNorm)]
+                fid.write("".join(map(lineFormat.__mod__, zip(*columns))))
+
+            fid.close()
+
+        return numStar
+
     def getStarInstance(self, obsId, aFilterId, ra=0, dec=0, rot=0, mjd=49552.3, simSeed=1000, filePath=None):
         """
         
@@ -360,10 +428,11 @@ class PhosimCommu(object):
         command = " ".join(["python", phosimRunPath])
 
         # Run the PhoSim with the related arguments
-        self.__runProgram(command, argstring=argstring)
+        with self.timer.stage("PhosimCommu.runPhoSim"):
+            self.__runProgram(command, argstring=argstring)
 
     def getPhoSimArgs(self, instance, extraCommand=None, numProc=1, numThread=1, outputDir=None, 
-                      instrument="lsst", sensorName=None, e2ADC=1, logFilePath=None):
+                      instrument="lsst", sensorName=None, e2ADC=1, logFilePath=None, workDir=None):
         """
         
         Get the arguments needed to run the PhoSim.
@@ -381,6 +450,8 @@ class PhosimCommu(object):
                                 (default: {None})
             e2ADC {int} -- Whether to generate amplifier images (1 = true, 0 = false). (default: {1})
             logFilePath {[str]} -- Log file path for PhoSim calculation log. (default: {None})
+            workDir {[str]} -- Work directory of PhoSim. Use the separated work directory for the 
+                               parallel PhoSim runs. (default: {None})
         
         Returns:
             [str] -- Arguments to run the PhoSim.
@@ -398,6 +469,9 @@ class PhosimCommu(object):
         if (logFilePath is not None):
             logFilePath = os.path.abspath(logFilePath)
 
+        if (workDir is not None):
+            workDir = os.path.abspath(workDir)
+
         # Prepare the argument list
         argString = "%s -i %s -e %d" % (instance, instrument, e2ADC)
 
@@ -416,11 +490,392 @@ class PhosimCommu(object):
         if (outputDir is not None):
             argString += " -o %s" % outputDir
 
+        if (workDir is not None):
+            argString += " -w %s" % workDir
+
         if (logFilePath is not None):
             argString += " > %s 2>&1" % logFilePath
 
         return argString
 
+    def getPhoSimArgList(self, instance, extraCommand=None, numProc=1, numThread=1, outputDir=None, 
+                         instrument="lsst", sensorName=None, e2ADC=1, workDir=None):
+        """
+        
+        Get the argument list needed to run the PhoSim directly without the shell.
+        
+        Arguments:
+            instance {[str]} -- Instance catalog file.
+        
+        Keyword Arguments:
+            extraCommand {[str]} -- Command file to modify the default physics. (default: {None})
+            numProc {int} -- Number of processors. (default: {1})
+            numThread {int} -- Number of threads. (default: {1})
+            outputDir {[str]} -- Output image directory. (default: {None})
+            instrument {str} -- Instrument site directory. (default: {"lsst"})
+            sensorName {str} -- Sensor chip specification (e.g., all, R22_S11, R22_S11|R22_S12). 
+                                No quotation is needed. (default: {None})
+            e2ADC {int} -- Whether to generate amplifier images (1 = true, 0 = false). (default: {1})
+            workDir {[str]} -- Work directory of PhoSim. (default: {None})
+        
+        Returns:
+            [list] -- Argument list to run the PhoSim.
+        """
+
+        # Prepare the argument list
+        argList = [os.path.abspath(instance), "-i", instrument, "-e", "%d" % e2ADC]
+
+        if (extraCommand is not None):
+            argList += ["-c", os.path.abspath(extraCommand)]
+
+        if (numProc > 1):
+            argList += ["-p", "%d" % numProc]
+
+        if (numThread > 1):
+            argList += ["-t", "%d" % numThread]
+
+        if (sensorName is not None):
+            # The quotation used in the shell is not needed here
+            argList += ["-s", sensorName.strip("\"'")]
+
+        if (outputDir is not None):
+            argList += ["-o", os.path.abspath(outputDir)]
+
+        if (workDir is not None):
+            argList += ["-w", os.path.abspath(workDir)]
+
+        return argList
+
+    def getPhoSimEnv(self, envVar=None, numThreadInLib=None):
+        """
+        
+        Get the environment variables to run the PhoSim.
+        
+        Keyword Arguments:
+            envVar {[dict]} -- Environment variables to add or overwrite. (default: {None})
+            numThreadInLib {[int]} -- Number of threads used in the numerical libraries (OpenMP, 
+                                      BLAS). Keep the current setting if None. (default: {None})
+        
+        Returns:
+            [dict] -- Environment variables.
+        """
+
+        env = dict(os.environ)
+
+        if (numThreadInLib is not None):
+            for varName in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+                env[varName] = "%d" % numThreadInLib
+
+        if (envVar is not None):
+            env.update(envVar)
+
+        return env
+
+    def startPhoSim(self, argList, cwd=None, env=None, logFilePath=None, cpuList=None, niceness=None, 
+                    streamOutput=False):
+        """
+        
+        Start the PhoSim program directly without the shell. This function does not wait the 
+        PhoSim to finish.
+        
+        Arguments:
+            argList {[list]} -- Argument list for PhoSim.
+        
+        Keyword Arguments:
+            cwd {[str]} -- Working directory of the process. (default: {None})
+            env {[dict]} -- Environment variables. Use the current environment if None. 
+                            (default: {None})
+            logFilePath {[str]} -- Log file path for PhoSim calculation log. The stdout and stderr 
+                                   are discarded if None. (default: {None})
+            cpuList {[list]} -- CPU indexes the process (and its child processes) is bound to. 
+                                (default: {None})
+            niceness {[int]} -- Increment of the niceness of process. (default: {None})
+            streamOutput {bool} -- Pipe the stdout and stderr to the caller instead of the log file. 
+                                   The process is started in a new session, so that the whole 
+                                   process group can be killed. The output of PhoSim binaries 
+                                   (e.g. raytrace and e2adc) is line buffered by stdbuf if it 
+                                   is available. Otherwise, it is block buffered and arrives in 
+                                   bursts. (default: {False})
+        
+        Returns:
+            [subprocess.Popen] -- PhoSim process.
+        """
+
+        # Path of phosim.py script 
+        phosimRunPath = os.path.join(self.phosimDir, "phosim.py")
+        command = ["python", phosimRunPath] + [str(arg) for arg in argList]
+
+        # Pipe the output line by line
+        if (streamOutput):
+            if (env is None):
+                env = dict(os.environ)
+            env = dict(env, PYTHONUNBUFFERED="1")
+
+            # The environment variables of stdbuf are inherited by the child binaries of 
+            # phosim.py, so their output is line buffered on the pipe as well
+            if (shutil.which("stdbuf") is not None):
+                command = ["stdbuf", "-oL", "-eL"] + command
+
+            process = subprocess.Popen(command, cwd=cwd, env=env, stdout=subprocess.PIPE, 
+                                       stderr=subprocess.STDOUT, start_new_session=True, 
+                                       universal_newlines=True, bufsize=1)
+
+            self.__setProcessPriority(process, cpuList=cpuList, niceness=niceness)
+
+            return process
+
+        # Redirect the stdout and stderr to the log file
+        if (logFilePath is not None):
+            logFile = open(logFilePath, "w")
+        else:
+            logFile = open(os.devnull, "w")
+
+        try:
+            process = subprocess.Popen(command, cwd=cwd, env=env, stdout=logFile, 
+                                       stderr=subprocess.STDOUT)
+        finally:
+            # The child process holds its own file handle
+            logFile.close()
+
+        self.__setProcessPriority(process, cpuList=cpuList, niceness=niceness)
+
+        return process
+
+    def runPhoSimByArgList(self, argList, cwd=None, env=None, logFilePath=None, cpuList=None, 
+                           niceness=None):
+        """
+        
+        Run the PhoSim program directly without the shell.
+        
+        Arguments:
+            argList {[list]} -- Argument list for PhoSim.
+        
+        Keyword Arguments:
+            cwd {[str]} -- Working directory of the process. (default: {None})
+            env {[dict]} -- Environment variables. Use the current environment if None. 
+                            (default: {None})
+            logFilePath {[str]} -- Log file path for PhoSim calculation log. (default: {None})
+            cpuList {[list]} -- CPU indexes the process is bound to. (default: {None})
+            niceness {[int]} -- Increment of the niceness of process. (default: {None})
+        
+        Raises:
+            RuntimeError -- There is the error in running the PhoSim.
+        """
+
+        with self.timer.stage("PhosimCommu.runPhoSim"):
+            process = self.startPhoSim(argList, cwd=cwd, env=env, logFilePath=logFilePath, 
+                                       cpuList=cpuList, niceness=niceness)
+
+            returnCode = process.wait()
+
+        if (returnCode != 0):
+            raise RuntimeError("Error running: %s" % " ".join(process.args))
+
+    def parsePhoSimLogLine(self, line):
+        """
+        
+        Parse the line of PhoSim log into the progress event.
+        
+        Arguments:
+            line {[str]} -- Line of PhoSim log.
+        
+        Returns:
+            [dict] -- Progress event with the keys of "time" (epoch time in second), "stage", 
+                      "chip", and "line". None if the line is not a stage marker.
+        """
+
+        # Stage markers in PhoSim log. The order matters: the first matched stage is used.
+        # The output image file name (e.g. lsst_e_9006000_f1_R22_S11_E000.fits.gz) means 
+        # the chip is done.
+        stageMarker = [("chipDone", r"\b[a-z]+_[ae]_\d+_f\d_(R\d\d_S\d\d(?:_C\d)?)_E\d+\.fits"),
+                       ("e2adc", r"e2adc"),
+                       ("raytrace", r"raytrace"),
+                       ("trim", r"\btrim"),
+                       ("atmosphere", r"atmosphere"),
+                       ("instrument", r"instrument")]
+
+        event = None
+        for stage, pattern in stageMarker:
+            m = re.search(pattern, line, flags=re.IGNORECASE)
+            if (m is not None):
+                chip = m.groups()[0] if (stage == "chipDone") else None
+                event = {"time": time.time(), "stage": stage, "chip": chip, "line": line.rstrip()}
+                break
+
+        return event
+
+    def iterPhoSimProgress(self, argList, cwd=None, env=None, logFilePath=None, cpuList=None, 
+                           niceness=None, stallTimeInSec=None):
+        """
+        
+        Run the PhoSim program and iterate the progress events parsed from the live log. The 
+        last event has the stage of "done". The PhoSim is killed if the iteration is stopped 
+        early by the caller.
+        
+        Arguments:
+            argList {[list]} -- Argument list for PhoSim.
+        
+        Keyword Arguments:
+            cwd {[str]} -- Working directory of the process. (default: {None})
+            env {[dict]} -- Environment variables. (default: {None})
+            logFilePath {[str]} -- Log file path to keep the PhoSim log. (default: {None})
+            cpuList {[list]} -- CPU indexes the process is bound to. (default: {None})
+            niceness {[int]} -- Increment of the niceness of process. (default: {None})
+            stallTimeInSec {[float]} -- Kill the PhoSim if there is no log output in this time. 
+                                        Without stdbuf, the output of PhoSim binaries is block 
+                                        buffered and the stall detection is coarse, so this 
+                                        should be longer than the longest raytrace. 
+                                        (default: {None})
+        
+        Yields:
+            [dict] -- Progress event. Check parsePhoSimLogLine() for the details.
+        
+        Raises:
+            RuntimeError -- PhoSim stalls.
+            RuntimeError -- There is the error in running the PhoSim.
+        """
+
+        process = self.startPhoSim(argList, cwd=cwd, env=env, cpuList=cpuList, niceness=niceness, 
+                                   streamOutput=True)
+
+        # Read the output in another thread to be able to detect the stall
+        lineQueue = queue.Queue()
+        reader = threading.Thread(target=self.__readLines, args=(process.stdout, lineQueue))
+        reader.daemon = True
+        reader.start()
+
+        logFile = None
+        if (logFilePath is not None):
+            logFile = open(logFilePath, "w")
+
+        try:
+            while True:
+                try:
+                    line = lineQueue.get(timeout=stallTimeInSec)
+                except queue.Empty:
+                    raise RuntimeError("PhoSim has no output in %.1f sec: %s" % (stallTimeInSec, 
+                                        " ".join(process.args)))
+
+                # End of output
+                if (line is None):
+                    break
+
+                if (logFile is not None):
+                    logFile.write(line)
+                    logFile.flush()
+
+                event = self.parsePhoSimLogLine(line)
+                if (event is not None):
+                    yield event
+
+            returnCode = process.wait()
+
+        finally:
+            if (logFile is not None):
+                logFile.close()
+
+            # Kill the PhoSim and its child processes if it is still running
+            if (process.poll() is None):
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+
+            process.stdout.close()
+
+        if (returnCode != 0):
+            raise RuntimeError("Error running: %s" % " ".join(process.args))
+
+        yield {"time": time.time(), "stage": "done", "chip": None, "line": ""}
+
+    def runPhoSimWithProgress(self, argList, callback=None, cwd=None, env=None, logFilePath=None, 
+                              cpuList=None, niceness=None, stallTimeInSec=None):
+        """
+        
+        Run the PhoSim program and send the progress events parsed from the live log to the 
+        callback function.
+        
+        Arguments:
+            argList {[list]} -- Argument list for PhoSim.
+        
+        Keyword Arguments:
+            callback {[function]} -- Function called with the progress event. Return False to 
+                                     kill the PhoSim. (default: {None})
+            cwd {[str]} -- Working directory of the process. (default: {None})
+            env {[dict]} -- Environment variables. (default: {None})
+            logFilePath {[str]} -- Log file path to keep the PhoSim log. (default: {None})
+            cpuList {[list]} -- CPU indexes the process is bound to. (default: {None})
+            niceness {[int]} -- Increment of the niceness of process. (default: {None})
+            stallTimeInSec {[float]} -- Kill the PhoSim if there is no log output in this time. 
+                                        Check iterPhoSimProgress() for the buffering of output. 
+                                        (default: {None})
+        
+        Returns:
+            [list] -- Progress events.
+        
+        Raises:
+            RuntimeError -- PhoSim is killed by the callback function.
+        """
+
+        eventList = []
+        progress = self.iterPhoSimProgress(argList, cwd=cwd, env=env, logFilePath=logFilePath, 
+                                           cpuList=cpuList, niceness=niceness, 
+                                           stallTimeInSec=stallTimeInSec)
+        for event in progress:
+            eventList.append(event)
+
+            if (callback is not None) and (callback(event) is False):
+                # Close the generator to kill the PhoSim
+                progress.close()
+                raise RuntimeError("PhoSim is killed by the callback at the stage of %s." % event["stage"])
+
+        return eventList
+
+    def __readLines(self, stream, lineQueue):
+        """
+        
+        Read the lines of stream into the queue. None is put at the end of stream.
+        
+        Arguments:
+            stream {[file]} -- Stream to read.
+            lineQueue {[queue.Queue]} -- Queue to put the lines.
+        """
+
+        try:
+            for line in stream:
+                lineQueue.put(line)
+        except ValueError:
+            # The stream is closed
+            pass
+        finally:
+            lineQueue.put(None)
+
+    def __setProcessPriority(self, process, cpuList=None, niceness=None):
+        """
+        
+        Set the CPU affinity and niceness of the started process from this process. The 
+        preexec_fn of subprocess.Popen() is not used because it is not safe when there are 
+        threads. The child processes of PhoSim started after this call inherit the setting. 
+        The process is killed if the setting fails.
+        
+        Arguments:
+            process {[subprocess.Popen]} -- Started process.
+        
+        Keyword Arguments:
+            cpuList {[list]} -- CPU indexes the process is bound to. (default: {None})
+            niceness {[int]} -- Increment of the niceness of process. (default: {None})
+        """
+
+        try:
+            if (cpuList is not None):
+                os.sched_setaffinity(process.pid, cpuList)
+
+            if (niceness is not None):
+                priority = os.getpriority(os.PRIO_PROCESS, process.pid)
+                os.setpriority(os.PRIO_PROCESS, process.pid, priority + niceness)
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+
     def __runProgram(self, command, binDir=None, argstring=None):
         """
         
@@ -526,6 +981,14 @@ class PhosimCommuTest(unittest.TestCase):
         self.phosimDir = os.path.join(os.path.abspath(os.sep), "home", "ttsai", "Document", 
                                         "bitbucket", "phosim_syseng2")
 
+        # Directory of fake PhoSim
+        self.fakePhosimDir = os.path.join("..", "testData", "tempPhoSim")
+
+    def tearDown(self):
+
+        if os.path.exists(self.fakePhosimDir):
+            shutil.rmtree(self.fakePhosimDir)
+
     def testFunc(self):
         
         # Instantiate the phosim communicator
@@ -586,6 +1049,25 @@ class PhosimCommuTest(unittest.TestCase):
         ansContent = "object  0\t 1.000000\t 1.000000  2.000000 ../sky/flat.txt 0.0 0.0 0.0 0.0 0.0 0.0 star 0.0 none none \n"
         self.assertEqual(content, ansContent)
 
+        starIdList = np.arange(5.0)
+        raList = np.random.rand(5)
+        decList = np.random.rand(5)
+        magList = np.random.rand(5)*10
+        ansContent = ""
+        for ii in range(len(starIdList)):
+            ansContent += phosimCom.generateStar(starIdList[ii], raList[ii], decList[ii], magList[ii], 
+                                                 sedName)
+
+        catalogFilePath = os.path.join("..", "testData", "tempCatalog.inst")
+        phosimCom.setTimer(StageTimer(enabled=True))
+        numStar = phosimCom.writeStarCatalog(catalogFilePath, starIdList, raList, decList, magList, 
+                                             sedName, chunkSize=2, mode="w")
+        self.assertEqual(numStar, 5)
+        with open(catalogFilePath, "r") as catalogFile:
+            self.assertEqual(catalogFile.read(), ansContent)
+        self.assertEqual(phosimCom.timer.getReport()["stage"]["PhosimCommu.writeStarCatalog"]["count"], 1)
+        os.remove(catalogFilePath)
+
         obsId = 100
         aFilterId = 1
         content = phosimCom.getStarInstance(obsId, aFilterId)
@@ -602,6 +1084,21 @@ class PhosimCommuTest(unittest.TestCase):
         ansArgString = "%s -i lsst -e 1 -s R22_S11" % absFilePath
 
         self.assertEqual(argString, ansArgString)
+
+        workDir = "work"
+        argString = phosimCom.getPhoSimArgs(instFileName, workDir=workDir)
+        ansArgString = "%s -i lsst -e 1 -w %s" % (absFilePath, os.path.abspath(workDir))
+        self.assertEqual(argString, ansArgString)
+
+        argList = phosimCom.getPhoSimArgList(instFileName, sensorName="\"R22_S11|R22_S12\"", 
+                                             numProc=2, workDir=workDir)
+        ansArgList = [absFilePath, "-i", "lsst", "-e", "1", "-p", "2", "-s", "R22_S11|R22_S12", 
+                      "-w", os.path.abspath(workDir)]
+        self.assertEqual(argList, ansArgList)
+
+        env = phosimCom.getPhoSimEnv(envVar={"TEMP_VAR": "1"}, numThreadInLib=2)
+        self.assertEqual(env["TEMP_VAR"], "1")
+        self.assertEqual(env["OMP_NUM_THREADS"], "2")
         os.remove(absFilePath)
 
         wavelengthInNm = 300.0
@@ -616,6 +1113,51 @@ class PhosimCommuTest(unittest.TestCase):
         except RuntimeError:
             print("Do not find PhoSim directory.")
 
+        try:
+            phosimCom.runPhoSimByArgList(["-v"], cpuList=[0], niceness=1)
+        except RuntimeError:
+            print("Do not find PhoSim directory.")
+
+        event = phosimCom.parsePhoSimLogLine("Photon Raytrace \n")
+        self.assertEqual(event["stage"], "raytrace")
+        event = phosimCom.parsePhoSimLogLine("lsst_e_9006000_f1_R22_S11_E000.fits.gz")
+        self.assertEqual((event["stage"], event["chip"]), ("chipDone", "R22_S11"))
+        self.assertEqual(phosimCom.parsePhoSimLogLine("Nothing"), None)
+
+        # Fake PhoSim to print the log
+        fakePhosimDir = self.fakePhosimDir
+        os.makedirs(fakePhosimDir)
+        content = "import sys, time\n"
+        content += "print(\"Photon Raytrace\")\n"
+        content += "print(\"lsst_e_9006000_f1_R22_S11_E000.fits.gz\")\n"
+        content += "print(\"E2ADC\")\n"
+        content += "if (sys.argv[1] == \"stall\"):\n"
+        content += "    time.sleep(30)\n"
+        phosimCom.writeToFile(os.path.join(fakePhosimDir, "phosim.py"), content=content, mode="w")
+        phosimCom.setPhoSimDir(fakePhosimDir)
+
+        # The CPU affinity and niceness are set from this process
+        process = phosimCom.startPhoSim(["stall"], cpuList=[0], niceness=1)
+        try:
+            self.assertEqual(os.sched_getaffinity(process.pid), {0})
+            self.assertEqual(os.getpriority(os.PRIO_PROCESS, process.pid), 
+                             os.getpriority(os.PRIO_PROCESS, 0) + 1)
+        finally:
+            process.kill()
+            process.wait()
+
+        logFilePath = os.path.join(fakePhosimDir, "phosim.log")
+        eventList = phosimCom.runPhoSimWithProgress(["run"], logFilePath=logFilePath)
+        stageList = [event["stage"] for event in eventList]
+        self.assertEqual(stageList, ["raytrace", "chipDone", "e2adc", "done"])
+        with open(logFilePath, "r") as logFile:
+            self.assertEqual(len(logFile.readlines()), 3)
+
+        self.assertRaises(RuntimeError, phosimCom.runPhoSimWithProgress, ["run"], 
+                          callback=lambda event: event["stage"] != "chipDone")
+        self.assertRaises(RuntimeError, phosimCom.runPhoSimWithProgress, ["stall"], 
+                          stallTimeInSec=1)
+
 if __name__ == "__main__":
 
     # Do the unit test
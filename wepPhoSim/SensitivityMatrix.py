@@ -0,0 +1,545 @@
+import os, hashlib, json, shutil, unittest
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from wepPhoSim.CamSim import CamSim
+from wepPhoSim.CampaignState import CampaignState
+from wepPhoSim.PhosimCommu import PhosimCommu
+from wepPhoSim.TeleFacade import TeleFacade
+from wepPhoSim.OpdMetrology import OpdMetrology
+
+class SensitivityMatrix(object):
+
+    def __init__(self, tele, opdMetr):
+        """
+
+        Initiate the SensitivityMatrix object. This class builds the sensitivity matrix of annular
+        Zernike polynomials (Zk) of field points to the degree of freedom (DOF) in PhoSim. Each DOF
+        is perturbed in turn from the accumulated DOF of telescope, and the OPD simulations are run
+        at the same time. The matrix is cached by the hash of telescope state, and the partially
+        completed build is resumed.
+
+        Arguments:
+            tele {[TeleFacade]} -- TeleFacade object.
+            opdMetr {[OpdMetrology]} -- OpdMetrology object with the field points.
+        """
+
+        self.tele = tele
+        self.opdMetr = opdMetr
+
+        # Observation
+        self.obsId = 9006000
+        self.aFilter = "g"
+        self.wavelengthInNm = 500
+        self.zAngleInDeg = 0
+        self.rotAngInDeg = 0
+        self.seedNum = None
+
+        # Setting files of PhoSim
+        self.opdCmdSettingFile = None
+        self.opdInstSettingFile = None
+
+        # Zk fitting
+        self.znTerms = 22
+        self.obscuration = 0.61
+        self.startZkIdx = 3
+
+        # PhoSim resource
+        self.numPro = 1
+        self.numThread = 1
+        self.numWorker = None
+
+        # State of build in the run
+        self.buildState = None
+
+    def setObservation(self, obsId, aFilter, wavelengthInNm, zAngleInDeg=0, rotAngInDeg=0, seedNum=None):
+        """
+
+        Set the observation.
+
+        Arguments:
+            obsId {[int]} -- Observation ID.
+            aFilter {[str]} -- Active filter type ("u", "g", "r", "i", "z", "y").
+            wavelengthInNm {[float]} -- OPD source wavelength in nm.
+
+        Keyword Arguments:
+            zAngleInDeg {[float]} -- Zenith angle in degree. (default: {0})
+            rotAngInDeg {[float]} -- Camera rotation angle in degree. (default: {0})
+            seedNum {[int]} -- Random seed number of mirror surface error. (default: {None})
+        """
+
+        self.obsId = obsId
+        self.aFilter = aFilter
+        self.wavelengthInNm = wavelengthInNm
+        self.zAngleInDeg = zAngleInDeg
+        self.rotAngInDeg = rotAngInDeg
+        self.seedNum = seedNum
+
+    def setSettingFile(self, opdCmdSettingFile=None, opdInstSettingFile=None):
+        """
+
+        Set the physical command and instance setting files of PhoSim.
+
+        Keyword Arguments:
+            opdCmdSettingFile {[str]} -- OPD physical command setting file. (default: {None})
+            opdInstSettingFile {[str]} -- OPD instance setting file. (default: {None})
+        """
+
+        self.opdCmdSettingFile = opdCmdSettingFile
+        self.opdInstSettingFile = opdInstSettingFile
+
+    def setZkSetting(self, znTerms=22, obscuration=0.61, startZkIdx=3):
+        """
+
+        Set the fitting of annular Zk.
+
+        Keyword Arguments:
+            znTerms {int} -- Number of terms of annular Zk. (default: {22})
+            obscuration {float} -- Obscuration of annular Zernike polynomial. (default: {0.61})
+            startZkIdx {int} -- Index of the first Zk in the matrix. The default value skips the
+                                piston, x-tilt, and y-tilt (z1-z3). (default: {3})
+        """
+
+        self.znTerms = int(znTerms)
+        self.obscuration = obscuration
+        self.startZkIdx = int(startZkIdx)
+
+    def setPhoSimResource(self, numPro=1, numThread=1, numWorker=None):
+        """
+
+        Set the resource of PhoSim runs.
+
+        Keyword Arguments:
+            numPro {int} -- Number of processors of each run. (default: {1})
+            numThread {int} -- Number of threads of each run. (default: {1})
+            numWorker {[int]} -- Number of PhoSim runs at the same time. Use the number of CPU if
+                                 None. (default: {None})
+        """
+
+        self.numPro = int(numPro)
+        self.numThread = int(numThread)
+        self.numWorker = numWorker
+
+    def getDofStepInUm(self, dofIdx, dofStepInUm=1.0):
+        """
+
+        Get the perturbation step of each DOF.
+
+        Arguments:
+            dofIdx {[list/ ndarray]} -- Indexes of DOF to perturb.
+
+        Keyword Arguments:
+            dofStepInUm {[float/ list/ ndarray]} -- Perturbation step in um. The step of each DOF
+                                                    can be given in the order of dofIdx.
+                                                    (default: {1.0})
+
+        Returns:
+            [ndarray] -- Perturbation step of each DOF in um.
+
+        Raises:
+            ValueError -- The length of step is different from the number of DOF, or the step
+                          is zero.
+        """
+
+        dofStepInUm = np.array(dofStepInUm, dtype=float)
+        if (dofStepInUm.ndim == 0):
+            dofStepInUm = np.ones(len(dofIdx))*dofStepInUm
+
+        if (len(dofStepInUm) != len(dofIdx)):
+            raise ValueError("The length of DOF step should be %d." % len(dofIdx))
+
+        if np.any(dofStepInUm == 0):
+            raise ValueError("The DOF step should not be zero.")
+
+        return dofStepInUm
+
+    def getStateHash(self, dofIdx, dofStepInUm):
+        """
+
+        Get the hash of telescope state that determines the sensitivity matrix.
+
+        Arguments:
+            dofIdx {[list/ ndarray]} -- Indexes of DOF to perturb.
+            dofStepInUm {[list/ ndarray]} -- Perturbation step of each DOF in um.
+
+        Returns:
+            [str] -- Hash of telescope state.
+        """
+
+        subSysDataDir = dict()
+        if (self.tele.cam is not None):
+            subSysDataDir["cam"] = self.tele.cam.camDataDir
+        if (self.tele.M1M3 is not None):
+            subSysDataDir["M1M3"] = self.tele.M1M3.mirrorDataDir
+        if (self.tele.M2 is not None):
+            subSysDataDir["M2"] = self.tele.M2.mirrorDataDir
+
+        state = dict()
+        state["dofInUm"] = np.array(self.tele.dofInUm, dtype=float).tolist()
+        state["dofIdx"] = np.array(dofIdx, dtype=int).tolist()
+        state["dofStepInUm"] = np.array(dofStepInUm, dtype=float).tolist()
+        state["fieldX"] = np.array(self.opdMetr.fieldX, dtype=float).tolist()
+        state["fieldY"] = np.array(self.opdMetr.fieldY, dtype=float).tolist()
+        state["observation"] = [self.aFilter, self.wavelengthInNm, self.zAngleInDeg,
+                                self.rotAngInDeg, self.seedNum]
+        state["inst"] = [self.tele.instName, self.tele.defocalDisInMm]
+        state["subSysDataDir"] = subSysDataDir
+        state["configData"] = self.tele.getConfigData()
+        state["settingFile"] = [self.__readFile(self.opdCmdSettingFile),
+                                self.__readFile(self.opdInstSettingFile)]
+        state["zk"] = [self.znTerms, self.obscuration, self.startZkIdx]
+
+        content = json.dumps(state, sort_keys=True, default=str)
+
+        return hashlib.md5(content.encode()).hexdigest()
+
+    def getBuildDir(self, outputDir, stateHash):
+        """
+
+        Get the directory of build.
+
+        Arguments:
+            outputDir {[str]} -- Output directory.
+            stateHash {[str]} -- Hash of telescope state.
+
+        Returns:
+            [str] -- Directory of build.
+        """
+
+        return os.path.join(outputDir, "senM_%s" % stateHash)
+
+    def build(self, outputDir, dofIdx=None, dofStepInUm=1.0, resume=True):
+        """
+
+        Build the sensitivity matrix. The matrix is (Zk(dof + step) - Zk(dof))/step of each
+        perturbed DOF, where dof is the accumulated DOF of telescope. The unit of Zk is um for the
+        PhoSim OPD. The matrix is saved as "senM.npy" in the directory of build and loaded directly
+        if the telescope state is not changed. The completed OPD simulations and Zk are recorded in
+        "build.json", so a failed or interrupted build only runs the remaining DOF.
+
+        Arguments:
+            outputDir {[str]} -- Output directory.
+
+        Keyword Arguments:
+            dofIdx {[list/ ndarray]} -- Indexes of DOF to perturb. Use all 50 DOF if None.
+                                        (default: {None})
+            dofStepInUm {[float/ list/ ndarray]} -- Perturbation step in um. (default: {1.0})
+            resume {bool} -- Reuse the cached matrix and completed simulations. Start over if
+                             False. (default: {True})
+
+        Returns:
+            [ndarray] -- Sensitivity matrix in the shape of (nField, nZk, nDof).
+
+        Raises:
+            ValueError -- The DOF index is out of range.
+            RuntimeError -- Some OPD simulations failed.
+        """
+
+        numDof = len(self.tele.dofInUm)
+        if (dofIdx is None):
+            dofIdx = np.arange(numDof)
+        dofIdx = np.array(dofIdx, dtype=int)
+
+        if np.any(dofIdx < 0) or np.any(dofIdx >= numDof):
+            raise ValueError("The DOF index should be in [0, %d)." % numDof)
+
+        dofStepInUm = self.getDofStepInUm(dofIdx, dofStepInUm=dofStepInUm)
+
+        buildDir = self.getBuildDir(outputDir, self.getStateHash(dofIdx, dofStepInUm))
+        self.buildState = CampaignState(os.path.join(buildDir, "build.json"))
+
+        # Use the cached matrix
+        senMFilePath = os.path.join(buildDir, "senM.npy")
+        if (resume) and (os.path.isfile(senMFilePath)):
+            return np.load(senMFilePath)
+
+        os.makedirs(buildDir, exist_ok=True)
+        if (not resume):
+            self.buildState.reset()
+
+        # The perturbation of subsystems is the same in all runs
+        pertCmdFilePath = self.tele.writePertBaseOnConfigFile(buildDir, zAngleInDeg=self.zAngleInDeg,
+                                    rotAngInDeg=self.rotAngInDeg, seedNum=self.seedNum)
+        cmdFilePath = self.tele.writeCmdFile(buildDir, cmdSettingFile=self.opdCmdSettingFile,
+                                             pertFilePath=pertCmdFilePath, cmdFileName="opd.cmd")
+
+        # Runs of DOF: {runIdx: dofInUm}. The run of unperturbed DOF has the index of -1.
+        baseDofInUm = np.array(self.tele.dofInUm, dtype=float)
+        runDict = {-1: baseDofInUm}
+        for idx, stepInUm in zip(dofIdx, dofStepInUm):
+            dofInUm = baseDofInUm.copy()
+            dofInUm[idx] += stepInUm
+            runDict[int(idx)] = dofInUm
+
+        # Run the OPD simulations not completed yet
+        runIdxList = [runIdx for runIdx in runDict.keys() if (not self.buildState.isIterationDone(runIdx))]
+        instFilePathDict = self.__writeInstFiles(buildDir, runIdxList, runDict)
+
+        numWorker = self.numWorker
+        if (numWorker is None):
+            numWorker = os.cpu_count()
+        numWorker = max(min(int(numWorker), len(runIdxList)), 1)
+
+        with ThreadPoolExecutor(max_workers=numWorker) as executor:
+            futureList = [executor.submit(self.__runDof, runIdx, buildDir, instFilePathDict[runIdx],
+                                          cmdFilePath, runDict[runIdx]) for runIdx in runIdxList]
+
+        errMsgList = [str(future.exception()) for future in futureList
+                        if (future.exception() is not None)]
+        if (len(errMsgList) > 0):
+            raise RuntimeError("%d OPD simulation(s) failed:\n%s" % (len(errMsgList), "\n".join(errMsgList)))
+
+        # Assemble the sensitivity matrix
+        baseZk = np.array(self.buildState.getIteration(-1)["zk"])
+        senM = []
+        for idx, stepInUm in zip(dofIdx, dofStepInUm):
+            zk = np.array(self.buildState.getIteration(int(idx))["zk"])
+            senM.append((zk - baseZk)/stepInUm)
+        senM = np.stack(senM, axis=-1)[:, self.startZkIdx:, :]
+
+        np.save(senMFilePath, senM)
+
+        return senM
+
+    def getBaseZk(self):
+        """
+
+        Get the Zk of field points at the unperturbed DOF in the last build. This is the baseline
+        Zk of SurrogateOpd.
+
+        Returns:
+            [ndarray] -- Zk in the shape of (nField, nZk).
+
+        Raises:
+            RuntimeError -- No build is completed.
+        """
+
+        if (self.buildState is None) or (not self.buildState.isIterationDone(-1)):
+            raise RuntimeError("No build of sensitivity matrix is completed.")
+
+        baseZk = np.array(self.buildState.getIteration(-1)["zk"])
+
+        return baseZk[:, self.startZkIdx:]
+
+    def __writeInstFiles(self, buildDir, runIdxList, runDict):
+        """
+
+        Write the OPD instance files of runs.
+
+        Arguments:
+            buildDir {[str]} -- Directory of build.
+            runIdxList {[list]} -- Indexes of runs to write.
+            runDict {[dict]} -- DOF in um of runs: {runIdx: dofInUm}.
+
+        Returns:
+            [dict] -- Instance file paths: {runIdx: instFilePath}.
+        """
+
+        instFilePathDict = dict()
+
+        # The instance file is written with the DOF of telescope
+        dofInUm = self.tele.dofInUm
+        try:
+            for runIdx in runIdxList:
+                runDir = self.__getRunDir(buildDir, runIdx)
+                os.makedirs(runDir, exist_ok=True)
+
+                self.tele.setDofInUm(runDict[runIdx])
+                instFilePathDict[runIdx] = self.tele.writeOpdInstFile(runDir, self.opdMetr,
+                                            self.obsId, self.aFilter, self.wavelengthInNm,
+                                            instSettingFile=self.opdInstSettingFile,
+                                            instFileName="opd.inst")
+        finally:
+            self.tele.setDofInUm(dofInUm)
+
+        return instFilePathDict
+
+    def __runDof(self, runIdx, buildDir, instFilePath, cmdFilePath, dofInUm):
+        """
+
+        Run the OPD simulation of DOF and fit the Zk of field points. The simulation is skipped if
+        it was completed in the build.
+
+        Arguments:
+            runIdx {[int]} -- Index of run.
+            buildDir {[str]} -- Directory of build.
+            instFilePath {[str]} -- Instance file path.
+            cmdFilePath {[str]} -- Command file path.
+            dofInUm {[ndarray]} -- DOF in um.
+        """
+
+        opdFileList = self.buildState.getPhoSimOutput(runIdx, "opd")
+        if (opdFileList is None):
+
+            runDir = self.__getRunDir(buildDir, runIdx)
+            imgDir = os.path.join(runDir, "opdImg")
+            workDir = imgDir + "Work"
+            os.makedirs(imgDir, exist_ok=True)
+            os.makedirs(workDir, exist_ok=True)
+
+            argList = self.tele.getPhoSimArgList(instFilePath, cmdFilePath=cmdFilePath,
+                                    numPro=self.numPro, numThread=self.numThread, outputDir=imgDir,
+                                    e2ADC=0, workDir=workDir)
+            try:
+                self.tele.runPhoSimByArgList(argList, logFilePath=os.path.join(runDir, "phosimOpd.log"))
+            finally:
+                shutil.rmtree(workDir, ignore_errors=True)
+
+            opdFileList = []
+            for idx in range(len(self.opdMetr.fieldX)):
+                opdFileList.append(os.path.join(imgDir, "opd_%d_%d.fits.gz" % (self.obsId, idx)))
+
+            self.buildState.recordPhoSimOutput(runIdx, "opd", opdFileList)
+
+        # Fit the Zk of field points
+        zk = []
+        for opdFitsFile in opdFileList:
+            zk.append(self.opdMetr.getZkFromOpd(opdFitsFile=opdFitsFile, znTerms=self.znTerms,
+                                                obscuration=self.obscuration)[0])
+
+        state = dict()
+        state["dofInUm"] = np.array(dofInUm, dtype=float).tolist()
+        state["zk"] = np.array(zk, dtype=float).tolist()
+        self.buildState.recordIteration(runIdx, state)
+
+    def __getRunDir(self, buildDir, runIdx):
+        """
+
+        Get the directory of run.
+
+        Arguments:
+            buildDir {[str]} -- Directory of build.
+            runIdx {[int]} -- Index of run. The run of unperturbed DOF is -1.
+
+        Returns:
+            [str] -- Directory of run.
+        """
+
+        if (runIdx < 0):
+            return os.path.join(buildDir, "base")
+
+        return os.path.join(buildDir, "dof%d" % runIdx)
+
+    def __readFile(self, filePath):
+        """
+
+        Read the content of file.
+
+        Arguments:
+            filePath {[str]} -- File path.
+
+        Returns:
+            [str] -- Content of file. None if the file path is None.
+        """
+
+        if (filePath is None):
+            return None
+
+        with open(filePath, "r") as inFile:
+            return inFile.read()
+
+class SensitivityMatrixTest(unittest.TestCase):
+
+    """
+    Test functions in SensitivityMatrix.
+    """
+
+    def setUp(self):
+
+        # Set the output dir
+        self.outputDir = os.path.join("..", "output", "tempSenM")
+        os.makedirs(self.outputDir)
+
+        # Fake PhoSim that scales the OPD map by (1 + sum of DOF). It fails if the file "fail"
+        # exists and the DOF 10 is perturbed.
+        self.phosimDir = os.path.join(self.outputDir, "phosim")
+        os.makedirs(os.path.join(self.phosimDir, "data", "sky"))
+
+        self.opdFitsFile = os.path.abspath(os.path.join("..", "testData", "testOpdFunc",
+                                                        "sim6_iter0_opd0.fits.gz"))
+
+        content = "import os, sys\n"
+        content += "from astropy.io import fits\n"
+        content += "args = sys.argv[1:]\n"
+        content += "outputDir = args[args.index(\"-o\") + 1]\n"
+        content += "lines = open(args[0]).readlines()\n"
+        content += "obsId = [int(l.split()[1]) for l in lines if l.startswith(\"Opsim_obshistid\")][0]\n"
+        content += "dof = dict([(int(l.split()[1]), float(l.split()[2])) for l in lines if l.startswith(\"move \")])\n"
+        content += "if os.path.isfile(os.path.join(os.path.dirname(__file__), \"fail\")) and (dof[15] != 0):\n"
+        content += "    sys.exit(1)\n"
+        content += "opd = fits.getdata(\"%s\")*(1 + sum(dof.values()))\n" % self.opdFitsFile
+        content += "for line in [l for l in lines if l.startswith(\"opd \")]:\n"
+        content += "    opdFileName = \"opd_%d_%d.fits.gz\" % (obsId, int(line.split()[1]))\n"
+        content += "    fits.writeto(os.path.join(outputDir, opdFileName), opd)\n"
+
+        fid = open(os.path.join(self.phosimDir, "phosim.py"), "w")
+        fid.write(content)
+        fid.close()
+
+        self.configFilePath = os.path.join("..", "data", "telescopeConfig", "GT.inst")
+        self.camDataDir = os.path.join("..", "data", "camera")
+
+    def tearDown(self):
+
+        shutil.rmtree(self.outputDir)
+
+    def testFunc(self):
+
+        tele = TeleFacade(cam=CamSim(), phoSimCommu=PhosimCommu())
+        tele.setConfigFile(self.configFilePath)
+        tele.setSubSysConfigFile(camDataDir=self.camDataDir, phosimDir=self.phosimDir)
+
+        opdMetr = OpdMetrology()
+        opdMetr.setFieldXYinDeg(np.array([0, 0.2]), np.array([0, 0.2]))
+
+        senMBuilder = SensitivityMatrix(tele, opdMetr)
+        senMBuilder.setObservation(9006000, "g", 500, zAngleInDeg=27.0912)
+        senMBuilder.setPhoSimResource(numWorker=2)
+
+        dofIdx = [0, 5, 10]
+        dofStepInUm = [1, 0.5, 2]
+        self.assertRaises(ValueError, senMBuilder.build, self.outputDir, dofIdx=[50])
+        self.assertRaises(ValueError, senMBuilder.build, self.outputDir, dofIdx=dofIdx,
+                          dofStepInUm=[1, 0])
+
+        # The simulation of DOF 10 fails
+        open(os.path.join(self.phosimDir, "fail"), "w").close()
+        self.assertRaises(RuntimeError, senMBuilder.build, self.outputDir, dofIdx=dofIdx,
+                          dofStepInUm=dofStepInUm)
+
+        stateHash = senMBuilder.getStateHash(dofIdx, senMBuilder.getDofStepInUm(dofIdx, dofStepInUm))
+        buildDir = senMBuilder.getBuildDir(self.outputDir, stateHash)
+        opdFilePath = os.path.join(buildDir, "dof5", "opdImg", "opd_9006000_0.fits.gz")
+        mtime = os.stat(opdFilePath).st_mtime_ns
+
+        # Resume the build: only the DOF 10 is simulated
+        os.remove(os.path.join(self.phosimDir, "fail"))
+        senM = senMBuilder.build(self.outputDir, dofIdx=dofIdx, dofStepInUm=dofStepInUm)
+        self.assertEqual(senM.shape, (2, 19, 3))
+        self.assertEqual(os.stat(opdFilePath).st_mtime_ns, mtime)
+        self.assertFalse(os.path.exists(os.path.join(buildDir, "dof10", "opdImgWork")))
+
+        # The OPD is linear to the DOF
+        ansZk = opdMetr.getZkFromOpd(opdFitsFile=self.opdFitsFile)[0][3:]
+        for ii in range(3):
+            self.assertTrue(np.max(np.abs(senM[0, :, ii] - ansZk)) < 1e-3*np.max(np.abs(ansZk)))
+        self.assertTrue(np.allclose(senM[0], senM[1]))
+        self.assertTrue(np.allclose(senMBuilder.getBaseZk()[1], ansZk))
+
+        # The cached matrix is used
+        os.remove(os.path.join(self.phosimDir, "phosim.py"))
+        self.assertTrue(np.array_equal(senMBuilder.build(self.outputDir, dofIdx=dofIdx,
+                                       dofStepInUm=dofStepInUm), senM))
+        self.assertTrue(np.allclose(senMBuilder.getBaseZk()[1], ansZk))
+
+        # The telescope state is changed
+        tele.setDofInUm(np.ones(50))
+        self.assertNotEqual(senMBuilder.getStateHash(dofIdx, senMBuilder.getDofStepInUm(dofIdx,
+                            dofStepInUm)), stateHash)
+        self.assertRaises(RuntimeError, senMBuilder.build, self.outputDir, dofIdx=dofIdx,
+                          dofStepInUm=dofStepInUm)
+
+if __name__ == "__main__":
+
+    # Do the unit test
+    unittest.main()
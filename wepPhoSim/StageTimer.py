@@ -0,0 +1,358 @@
+import os, cProfile, io, json, pickle, pstats, shutil, threading, time, unittest
+
+class StageTimer(object):
+
+    def __init__(self, enabled=False):
+        """
+
+        Initiate the StageTimer object. This class records the time spent in each stage and the
+        counters of events. The cProfile can be captured as well. When it is disabled, stage()
+        returns a shared empty context manager and count() returns immediately, so the cost of
+        instrumentation is negligible.
+
+        Keyword Arguments:
+            enabled {bool} -- Enable the timer or not. (default: {False})
+        """
+
+        self.enabled = enabled
+
+        # Stage time: {stageName: {"count", "totalTime", "minTime", "maxTime"}}
+        self.stageData = dict()
+
+        # Counter: {counterName: count}
+        self.counterData = dict()
+
+        # Profiler
+        self.profiler = None
+
+        # Lock to record from several threads
+        self.lock = threading.Lock()
+
+    def enable(self, profile=False):
+        """
+
+        Enable the timer.
+
+        Keyword Arguments:
+            profile {bool} -- Capture the cProfile of calling thread as well. (default: {False})
+        """
+
+        self.enabled = True
+
+        if (profile) and (self.profiler is None):
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def disable(self):
+        """
+
+        Disable the timer. The recorded data is kept.
+        """
+
+        self.enabled = False
+
+        if (self.profiler is not None):
+            self.profiler.disable()
+
+    def reset(self):
+        """
+
+        Reset the recorded data and profile.
+        """
+
+        with self.lock:
+            self.stageData = dict()
+            self.counterData = dict()
+
+        if (self.profiler is not None):
+            self.profiler.disable()
+            self.profiler = None
+
+    def stage(self, stageName):
+        """
+
+        Get the context manager to time the stage.
+
+        Arguments:
+            stageName {[str]} -- Stage name (e.g. "MirrorSim.readData").
+
+        Returns:
+            [object] -- Context manager.
+        """
+
+        if (not self.enabled):
+            return _nullStage
+
+        return _Stage(self, stageName)
+
+    def count(self, counterName, num=1):
+        """
+
+        Add the number to the counter.
+
+        Arguments:
+            counterName {[str]} -- Counter name (e.g. "TeleFacade.pertCacheHit").
+
+        Keyword Arguments:
+            num {int} -- Number to add. (default: {1})
+        """
+
+        if (not self.enabled):
+            return
+
+        with self.lock:
+            self.counterData[counterName] = self.counterData.get(counterName, 0) + num
+
+    def addStageTime(self, stageName, timeInSec):
+        """
+
+        Add the time spent in the stage.
+
+        Arguments:
+            stageName {[str]} -- Stage name.
+            timeInSec {[float]} -- Time in second.
+        """
+
+        with self.lock:
+            data = self.stageData.get(stageName)
+            if (data is None):
+                self.stageData[stageName] = {"count": 1, "totalTime": timeInSec,
+                                             "minTime": timeInSec, "maxTime": timeInSec}
+            else:
+                data["count"] += 1
+                data["totalTime"] += timeInSec
+                data["minTime"] = min(data["minTime"], timeInSec)
+                data["maxTime"] = max(data["maxTime"], timeInSec)
+
+    def merge(self, stageData, counterData):
+        """
+
+        Merge the stage time and counters recorded by another timer (e.g. in the worker
+        process).
+
+        Arguments:
+            stageData {[dict]} -- Stage time: {stageName: {"count", "totalTime", "minTime",
+                                  "maxTime"}}.
+            counterData {[dict]} -- Counter: {counterName: count}.
+        """
+
+        with self.lock:
+            for stageName, newData in stageData.items():
+                data = self.stageData.get(stageName)
+                if (data is None):
+                    self.stageData[stageName] = dict(newData)
+                else:
+                    data["count"] += newData["count"]
+                    data["totalTime"] += newData["totalTime"]
+                    data["minTime"] = min(data["minTime"], newData["minTime"])
+                    data["maxTime"] = max(data["maxTime"], newData["maxTime"])
+
+            for counterName, num in counterData.items():
+                self.counterData[counterName] = self.counterData.get(counterName, 0) + num
+
+    def getReport(self, numProfileLine=30):
+        """
+
+        Get the timing report.
+
+        Keyword Arguments:
+            numProfileLine {int} -- Number of functions listed in the profile sorted by the
+                                    cumulative time. (default: {30})
+
+        Returns:
+            [dict] -- Report with the stage time in second, counters, and profile text (None if
+                      the profile is not captured).
+        """
+
+        with self.lock:
+            stageData = dict([(stageName, dict(data)) for stageName, data in self.stageData.items()])
+            counterData = dict(self.counterData)
+
+        for data in stageData.values():
+            data["meanTime"] = data["totalTime"]/data["count"]
+
+        profileText = None
+        if (self.profiler is not None):
+            stream = io.StringIO()
+            stats = pstats.Stats(self.profiler, stream=stream)
+            stats.sort_stats("cumulative").print_stats(numProfileLine)
+            profileText = stream.getvalue()
+
+        report = dict()
+        report["stage"] = stageData
+        report["counter"] = counterData
+        report["profile"] = profileText
+
+        return report
+
+    def writeReport(self, filePath, numProfileLine=30):
+        """
+
+        Write the timing report to the JSON file.
+
+        Arguments:
+            filePath {[str]} -- JSON file path.
+
+        Keyword Arguments:
+            numProfileLine {int} -- Number of functions listed in the profile. (default: {30})
+
+        Returns:
+            [dict] -- Report.
+        """
+
+        report = self.getReport(numProfileLine=numProfileLine)
+        with open(filePath, "w") as outFile:
+            json.dump(report, outFile, indent=2, sort_keys=True)
+
+        return report
+
+    def __getstate__(self):
+        """
+
+        Get the state to pickle. The lock and profiler are not pickled, so the object can be
+        sent to the worker processes. The data recorded in the worker processes is not
+        returned. Use merge() to collect it.
+
+        Returns:
+            [dict] -- State to pickle.
+        """
+
+        state = self.__dict__.copy()
+        state["lock"] = None
+        state["profiler"] = None
+
+        return state
+
+    def __setstate__(self, state):
+        """
+
+        Set the state from pickle.
+
+        Arguments:
+            state {[dict]} -- Pickled state.
+        """
+
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+class _Stage(object):
+
+    def __init__(self, timer, stageName):
+        """
+
+        Initiate the _Stage object. This is the context manager to time one stage.
+
+        Arguments:
+            timer {[StageTimer]} -- StageTimer object.
+            stageName {[str]} -- Stage name.
+        """
+
+        self.timer = timer
+        self.stageName = stageName
+        self.startTime = None
+
+    def __enter__(self):
+
+        self.startTime = time.perf_counter()
+
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+
+        self.timer.addStageTime(self.stageName, time.perf_counter() - self.startTime)
+
+        return False
+
+class _NullStage(object):
+
+    """
+    Context manager that does nothing for the disabled timer.
+    """
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+
+        return False
+
+_nullStage = _NullStage()
+
+class StageTimerTest(unittest.TestCase):
+
+    """
+    Test functions in StageTimer.
+    """
+
+    def setUp(self):
+
+        # Set the output dir
+        self.outputDir = os.path.join("..", "output", "tempTimer")
+        os.makedirs(self.outputDir)
+
+    def tearDown(self):
+
+        shutil.rmtree(self.outputDir)
+
+    def testFunc(self):
+
+        timer = StageTimer()
+        with timer.stage("read"):
+            pass
+        timer.count("cacheHit")
+        self.assertEqual(timer.getReport()["stage"], dict())
+        self.assertEqual(timer.getReport()["counter"], dict())
+
+        timer.enable(profile=True)
+        for ii in range(3):
+            with timer.stage("read"):
+                time.sleep(0.01)
+        timer.count("cacheHit", num=2)
+
+        try:
+            with timer.stage("fail"):
+                raise ValueError("Test")
+        except ValueError:
+            pass
+
+        timer.disable()
+
+        reportFilePath = os.path.join(self.outputDir, "timing.json")
+        timer.writeReport(reportFilePath)
+        with open(reportFilePath, "r") as inFile:
+            report = json.load(inFile)
+
+        self.assertEqual(report["stage"]["read"]["count"], 3)
+        self.assertGreaterEqual(report["stage"]["read"]["totalTime"], 0.03)
+        self.assertLessEqual(report["stage"]["read"]["minTime"], report["stage"]["read"]["meanTime"])
+        self.assertEqual(report["stage"]["fail"]["count"], 1)
+        self.assertEqual(report["counter"]["cacheHit"], 2)
+        self.assertTrue("sleep" in report["profile"])
+
+        # The timer can be pickled for the worker processes
+        newTimer = pickle.loads(pickle.dumps(timer))
+        self.assertEqual(newTimer.stageData["read"]["count"], 3)
+        self.assertEqual(newTimer.profiler, None)
+
+        # The data of worker timer is merged
+        newTimer.reset()
+        newTimer.enable()
+        newTimer.addStageTime("read", 1.0)
+        newTimer.addStageTime("write", 2.0)
+        newTimer.count("cacheHit")
+        timer.merge(newTimer.stageData, newTimer.counterData)
+        report = timer.getReport()
+        self.assertEqual(report["stage"]["read"]["count"], 4)
+        self.assertEqual(report["stage"]["read"]["maxTime"], 1.0)
+        self.assertEqual(report["stage"]["write"]["totalTime"], 2.0)
+        self.assertEqual(report["counter"]["cacheHit"], 3)
+
+        timer.reset()
+        self.assertEqual(timer.getReport()["profile"], None)
+        self.assertEqual(timer.getReport()["stage"], dict())
+
+if __name__ == "__main__":
+
+    # Do the unit test
+    unittest.main()
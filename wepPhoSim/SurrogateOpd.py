@@ -0,0 +1,237 @@
+import os, unittest
+import numpy as np
+
+from lsst.ts.wep.cwfs.Tool import ZernikeAnnularEval
+from wepPhoSim.OpdMetrology import OpdMetrology
+
+class SurrogateOpd(object):
+
+    def __init__(self, senM, baseZk, baseDofInUm, dofIdx=None, startZkIdx=3, obscuration=0.61,
+                 opdSize=255):
+        """
+
+        Initiate the SurrogateOpd object. This class is the linear model of the annular Zernike
+        polynomials (Zk) of field points to the degree of freedom (DOF) based on the sensitivity
+        matrix. It predicts the Zk and synthesizes the OPD maps without running the PhoSim.
+
+        Arguments:
+            senM {[ndarray]} -- Sensitivity matrix in the shape of (nField, nZk, nDof).
+            baseZk {[ndarray]} -- Zk of field points at the baseline DOF in the shape of
+                                  (nField, nZk). For PhoSim OPD, the unit is um.
+            baseDofInUm {[list/ ndarray]} -- Baseline DOF in um.
+
+        Keyword Arguments:
+            dofIdx {[list/ ndarray]} -- Indexes of DOF in the sensitivity matrix. Use the first
+                                        nDof DOF if None. (default: {None})
+            startZkIdx {int} -- Index of the first Zk in the sensitivity matrix. (default: {3})
+            obscuration {float} -- Obscuration of annular Zernike polynomial. (default: {0.61})
+            opdSize {int} -- Pixel size of synthesized OPD map. (default: {255})
+
+        Raises:
+            ValueError -- The shapes of sensitivity matrix, baseline Zk, and DOF indexes do not
+                          match.
+        """
+
+        senM = np.array(senM, dtype=float)
+        if (senM.ndim != 3):
+            raise ValueError("The sensitivity matrix should be in the shape of (nField, nZk, nDof).")
+        numField, numZk, numDof = senM.shape
+
+        baseZk = np.array(baseZk, dtype=float)
+        if (baseZk.shape != (numField, numZk)):
+            raise ValueError("The baseline Zk should be in the shape of (%d, %d)." % (numField, numZk))
+
+        if (dofIdx is None):
+            dofIdx = np.arange(numDof)
+        dofIdx = np.array(dofIdx, dtype=int)
+        if (len(dofIdx) != numDof):
+            raise ValueError("The number of DOF indexes should be %d." % numDof)
+
+        self.senM = senM
+        self.baseZk = baseZk
+        self.baseDofInUm = np.array(baseDofInUm, dtype=float)
+        self.dofIdx = dofIdx
+        self.startZkIdx = int(startZkIdx)
+        self.obscuration = obscuration
+        self.opdSize = int(opdSize)
+
+        # Sensitivity matrix in the shape of (nField*nZk, nDof)
+        self.senM2d = senM.reshape(numField*numZk, numDof)
+
+        # Zk basis of OPD map: {opdSize: (index of pupil, basis)}
+        self.opdBasis = dict()
+
+    def getNumOfField(self):
+        """
+
+        Get the number of field points.
+
+        Returns:
+            [int] -- Number of field points.
+        """
+
+        return self.senM.shape[0]
+
+    def getZk(self, dofInUm):
+        """
+
+        Predict the Zk of field points.
+
+        Arguments:
+            dofInUm {[list/ ndarray]} -- DOF in um.
+
+        Returns:
+            [ndarray] -- Zk in the shape of (nField, nZk).
+        """
+
+        return self.getZkBatch(np.array(dofInUm, dtype=float)[np.newaxis, :])[0]
+
+    def getZkBatch(self, dofInUmList):
+        """
+
+        Predict the Zk of field points for several DOF at once.
+
+        Arguments:
+            dofInUmList {[list/ ndarray]} -- DOF in um in the shape of (nBatch, 50).
+
+        Returns:
+            [ndarray] -- Zk in the shape of (nBatch, nField, nZk).
+        """
+
+        dofInUmList = np.atleast_2d(np.array(dofInUmList, dtype=float))
+        dofDiffInUm = dofInUmList[:, self.dofIdx] - self.baseDofInUm[self.dofIdx]
+
+        zk = dofDiffInUm.dot(self.senM2d.T).reshape((-1,) + self.baseZk.shape)
+
+        return zk + self.baseZk
+
+    def getOpdMaps(self, dofInUm, opdSize=None):
+        """
+
+        Synthesize the OPD maps of field points. The piston, x-tilt, and y-tilt are not in the
+        maps by default, and the values outside of pupil are zeros. The maps can be used in
+        OpdMetrology as the PhoSim OPD.
+
+        Arguments:
+            dofInUm {[list/ ndarray]} -- DOF in um.
+
+        Keyword Arguments:
+            opdSize {[int]} -- Pixel size of OPD map. Use the default size if None.
+                               (default: {None})
+
+        Returns:
+            [ndarray] -- OPD maps in the shape of (nField, opdSize, opdSize).
+        """
+
+        return self.getOpdMapsFromZk(self.getZk(dofInUm), opdSize=opdSize)
+
+    def getOpdMapsFromZk(self, zk, opdSize=None):
+        """
+
+        Synthesize the OPD maps from the Zk of field points.
+
+        Arguments:
+            zk {[ndarray]} -- Zk in the shape of (nField, nZk).
+
+        Keyword Arguments:
+            opdSize {[int]} -- Pixel size of OPD map. Use the default size if None.
+                               (default: {None})
+
+        Returns:
+            [ndarray] -- OPD maps in the shape of (nField, opdSize, opdSize).
+        """
+
+        if (opdSize is None):
+            opdSize = self.opdSize
+
+        idx, basis = self.__getOpdBasis(int(opdSize))
+
+        zk = np.atleast_2d(zk)
+        opdMap = np.zeros((zk.shape[0], opdSize, opdSize))
+        opdMap[:, idx] = zk.dot(basis.T)
+
+        return opdMap
+
+    def __getOpdBasis(self, opdSize):
+        """
+
+        Get the Zk basis of OPD map. The basis is evaluated only once for each map size.
+
+        Arguments:
+            opdSize {[int]} -- Pixel size of OPD map.
+
+        Returns:
+            [ndarray] -- Index of pupil in the OPD map.
+            [ndarray] -- Zk basis in the shape of (nPixel in pupil, nZk).
+        """
+
+        if (opdSize not in self.opdBasis):
+
+            # x-, y-coordinate in the OPD image
+            opdGrid1d = np.linspace(-1, 1, opdSize)
+            opdx, opdy = np.meshgrid(opdGrid1d, opdGrid1d)
+            r = np.sqrt(opdx**2 + opdy**2)
+            idx = (r <= 1) & (r >= self.obscuration)
+
+            numZk = self.baseZk.shape[1]
+            basis = np.zeros((np.sum(idx), numZk))
+            for ii in range(numZk):
+                z = np.zeros(self.startZkIdx + numZk)
+                z[self.startZkIdx + ii] = 1
+                basis[:, ii] = ZernikeAnnularEval(z, opdx[idx], opdy[idx], self.obscuration)
+
+            self.opdBasis[opdSize] = (idx, basis)
+
+        return self.opdBasis[opdSize]
+
+class SurrogateOpdTest(unittest.TestCase):
+
+    """
+    Test functions in SurrogateOpd.
+    """
+
+    def setUp(self):
+
+        self.opdFitsFile = os.path.join("..", "testData", "testOpdFunc", "sim6_iter0_opd0.fits.gz")
+
+    def testFunc(self):
+
+        opdMetr = OpdMetrology()
+        baseZk = opdMetr.getZkFromOpd(opdFitsFile=self.opdFitsFile)[0][3:]
+
+        np.random.seed(6)
+        senM = np.random.rand(2, 19, 3)*0.1
+        dofIdx = [0, 5, 10]
+        surrogate = SurrogateOpd(senM, np.array([baseZk, baseZk]), np.zeros(50), dofIdx=dofIdx)
+        self.assertEqual(surrogate.getNumOfField(), 2)
+
+        self.assertRaises(ValueError, SurrogateOpd, senM, baseZk, np.zeros(50))
+        self.assertRaises(ValueError, SurrogateOpd, senM, np.array([baseZk, baseZk]), np.zeros(50),
+                          dofIdx=[0])
+
+        dofInUm = np.zeros(50)
+        dofInUm[5] = 2
+        dofInUm[20] = 1
+        zk = surrogate.getZk(dofInUm)
+        self.assertTrue(np.allclose(zk, baseZk + 2*senM[:, :, 1]))
+
+        dofInUmList = np.random.rand(4, 50)
+        zkList = surrogate.getZkBatch(dofInUmList)
+        self.assertEqual(zkList.shape, (4, 2, 19))
+        self.assertTrue(np.allclose(zkList[3], surrogate.getZk(dofInUmList[3])))
+
+        # The Zk fitted from the synthesized OPD map is the predicted Zk
+        opdMap = surrogate.getOpdMaps(dofInUm)
+        self.assertEqual(opdMap.shape, (2, 255, 255))
+        fitZk = opdMetr.getZkFromOpd(opdMap=opdMap[1])[0]
+        self.assertTrue(np.max(np.abs(fitZk[3:] - zk[1])) < 1e-3*np.max(np.abs(zk[1])))
+        self.assertTrue(np.max(np.abs(fitZk[0:3])) < 1e-3*np.max(np.abs(zk[1])))
+
+        # The map can be used in the metrology of OPD
+        pssn = opdMetr.calcPSSN(0.5, opdMap=surrogate.getOpdMaps(np.zeros(50))[0])
+        self.assertTrue((pssn > 0) and (pssn <= 1))
+
+if __name__ == "__main__":
+
+    # Do the unit test
+    unittest.main()
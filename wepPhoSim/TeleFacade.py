@@ -1,10 +1,13 @@
-import os, re, shutil, unittest
+import copy, csv, filecmp, hashlib, itertools, os, re, shutil, threading, unittest
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from wepPhoSim.CamSim import CamSim
 from wepPhoSim.M2Sim import M2Sim
 from wepPhoSim.M1M3Sim import M1M3Sim
 from wepPhoSim.PhosimCommu import PhosimCommu
+from wepPhoSim.PhoSimScheduler import PhoSimScheduler
+from wepPhoSim.StageTimer import StageTimer
 
 from wepPhoSim.OpdMetrology import OpdMetrology
 from wepPhoSim.SkySim import SkySim
@@ -37,6 +40,39 @@ class TeleFacade(object):
 
         self.configFile = configFilePath
 
+        # Parsed configuration and the modification time of configuration file
+        self.configData = None
+        self.configMtime = None
+
+        # Cached subsystem perturbations
+        self.pertCache = dict()
+
+        # Background writer of perturbation files
+        self.pertWriter = None
+        self.pertWriterError = None
+
+        # Conditions of parameter sweep given as the arguments of writePertBaseOnConfigFile()
+        self.sweepArgList = ["zAngleInDeg", "rotAngInDeg", "seedNum"]
+
+        # Timer of stages
+        self.timer = StageTimer()
+
+    def setTimer(self, timer):
+        """
+        
+        Set the timer to record the time of stages. The timer is shared with the camera, M1M3, 
+        M2, and PhoSim communication objects. The stages run in the worker processes 
+        (parallelMode="process") are not recorded.
+        
+        Arguments:
+            timer {[StageTimer]} -- StageTimer object.
+        """
+
+        self.timer = timer
+        for subSys in (self.cam, self.M1M3, self.M2, self.phoSimCommu):
+            if (subSys is not None):
+                subSys.setTimer(timer)
+
     def runPhoSim(self, argString):
         """
         
@@ -45,9 +81,53 @@ class TeleFacade(object):
         Arguments:
             argString {[str]} -- Arguments for PhoSim.
         """
-        
+
+        # The perturbation files should be ready before the PhoSim run
+        self.waitPertFileWriting()
+
         self.phoSimCommu.runPhoSim(argstring=argString)
 
+    def runPhoSimInShards(self, instFilePath, sensorNameList, outputDir, numShard=None, cmdFilePath=None, 
+                            numPro=1, numThread=1, e2ADC=1, logFilePath=None, numWorker=None, 
+                            numCpuPerJob=None, niceness=None):
+        """
+        
+        Run the PhoSim by splitting the sensors into shards. One PhoSim job is run for each shard 
+        in parallel and the outputs are merged into the output directory.
+        
+        Arguments:
+            instFilePath {[str]} -- Instance catalog file path.
+            sensorNameList {[list]} -- List of sensor name (e.g. ["R22_S11", "R22_S12"]).
+            outputDir {[str]} -- Output image directory.
+        
+        Keyword Arguments:
+            numShard {[int]} -- Number of shards. Use the number of workers if None. (default: {None})
+            cmdFilePath {[str]} -- Command file to modify the default physics. (default: {None})
+            numPro {int} -- Number of processors for each shard. (default: {1})
+            numThread {int} -- Number of threads for each shard. (default: {1})
+            e2ADC {int} -- Whether to generate amplifier images (1 = true, 0 = false). (default: {1})
+            logFilePath {[str]} -- Log file path for PhoSim calculation log. (default: {None})
+            numWorker {[int]} -- Number of shards run at the same time. Use the number of CPU if 
+                                 None. (default: {None})
+            numCpuPerJob {[int]} -- Number of CPUs each shard is bound to. (default: {None})
+            niceness {[int]} -- Increment of the niceness of shards. (default: {None})
+        
+        Returns:
+            [list] -- Merged output file paths.
+        """
+
+        # The perturbation files should be ready before the PhoSim run
+        self.waitPertFileWriting()
+
+        scheduler = PhoSimScheduler(self.phoSimCommu, numWorker=numWorker)
+        outputFileList = scheduler.runSensorShards(instFilePath, sensorNameList, outputDir, 
+                                numShard=numShard, cmdFilePath=cmdFilePath, numProc=numPro, 
+                                numThread=numThread, instrument=self.instName, e2ADC=e2ADC, 
+                                logFilePath=logFilePath, numCpuPerJob=numCpuPerJob, 
+                                niceness=niceness)
+
+        return outputFileList
+
     def getPhoSimArgs(self, instFilePath, cmdFilePath=None, numPro=1, numThread=1, outputDir=None, 
                         sensorName=None, e2ADC=1, logFilePath=None):
         """
@@ -78,6 +158,57 @@ class TeleFacade(object):
 
         return argString
 
+    def getPhoSimArgList(self, instFilePath, cmdFilePath=None, numPro=1, numThread=1, outputDir=None, 
+                            sensorName=None, e2ADC=1, workDir=None):
+        """
+        
+        Get the argument list needed to run the PhoSim directly without the shell.
+        
+        Arguments:
+            instFilePath {[str]} -- Instance catalog file path.
+        
+        Keyword Arguments:
+            cmdFilePath {[str]} -- Command file to modify the default physics. (default: {None})
+            numPro {int} -- Number of processors. (default: {1})
+            numThread {int} -- Number of threads. (default: {1})
+            outputDir {[str]} -- Output image directory. (default: {None})
+            sensorName {str} -- Sensor chip specification (e.g., all, R22_S11, R22_S11|R22_S12) 
+                                (default: {None})
+            e2ADC {int} -- Whether to generate amplifier images (1 = true, 0 = false). (default: {1})
+            workDir {[str]} -- Work directory of PhoSim. (default: {None})
+        
+        Returns:
+            [list] -- Argument list to run the PhoSim.
+        """
+
+        argList = self.phoSimCommu.getPhoSimArgList(instFilePath, extraCommand=cmdFilePath, 
+                                numProc=numPro, numThread=numThread, outputDir=outputDir, 
+                                instrument=self.instName, sensorName=sensorName, e2ADC=e2ADC, 
+                                workDir=workDir)
+
+        return argList
+
+    def runPhoSimByArgList(self, argList, logFilePath=None, env=None, cpuList=None, niceness=None):
+        """
+        
+        Run the PhoSim program directly without the shell.
+        
+        Arguments:
+            argList {[list]} -- Argument list for PhoSim.
+        
+        Keyword Arguments:
+            logFilePath {[str]} -- Log file path for PhoSim calculation log. (default: {None})
+            env {[dict]} -- Environment variables. (default: {None})
+            cpuList {[list]} -- CPU indexes the PhoSim is bound to. (default: {None})
+            niceness {[int]} -- Increment of the niceness of PhoSim. (default: {None})
+        """
+
+        # The perturbation files should be ready before the PhoSim run
+        self.waitPertFileWriting()
+
+        self.phoSimCommu.runPhoSimByArgList(argList, env=env, logFilePath=logFilePath, 
+                                            cpuList=cpuList, niceness=niceness)
+
     def setInstName(self, instruFile):
         """
         
@@ -168,7 +299,7 @@ class TeleFacade(object):
     def setConfigFile(self, configFilePath):
         """
         
-        Set the telescope configuration file.
+        Set the telescope configuration file. The parsed configuration is reset.
         
         Arguments:
             configFilePath {[str]} -- Configuration file path.
@@ -176,43 +307,108 @@ class TeleFacade(object):
 
         self.configFile = configFilePath
 
-    def getConfigValue(self, varName, index=1):
+        self.configData = None
+        self.configMtime = None
+
+    def setConfigData(self, configData):
         """
         
-        Get the value of certain variable defined in the configuration file.
+        Set the parsed telescope configuration directly. This is used to give the configuration 
+        to the parallel workers instead of the configuration file path.
         
         Arguments:
-            varName {[str]} -- Name of variable.
+            configData {[dict]} -- Parsed configuration from getConfigData().
+        """
+
+        self.configFile = None
+
+        self.configData = self.__copyConfigData(configData)
+        self.configMtime = None
+
+    def getConfigData(self):
+        """
         
-        Keyword Arguments:
-            index {int} -- Index of value. (default: {1})
+        Get the copy of parsed telescope configuration. The configuration file is parsed only if 
+        it has not been parsed or it has been modified.
         
         Returns:
-            [float/ int/ str] -- Variable value.
+            [dict] -- Parsed configuration. The key is the variable name and the value is the list 
+                      of values after the variable name.
         """
 
-        # Read the file
-        fid = open(self.configFile)
+        return self.__copyConfigData(self.__getConfigData())
 
-        # Search for the value of certain variable
-        value = None
-        for line in fid:
+    def __copyConfigData(self, configData):
+        """
+        
+        Copy the parsed configuration, so the caller can not change the configuration in use.
+        
+        Arguments:
+            configData {[dict]} -- Parsed configuration.
+        
+        Returns:
+            [dict] -- Copied configuration.
+        """
 
-            # Strip the line
-            line = line.strip()
+        return dict([(varName, list(valueList)) for varName, valueList in configData.items()])
+
+    def __getConfigData(self):
+        """
+        
+        Get the parsed telescope configuration in use.
+        
+        Returns:
+            [dict] -- Parsed configuration.
+        """
+
+        # Parse the configuration file again if it has been modified
+        if (self.configFile is not None):
+            mtime = os.stat(self.configFile).st_mtime_ns
+            if (self.configData is None) or (mtime != self.configMtime):
+                self.configData = self.__parseConfigFile(self.configFile)
+                self.configMtime = mtime
+
+        return self.configData
+
+    def __parseConfigFile(self, configFilePath):
+        """
+        
+        Parse the configuration file. Only the first definition of variable is used.
+        
+        Arguments:
+            configFilePath {[str]} -- Configuration file path.
+        
+        Returns:
+            [dict] -- Parsed configuration.
+        """
+
+        configData = dict()
+
+        fid = open(configFilePath)
+        for line in fid:
 
             # Get the element of line
             lineArray = line.split()
 
-            # Get the value
-            if (len(lineArray) > 0) and (lineArray[0] == varName):
-                value = lineArray[index]
-                break
+            if (len(lineArray) > 0) and (lineArray[0] not in configData):
+                configData[lineArray[0]] = [self.__changeValueType(value) for value in lineArray[1:]]
 
-        # Close the file
         fid.close()
 
-        # Change the value type if necessary
+        return configData
+
+    def __changeValueType(self, value):
+        """
+        
+        Change the value type to int or float if possible.
+        
+        Arguments:
+            value {[str]} -- Value.
+        
+        Returns:
+            [float/ int/ str] -- Value in the changed type.
+        """
+
         try:
             value = float(value)
             if (value == int(value)):
@@ -222,6 +418,47 @@ class TeleFacade(object):
 
         return value
 
+    def getConfigValue(self, varName, index=1):
+        """
+        
+        Get the value of certain variable defined in the configuration file.
+        
+        Arguments:
+            varName {[str]} -- Name of variable.
+        
+        Keyword Arguments:
+            index {int} -- Index of value. The index 0 is the variable name. (default: {1})
+        
+        Returns:
+            [float/ int/ str] -- Variable value.
+        """
+
+        valueList = self.__getConfigData().get(varName)
+
+        # The index 0 is the variable name
+        value = None
+        if (valueList is not None):
+            value = ([varName] + valueList)[index]
+
+        return value
+
+    def getConfigValues(self, varNameList, index=1):
+        """
+        
+        Get the values of variables defined in the configuration file.
+        
+        Arguments:
+            varNameList {[list]} -- List of variable name.
+        
+        Keyword Arguments:
+            index {int} -- Index of value. (default: {1})
+        
+        Returns:
+            [dict] -- Variable values. The key is the variable name.
+        """
+
+        return dict([(varName, self.getConfigValue(varName, index=index)) for varName in varNameList])
+
     def writeAccDofFile(self, outputFileDir, dofFileName="pert.mat"):
         """
         
@@ -326,16 +563,16 @@ class TeleFacade(object):
         content += self.phoSimCommu.doCameraConfig(sciSensorOn=sciSensorOn, wfSensorOn=wfSensorOn, 
                                                     guidSensorOn=guidSensorOn)
 
-        # Write the star source
-        for ii in range(len(skySim.starId)):
-            content += self.phoSimCommu.generateStar(skySim.starId[ii], skySim.ra[ii], 
-                                                skySim.decl[ii], skySim.mag[ii], sedName)
         self.phoSimCommu.writeToFile(instFilePath, content=content)
 
+        # Write the star source
+        self.phoSimCommu.writeStarCatalog(instFilePath, skySim.starId, skySim.ra, skySim.decl, 
+                                          skySim.mag, sedName)
+
         return instFilePath
 
     def writeOpdInstFile(self, instFileDir, opdMetr, obsId, aFilter, wavelengthInNm, 
-                            instSettingFile=None, instFileName="opd.inst"):
+                            instSettingFile=None, instFileName="opd.inst", fieldIdx=None):
         """
         
         Write the optical path difference (OPD) instance file.
@@ -350,6 +587,9 @@ class TeleFacade(object):
         Keyword Arguments:
             instSettingFile {[str]} -- Instance setting file. (default: {"None"}) 
             instFileName {[str]} -- OPD instance file name. (default: {"opd.inst"})
+            fieldIdx {[list/ ndarray]} -- Indexes of field points to write. The OPD ID is renumbered 
+                                          from 0 in this order. Write all field points if None. 
+                                          (default: {None})
         
         Returns:
             [str] -- Instance file path.
@@ -370,8 +610,12 @@ class TeleFacade(object):
         content = self.phoSimCommu.doDofPert(self.dofInUm)
 
         # Write the OPD source
-        for ii in range(len(opdMetr.fieldX)):
-            content += self.phoSimCommu.generateOpd(ii, opdMetr.fieldX[ii], opdMetr.fieldY[ii], wavelengthInNm)
+        if (fieldIdx is None):
+            fieldIdx = range(len(opdMetr.fieldX))
+
+        for opdId, idx in enumerate(fieldIdx):
+            content += self.phoSimCommu.generateOpd(opdId, opdMetr.fieldX[idx], opdMetr.fieldY[idx], 
+                                                    wavelengthInNm)
         self.phoSimCommu.writeToFile(instFilePath, content=content)
 
         # Write the OPD SED file if necessary
@@ -382,8 +626,151 @@ class TeleFacade(object):
 
         return instFilePath
 
+    def writeOpdInstFileInChunks(self, instFileDir, opdMetr, obsId, aFilter, wavelengthInNm, numChunk, 
+                                    instSettingFile=None, instFileName="opd.inst"):
+        """
+        
+        Split the field points into chunks and write the optical path difference (OPD) instance 
+        file of each chunk. The observation ID of chunk ii is obsId*100 + ii, which should be in 
+        the 32-bit integer range of PhoSim obshistid. Therefore, obsId should be in 
+        [0, 21474835].
+        
+        Arguments:
+            instFileDir {[str]} -- Directory to instance file.
+            opdMetr {[OpdMetrology]} -- OpdMetrology object.
+            obsId {[int]} -- Observation ID.
+            aFilter {[str]} -- Active filter type ("u", "g", "r", "i", "z", "y").
+            wavelengthInNm {[float]} -- OPD source wavelength in nm.
+            numChunk {[int]} -- Number of chunks (<= 100).
+        
+        Keyword Arguments:
+            instSettingFile {[str]} -- Instance setting file. (default: {"None"}) 
+            instFileName {[str]} -- OPD instance file name. The chunk index is added to the file 
+                                    name. (default: {"opd.inst"})
+        
+        Returns:
+            [list] -- Chunk information. Each chunk is a dictionary with the keys of "instFilePath", 
+                      "obsId", and "fieldIdx".
+        
+        Raises:
+            ValueError -- The number of chunks is not in [1, 100].
+            ValueError -- The observation ID of chunk is not in the 32-bit integer range.
+        """
+
+        if (numChunk < 1) or (numChunk > 100):
+            raise ValueError("The number of chunks should be in [1, 100].")
+
+        # PhoSim reads the obshistid as the 32-bit integer
+        maxObsId = 2**31 - 1
+        if (obsId < 0) or (obsId*100 + int(numChunk) - 1 > maxObsId):
+            raise ValueError("The observation ID should be in [0, %d] to run in chunks." % 
+                             ((maxObsId - int(numChunk) + 1)//100))
+
+        fileName, fileExt = os.path.splitext(instFileName)
+
+        chunkList = []
+        for fieldIdx in np.array_split(np.arange(len(opdMetr.fieldX)), int(numChunk)):
+
+            # Skip the empty chunk
+            if (len(fieldIdx) == 0):
+                continue
+
+            chunkIdx = len(chunkList)
+            chunkObsId = obsId*100 + chunkIdx
+            chunkInstFileName = "%s_chunk%d%s" % (fileName, chunkIdx, fileExt)
+
+            instFilePath = self.writeOpdInstFile(instFileDir, opdMetr, chunkObsId, aFilter, wavelengthInNm, 
+                                                 instSettingFile=instSettingFile, 
+                                                 instFileName=chunkInstFileName, fieldIdx=fieldIdx)
+
+            chunkList.append({"instFilePath": instFilePath, "obsId": chunkObsId, 
+                              "fieldIdx": fieldIdx.tolist()})
+
+        return chunkList
+
+    def runOpdChunks(self, chunkList, obsId, outputDir, cmdFilePath=None, numPro=1, numThread=1, 
+                        logFilePath=None, numWorker=None, numCpuPerJob=None):
+        """
+        
+        Run the PhoSim of optical path difference (OPD) chunks concurrently and remap the OPD 
+        outputs (opd_<chunkObsId>_<n>.fits.gz) to the original field indexes 
+        (opd_<obsId>_<fieldIdx>.fits.gz).
+        
+        Arguments:
+            chunkList {[list]} -- Chunk information from writeOpdInstFileInChunks().
+            obsId {[int]} -- Observation ID used in the remapped OPD file name.
+            outputDir {[str]} -- Output image directory.
+        
+        Keyword Arguments:
+            cmdFilePath {[str]} -- Command file to modify the default physics. (default: {None})
+            numPro {int} -- Number of processors for each chunk. (default: {1})
+            numThread {int} -- Number of threads for each chunk. (default: {1})
+            logFilePath {[str]} -- Log file path for PhoSim calculation log. The chunk index is 
+                                   added to the file name. (default: {None})
+            numWorker {[int]} -- Number of chunks run at the same time. Use the number of CPU if 
+                                 None. (default: {None})
+            numCpuPerJob {[int]} -- Number of CPUs each chunk is bound to. (default: {None})
+        
+        Returns:
+            [list] -- Remapped OPD file paths in the order of field index.
+        
+        Raises:
+            RuntimeError -- The OPD output of field point is not found.
+        """
+
+        # The perturbation files should be ready before the PhoSim run
+        self.waitPertFileWriting()
+
+        scheduler = PhoSimScheduler(self.phoSimCommu, numWorker=numWorker)
+
+        # Prepare the arguments of each chunk with its own work directory
+        argListList = []
+        logFilePathList = []
+        workDirList = []
+        for chunkIdx, chunk in enumerate(chunkList):
+
+            workDir = os.path.join(outputDir, "opdWork%d" % chunkIdx)
+            os.makedirs(workDir, exist_ok=True)
+            workDirList.append(workDir)
+
+            argList = self.getPhoSimArgList(chunk["instFilePath"], cmdFilePath=cmdFilePath, 
+                                            numPro=numPro, numThread=numThread, outputDir=outputDir, 
+                                            e2ADC=0, workDir=workDir)
+            argListList.append(argList)
+
+            chunkLogFilePath = None
+            if (logFilePath is not None):
+                fileName, fileExt = os.path.splitext(logFilePath)
+                chunkLogFilePath = "%s_chunk%d%s" % (fileName, chunkIdx, fileExt)
+            logFilePathList.append(chunkLogFilePath)
+
+        # Run the chunks and remove the work directories even if some chunks failed
+        try:
+            scheduler.runArgListJobs(argListList, logFilePathList=logFilePathList, 
+                                     numCpuPerJob=numCpuPerJob)
+        finally:
+            for workDir in workDirList:
+                shutil.rmtree(workDir, ignore_errors=True)
+
+        # Remap the OPD outputs to the original field indexes
+        opdFileDict = {}
+        for chunk in chunkList:
+            for opdId, fieldIdx in enumerate(chunk["fieldIdx"]):
+                srcFilePath = os.path.join(outputDir, "opd_%d_%d.fits.gz" % (chunk["obsId"], opdId))
+                if (not os.path.isfile(srcFilePath)):
+                    raise RuntimeError("Cannot find the OPD output: %s." % srcFilePath)
+
+                dstFilePath = os.path.join(outputDir, "opd_%d_%d.fits.gz" % (obsId, fieldIdx))
+                os.replace(srcFilePath, dstFilePath)
+                opdFileDict[fieldIdx] = dstFilePath
+
+        opdFileList = [opdFileDict[fieldIdx] for fieldIdx in sorted(opdFileDict)]
+
+        return opdFileList
+
     def writePertBaseOnConfigFile(self, pertCmdFileDir, zAngleInDeg=0, rotAngInDeg=0, seedNum=None, 
-                                    saveResMapFig=False, pertCmdFileName="pert.cmd"):
+                                    saveResMapFig=False, pertCmdFileName="pert.cmd", useCache=True, 
+                                    writeInBackground=False, parallelMode=None):
         """
         
         Write the perturbation command file based on the telescope configuration file.
@@ -398,6 +785,14 @@ class TeleFacade(object):
             seedNum {[int]} -- Random seed number. (default: {None})
             saveResMapFig {[bool]} -- Save the mirror surface residue map or not. (default: {False})
             pertCmdFileName {[str]} -- Perturbation command file name. (default: {pert.cmd})
+            useCache {[bool]} -- Reuse the subsystem perturbation of the previous call if its inputs 
+                                 are not changed. (default: {True})
+            writeInBackground {[bool]} -- Write the surface residue maps and fitted Zk files in a 
+                                          background thread. Call waitPertFileWriting() before 
+                                          reading these files. (default: {False})
+            parallelMode {[str]} -- Calculate the M1M3, M2, and camera perturbations in "thread" 
+                                    or "process" pool. The subsystems are calculated one by one 
+                                    if None. (default: {None})
         
         Returns:
             [str] -- Perturbation command file path.
@@ -420,9 +815,19 @@ class TeleFacade(object):
         M1M3zcFilePath = os.path.join(pertCmdFileDir, M1M3zcFileName)
         M2zcFilePath = os.path.join(pertCmdFileDir, M2zcFileName)
 
+        # Wait for the previous files to be written
+        self.waitPertFileWriting()
+
+        # Clear the cache if it is not used
+        if (not useCache):
+            self.clearPertCache()
+
         # Perturbation command 
         content = ""
 
+        # Files to write: {filePath: content}
+        fileDict = dict()
+
         # Get the zenith angle in radian
         zAngleInRad = zAngleInDeg/180.0*np.pi
 
@@ -432,37 +837,28 @@ class TeleFacade(object):
         # Get the numeber of grid used in Zemax
         surfaceGridN = self.getConfigValue("surfaceGridN")
 
-        # Write the camera perturbation command file
+        # Collect the subsystem perturbations to calculate
+        # {subSysName: (key, fileList, func, args)}
+        taskDict = dict()
         if (self.M1M3 is not None):
-            
-            # Do the gravity correction
-            printthzInM = self.M1M3.getPrintthz(zAngleInRad)
-
-            # Add the surface error if necessary
-            randSurfInM = None
-            if (seedNum is not None):
-                randSurfInM = self.M1M3.genMirSurfRandErr(zAngleInRad, seedNum=seedNum)
-
-            # Do the temperature correction
-            M1M3TBulk = self.getConfigValue("M1M3TBulk")
-            M1M3TxGrad = self.getConfigValue("M1M3TxGrad")
-            M1M3TyGrad = self.getConfigValue("M1M3TyGrad")
-            M1M3TzGrad = self.getConfigValue("M1M3TzGrad")
-            M1M3TrGrad = self.getConfigValue("M1M3TrGrad")
-            tempCorrInUm = self.M1M3.getTempCorr(M1M3TBulk, M1M3TxGrad, M1M3TyGrad, M1M3TzGrad, M1M3TrGrad)
-
-            # Set the mirror surface in mm
-            if (randSurfInM is not None):
-                mirrorSurfInUm = (printthzInM + randSurfInM)*1e6 + tempCorrInUm
-            else:
-                mirrorSurfInUm = printthzInM*1e6 + tempCorrInUm
-            self.M1M3.setSurfAlongZ(mirrorSurfInUm)
-
             resFile = [M1resFilePath, M3resFilePath]
-            self.M1M3.writeMirZkAndGridResInZemax(resFile=resFile, numTerms=numTerms, writeZcInMnToFilePath=M1M3zcFilePath)
+            taskDict["M1M3"] = self.__getM1M3PertTask(zAngleInRad, seedNum, numTerms, resFile, 
+                                                      M1M3zcFilePath)
+
+        if (self.M2 is not None):
+            taskDict["M2"] = self.__getM2PertTask(zAngleInRad, numTerms, surfaceGridN, M2resFilePath, 
+                                                  M2zcFilePath)
+
+        if (self.cam is not None):
+            taskDict["cam"] = self.__getCamPertTask(zAngleInRad, rotAngInDeg)
+
+        # Calculate the subsystem perturbations not in the cache
+        self.__runPertTasks(taskDict, fileDict, parallelMode=parallelMode)
+
+        # Assemble the perturbation command in the order of M1M3, M2, and camera
+        if (self.M1M3 is not None):
 
-            # Get the Zk in mm
-            zkInMm = np.loadtxt(M1M3zcFilePath)
+            zkInMm = self.pertCache["M1M3"]["zkInMm"]
 
             # Do the surface perturbation
             surfList = ["M1", "M3"]
@@ -482,23 +878,8 @@ class TeleFacade(object):
             content += self.phoSimCommu.doSurfLink(surfIdList[1], surfIdList[0])
 
         if (self.M2 is not None):
-            
-            # Do the gravity correction
-            printthzInUm = self.M2.getPrintthz(zAngleInRad)
 
-            # Do the temperature correction
-            M2TzGrad = self.getConfigValue("M2TzGrad")
-            M2TrGrad = self.getConfigValue("M2TrGrad")
-            tempCorrInUm = self.M2.getTempCorr(M2TzGrad, M2TrGrad)
-
-            # Set the mirror surface in mm
-            mirrorSurfInUm = printthzInUm + tempCorrInUm
-            self.M2.setSurfAlongZ(mirrorSurfInUm)
-            self.M2.writeMirZkAndGridResInZemax(resFile=M2resFilePath, surfaceGridN=surfaceGridN, 
-                                            numTerms=numTerms, writeZcInMnToFilePath=M2zcFilePath)
-
-            # Get the Zk in mm
-            zkInMm = np.loadtxt(M2zcFilePath)
+            zkInMm = self.pertCache["M2"]["zkInMm"]
 
             # Do the surface perturbation
             surfId = self.phoSimCommu.getSurfaceId("M2")
@@ -508,31 +889,29 @@ class TeleFacade(object):
             content += self.phoSimCommu.doSurfMapPert(surfId, M2resFilePath, 1)
 
         if (self.cam is not None):
-            # Set the camera rotation angle
-            self.cam.setRotAngInDeg(rotAngInDeg)
-
-            # Set the temperature information
-            tempInDegC = self.getConfigValue("camTB")
-            self.cam.setBodyTempInDegC(tempInDegC)
-
-            # Get the camera distortion
-            distTypeList = ["L1S1zer", "L1S2zer", "L2S1zer", "L2S2zer", "L3S1zer", "L3S2zer"]
 
             # Write the perturbation file
-            for distType in distTypeList:
+            for surfName, zkInMm in self.pertCache["cam"]["zkList"]:
                 # Get the surface ID
-                surfName = self.__getPhoSimCamSurfName(distType)
                 surfId = self.phoSimCommu.getSurfaceId(surfName)
 
                 # Do the perturbation
-                zkInMm = self.cam.getCamDistortionInMm(zAngleInRad, distType)
                 content += self.phoSimCommu.doSurfPert(surfId, zkInMm)
 
         # Write the perturbation command to file
         self.phoSimCommu.writeToFile(pertCmdFilePath, content=content, mode="w")
 
+        # Write the surface residue maps and fitted Zk files
+        if (writeInBackground):
+            self.pertWriter = threading.Thread(target=self.__runPertWriter, args=(fileDict,))
+            self.pertWriter.start()
+        else:
+            with self.timer.stage("TeleFacade.writePertFiles"):
+                self.__writePertFiles(fileDict)
+
         # Save the mirror residue map if necessary
         if (saveResMapFig):
+            self.waitPertFileWriting()
             if (self.M1M3 is not None):
                 resFile = [M1resFilePath, M3resFilePath]
                 writeToResMapFilePath1 = os.path.splitext(M1resFilePath)[0] + ".png"
@@ -547,7 +926,473 @@ class TeleFacade(object):
                                       writeToResMapFilePath=writeToResMapFilePath)
 
         return pertCmdFilePath
-                
+
+    def getSweepPoints(self, conditions):
+        """
+        
+        Get the points of parameter sweep.
+        
+        Arguments:
+            conditions {[dict/ list]} -- Grid of conditions. A dict of value lists gives the 
+                                         Cartesian product (e.g. {"zAngleInDeg": [0, 30], 
+                                         "M1M3TBulk": [0.1, 0.2]}). A list of dicts gives the 
+                                         points directly.
+        
+        Returns:
+            [list] -- List of condition dict of each point.
+        """
+
+        if isinstance(conditions, dict):
+            varNameList = list(conditions.keys())
+            pointList = [dict(zip(varNameList, valueList)) 
+                            for valueList in itertools.product(*[conditions[varName] 
+                                                                  for varName in varNameList])]
+        else:
+            pointList = [dict(point) for point in conditions]
+
+        return pointList
+
+    def runPertSweep(self, outputDir, conditions, numWorker=None, resultFileName="sweep.csv"):
+        """
+        
+        Run the perturbation over a grid of observing conditions. The perturbation files of the 
+        ii-th point are written to "point<ii>" in the output directory. The condition can be the 
+        zenith angle ("zAngleInDeg"), camera rotation angle ("rotAngInDeg"), random seed number 
+        ("seedNum"), or any variable in the configuration file (e.g. "M1M3TBulk", "camTB"). The 
+        subsystem data (FEA bases, LUT, and distortion tables) are loaded once and shared by all 
+        points. The results are written to a tidy table with one Zk term of one surface in each 
+        row.
+        
+        Arguments:
+            outputDir {[str]} -- Output directory.
+            conditions {[dict/ list]} -- Grid of conditions. See getSweepPoints().
+        
+        Keyword Arguments:
+            numWorker {[int]} -- Number of processes. Use the number of CPU if None. The points are 
+                                 run one by one if it is 1. (default: {None})
+            resultFileName {str} -- Result table file name. (default: {"sweep.csv"})
+        
+        Returns:
+            [list] -- Rows of result table.
+        
+        Raises:
+            ValueError -- The condition is not supported.
+        """
+
+        pointList = self.getSweepPoints(conditions)
+
+        # Check the conditions
+        configData = self.__getConfigData()
+        for point in pointList:
+            for varName in point.keys():
+                if (varName not in self.sweepArgList) and (varName not in configData):
+                    raise ValueError("The condition '%s' is not supported." % varName)
+
+        # Load the subsystem data shared by the points
+        self.waitPertFileWriting()
+        self.__loadSweepData(pointList)
+
+        # Directory of each point
+        pointDirList = [os.path.join(outputDir, "point%d" % ii) for ii in range(len(pointList))]
+        for pointDir in pointDirList:
+            os.makedirs(pointDir, exist_ok=True)
+
+        if (numWorker is None):
+            numWorker = os.cpu_count()
+        numWorker = min(int(numWorker), len(pointList))
+
+        # Run the points
+        if (numWorker <= 1):
+            configFile, configData, configMtime = self.configFile, self.configData, self.configMtime
+            try:
+                rowList = []
+                for pointIdx, point in enumerate(pointList):
+                    rowList += calcSweepPoint(self, pointIdx, point, pointDirList[pointIdx])
+            finally:
+                self.configFile, self.configData, self.configMtime = configFile, configData, configMtime
+        else:
+            # Give the parsed configuration to the workers
+            tele = copy.copy(self)
+            tele.pertCache = dict()
+            tele.setConfigData(configData)
+
+            with ProcessPoolExecutor(max_workers=numWorker, initializer=initSweepWorker, 
+                                     initargs=(tele,)) as executor:
+                futureList = [executor.submit(calcSweepPointInWorker, pointIdx, point, 
+                                              pointDirList[pointIdx]) 
+                                for pointIdx, point in enumerate(pointList)]
+                rowList = []
+                for future in futureList:
+                    rowList += future.result()
+
+        # Write the result table
+        fieldNameList = ["pointIdx"]
+        for point in pointList:
+            fieldNameList += [varName for varName in point.keys() if (varName not in fieldNameList)]
+        fieldNameList += ["surface", "zkIdx", "zkInMm"]
+
+        resultFilePath = os.path.join(outputDir, resultFileName)
+        with open(resultFilePath, "w", newline="") as outFile:
+            writer = csv.DictWriter(outFile, fieldnames=fieldNameList)
+            writer.writeheader()
+            writer.writerows(rowList)
+
+        return rowList
+
+    def __loadSweepData(self, pointList):
+        """
+        
+        Load the subsystem data used by the points of parameter sweep. The data is kept in the 
+        subsystem objects and shared by the points.
+        
+        Arguments:
+            pointList {[list]} -- List of condition dict of each point.
+        """
+
+        if (self.M1M3 is not None):
+            self.M1M3.getPrintthz(0)
+            self.M1M3.getTempCorr(0, 0, 0, 0, 0)
+
+            if any([(point.get("seedNum") is not None) for point in pointList]):
+                self.M1M3.genMirSurfRandErr(0)
+
+        if (self.M2 is not None):
+            self.M2.getPrintthz(0)
+            self.M2.getTempCorr(0, 0)
+
+        if (self.cam is not None):
+            for distType in ["L1S1zer", "L1S2zer", "L2S1zer", "L2S2zer", "L3S1zer", "L3S2zer"]:
+                self.cam.getCamDistortionInMm(0, distType)
+
+    def clearPertCache(self):
+        """
+        
+        Clear the cached subsystem perturbations used in writePertBaseOnConfigFile().
+        """
+
+        self.waitPertFileWriting()
+        self.pertCache = dict()
+
+    def waitPertFileWriting(self):
+        """
+        
+        Wait for the background writing of perturbation files to finish.
+        
+        Raises:
+            RuntimeError -- Failed to write the perturbation files.
+        """
+
+        if (self.pertWriter is not None):
+            self.pertWriter.join()
+            self.pertWriter = None
+
+        if (self.pertWriterError is not None):
+            error = self.pertWriterError
+            self.pertWriterError = None
+            raise RuntimeError("Failed to write the perturbation files: %s" % error)
+
+    def __runPertWriter(self, fileDict):
+        """
+        
+        Write the perturbation files in the background thread. The error is kept and raised in 
+        waitPertFileWriting().
+        
+        Arguments:
+            fileDict {[dict]} -- Files to write: {filePath: content}.
+        """
+
+        try:
+            with self.timer.stage("TeleFacade.writePertFiles"):
+                self.__writePertFiles(fileDict)
+        except Exception as error:
+            self.pertWriterError = error
+
+    def __writePertFiles(self, fileDict):
+        """
+        
+        Write the perturbation files and record their modification time in the cache.
+        
+        Arguments:
+            fileDict {[dict]} -- Files to write: {filePath: content}. The content is a string or 
+                                 an array of fitted Zk.
+        """
+
+        try:
+            for filePath, fileContent in fileDict.items():
+                if isinstance(fileContent, str):
+                    self.phoSimCommu.writeToFile(filePath, content=fileContent, mode="w")
+                else:
+                    np.savetxt(filePath, fileContent)
+
+        except Exception:
+            # Invalidate the cache of unwritten files
+            for subSysName in list(self.pertCache.keys()):
+                if set(self.pertCache[subSysName]["fileList"]) & set(fileDict.keys()):
+                    self.pertCache.pop(subSysName)
+            raise
+
+        # Record the modification time of written files
+        for cache in self.pertCache.values():
+            for filePath in cache["fileList"]:
+                if (filePath in fileDict):
+                    cache["fileStat"][filePath] = os.stat(filePath).st_mtime_ns
+
+    def __getM1M3PertTask(self, zAngleInRad, seedNum, numTerms, resFile, zcFilePath):
+        """
+        
+        Get the task to calculate the M1M3 perturbation.
+        
+        Arguments:
+            zAngleInRad {[float]} -- Zenith angle in radian.
+            seedNum {[int]} -- Random seed number.
+            numTerms {[int]} -- Number of Zernike terms.
+            resFile {[list]} -- File path of M1 and M3 surface residue maps.
+            zcFilePath {[str]} -- File path of fitted Zk.
+        
+        Returns:
+            [tuple] -- Cache key, file list, calculation function, and its arguments.
+        """
+
+        # Temperature inputs
+        tempVarList = ["M1M3TBulk", "M1M3TxGrad", "M1M3TyGrad", "M1M3TzGrad", "M1M3TrGrad"]
+        tempDict = self.getConfigValues(tempVarList)
+        tempList = [tempDict[varName] for varName in tempVarList]
+
+        # The output files are not in the key, so the cached files can be copied to another 
+        # directory
+        fileList = resFile + [zcFilePath]
+        key = (os.path.abspath(self.M1M3.mirrorDataDir), zAngleInRad, seedNum, tuple(tempList), 
+               numTerms, self.__getDirChecksum(self.M1M3.mirrorDataDir))
+
+        return key, fileList, calcM1M3Pert, (self.M1M3, zAngleInRad, seedNum, tempList, numTerms)
+
+    def __getM2PertTask(self, zAngleInRad, numTerms, surfaceGridN, resFile, zcFilePath):
+        """
+        
+        Get the task to calculate the M2 perturbation.
+        
+        Arguments:
+            zAngleInRad {[float]} -- Zenith angle in radian.
+            numTerms {[int]} -- Number of Zernike terms.
+            surfaceGridN {[int]} -- Surface grid number.
+            resFile {[str]} -- File path of surface residue map.
+            zcFilePath {[str]} -- File path of fitted Zk.
+        
+        Returns:
+            [tuple] -- Cache key, file list, calculation function, and its arguments.
+        """
+
+        # Temperature inputs
+        M2TzGrad = self.getConfigValue("M2TzGrad")
+        M2TrGrad = self.getConfigValue("M2TrGrad")
+
+        fileList = [resFile, zcFilePath]
+        key = (os.path.abspath(self.M2.mirrorDataDir), zAngleInRad, M2TzGrad, M2TrGrad, numTerms, 
+               surfaceGridN, self.__getDirChecksum(self.M2.mirrorDataDir))
+
+        return key, fileList, calcM2Pert, (self.M2, zAngleInRad, M2TzGrad, M2TrGrad, numTerms, 
+                                           surfaceGridN)
+
+    def __getCamPertTask(self, zAngleInRad, rotAngInDeg):
+        """
+        
+        Get the task to calculate the camera perturbation.
+        
+        Arguments:
+            zAngleInRad {[float]} -- Zenith angle in radian.
+            rotAngInDeg {[float]} -- Camera rotation angle in degree.
+        
+        Returns:
+            [tuple] -- Cache key, file list, calculation function, and its arguments.
+        """
+
+        # Set the camera rotation angle
+        self.cam.setRotAngInDeg(rotAngInDeg)
+
+        # Set the temperature information
+        tempInDegC = self.getConfigValue("camTB")
+        self.cam.setBodyTempInDegC(tempInDegC)
+
+        key = (os.path.abspath(self.cam.camDataDir), zAngleInRad, rotAngInDeg, tempInDegC, 
+               self.__getDirChecksum(self.cam.camDataDir))
+
+        # Camera distortion and the related PhoSim surface name
+        distTypeList = ["L1S1zer", "L1S2zer", "L2S1zer", "L2S2zer", "L3S1zer", "L3S2zer"]
+        surfNameList = [self.__getPhoSimCamSurfName(distType) for distType in distTypeList]
+
+        return key, [], calcCamPert, (self.cam, zAngleInRad, distTypeList, surfNameList)
+
+    def __runPertTasks(self, taskDict, fileDict, parallelMode=None):
+        """
+        
+        Calculate the subsystem perturbations that are not in the cache and update the cache.
+        
+        Arguments:
+            taskDict {[dict]} -- Tasks of subsystem: {subSysName: (key, fileList, func, args)}.
+            fileDict {[dict]} -- Files to write: {filePath: content}.
+        
+        Keyword Arguments:
+            parallelMode {[str]} -- Calculate the subsystems in "thread" or "process" pool. The 
+                                    subsystems are calculated one by one if None. (default: {None})
+        
+        Raises:
+            ValueError -- The parallel mode is not supported.
+        """
+
+        # Keep the tasks whose cache is invalid
+        runTaskDict = dict()
+        for subSysName, (key, fileList, func, args) in taskDict.items():
+            cache = self.__getPertCache(subSysName, key)
+            if (cache is None):
+                runTaskDict[subSysName] = (func, args)
+            else:
+                self.timer.count("TeleFacade.pertCacheHit")
+                self.__useCachedPert(subSysName, cache, fileList)
+
+        # Calculate the subsystem perturbations
+        if (parallelMode is None) or (len(runTaskDict) <= 1):
+            resultDict = dict()
+            for subSysName, (func, args) in runTaskDict.items():
+                with self.timer.stage("TeleFacade.calcPert.%s" % subSysName):
+                    resultDict[subSysName] = func(*args)
+        else:
+            if (parallelMode == "thread"):
+                poolExecutor = ThreadPoolExecutor
+            elif (parallelMode == "process"):
+                poolExecutor = ProcessPoolExecutor
+            else:
+                raise ValueError("The parallel mode '%s' is not supported." % parallelMode)
+
+            with self.timer.stage("TeleFacade.calcPertInPool"), \
+                 poolExecutor(max_workers=len(runTaskDict)) as executor:
+                futureDict = dict([(subSysName, executor.submit(func, *args)) 
+                                    for subSysName, (func, args) in runTaskDict.items()])
+                resultDict = dict([(subSysName, future.result()) 
+                                    for subSysName, future in futureDict.items()])
+
+        # Update the subsystem and cache
+        for subSysName, result in resultDict.items():
+            key, fileList = taskDict[subSysName][0:2]
+
+            if (subSysName == "M1M3"):
+                zkInMm, contentM1, contentM3, surfAlongZinUm = result
+                self.M1M3.setSurfAlongZ(surfAlongZinUm)
+                fileDict.update(zip(fileList, [contentM1, contentM3, zkInMm]))
+                self.__setPertCache(subSysName, key, fileList=fileList, zkInMm=zkInMm, 
+                                    surfAlongZinUm=surfAlongZinUm)
+
+            elif (subSysName == "M2"):
+                zkInMm, resContent, surfAlongZinUm = result
+                self.M2.setSurfAlongZ(surfAlongZinUm)
+                fileDict.update(zip(fileList, [resContent, zkInMm]))
+                self.__setPertCache(subSysName, key, fileList=fileList, zkInMm=zkInMm, 
+                                    surfAlongZinUm=surfAlongZinUm)
+
+            elif (subSysName == "cam"):
+                self.__setPertCache(subSysName, key, zkList=result)
+
+    def __useCachedPert(self, subSysName, cache, fileList):
+        """
+        
+        Use the cached subsystem perturbation. The mirror surface is set again and the cached 
+        files are copied to the new file paths if they are different.
+        
+        Arguments:
+            subSysName {[str]} -- Subsystem name.
+            cache {[dict]} -- Cached perturbation.
+            fileList {[list]} -- Files of subsystem perturbation to write.
+        """
+
+        if (subSysName == "M1M3"):
+            self.M1M3.setSurfAlongZ(cache["surfAlongZinUm"])
+        elif (subSysName == "M2"):
+            self.M2.setSurfAlongZ(cache["surfAlongZinUm"])
+
+        if (fileList == cache["fileList"]):
+            return
+
+        # Copy the cached files and track the new ones
+        fileStat = dict()
+        for cachedFilePath, filePath in zip(cache["fileList"], fileList):
+            if (os.path.abspath(cachedFilePath) != os.path.abspath(filePath)):
+                shutil.copyfile(cachedFilePath, filePath)
+            fileStat[filePath] = os.stat(filePath).st_mtime_ns
+
+        cache["fileList"] = list(fileList)
+        cache["fileStat"] = fileStat
+
+    def __getPertCache(self, subSysName, key):
+        """
+        
+        Get the cached subsystem perturbation.
+        
+        Arguments:
+            subSysName {[str]} -- Subsystem name.
+            key {[tuple]} -- Inputs of subsystem perturbation.
+        
+        Returns:
+            [dict] -- Cached perturbation. None if the inputs are changed or the written files are 
+                      modified.
+        """
+
+        cache = self.pertCache.get(subSysName)
+        if (cache is None) or (cache["key"] != key):
+            return None
+
+        # Check the written files are not changed
+        for filePath in cache["fileList"]:
+            mtime = cache["fileStat"].get(filePath)
+            if (mtime is None) or (not os.path.isfile(filePath)) or \
+               (os.stat(filePath).st_mtime_ns != mtime):
+                return None
+
+        return cache
+
+    def __setPertCache(self, subSysName, key, fileList=None, **kwargs):
+        """
+        
+        Set the cached subsystem perturbation.
+        
+        Arguments:
+            subSysName {[str]} -- Subsystem name.
+            key {[tuple]} -- Inputs of subsystem perturbation.
+        
+        Keyword Arguments:
+            fileList {list} -- Files of subsystem perturbation. Their modification time is 
+                               recorded after the writing. (default: {None})
+            **kwargs -- Perturbation data to cache.
+        """
+
+        if (fileList is None):
+            fileList = []
+
+        cache = dict(kwargs)
+        cache["key"] = key
+        cache["fileList"] = list(fileList)
+        cache["fileStat"] = dict()
+
+        self.pertCache[subSysName] = cache
+
+    def __getDirChecksum(self, dirPath):
+        """
+        
+        Get the checksum of data directory based on the name, size, and modification time of 
+        files in the directory.
+        
+        Arguments:
+            dirPath {[str]} -- Directory path.
+        
+        Returns:
+            [str] -- Checksum.
+        """
+
+        md5 = hashlib.md5(os.path.abspath(dirPath).encode())
+        for fileName in sorted(os.listdir(dirPath)):
+            fileStat = os.stat(os.path.join(dirPath, fileName))
+            md5.update(("%s %d %d;" % (fileName, fileStat.st_size, fileStat.st_mtime_ns)).encode())
+
+        return md5.hexdigest()
+
     def __getPhoSimCamSurfName(self, camSurfName):
         """
         
@@ -574,6 +1419,180 @@ class TeleFacade(object):
 
         return surfName
 
+def calcM1M3Pert(M1M3, zAngleInRad, seedNum, tempList, numTerms):
+    """
+    
+    Calculate the M1M3 perturbation. This is a module function to be able to run in the process 
+    pool.
+    
+    Arguments:
+        M1M3 {[M1M3Sim]} -- M1M3 simulator.
+        zAngleInRad {[float]} -- Zenith angle in radian.
+        seedNum {[int]} -- Random seed number.
+        tempList {[list]} -- M1M3 temperature inputs (bulk, x-, y-, z-, and r-gradient).
+        numTerms {[int]} -- Number of Zernike terms.
+    
+    Returns:
+        [ndarray] -- Zk in mm.
+        [str] -- Grid residue map related data of M1.
+        [str] -- Grid residue map related data of M3.
+        [ndarray] -- Mirror surface along z in um.
+    """
+
+    # Do the gravity correction
+    printthzInM = M1M3.getPrintthz(zAngleInRad)
+
+    # Add the surface error if necessary
+    randSurfInM = None
+    if (seedNum is not None):
+        randSurfInM = M1M3.genMirSurfRandErr(zAngleInRad, seedNum=seedNum)
+
+    # Do the temperature correction
+    tempCorrInUm = M1M3.getTempCorr(*tempList)
+
+    # Set the mirror surface in mm
+    if (randSurfInM is not None):
+        mirrorSurfInUm = (printthzInM + randSurfInM)*1e6 + tempCorrInUm
+    else:
+        mirrorSurfInUm = printthzInM*1e6 + tempCorrInUm
+    M1M3.setSurfAlongZ(mirrorSurfInUm)
+
+    zkInMm, contentM1, contentM3 = M1M3.getMirZkAndGridResInZemax(numTerms=numTerms)
+
+    return zkInMm, contentM1, contentM3, mirrorSurfInUm
+
+def calcM2Pert(M2, zAngleInRad, M2TzGrad, M2TrGrad, numTerms, surfaceGridN):
+    """
+    
+    Calculate the M2 perturbation. This is a module function to be able to run in the process 
+    pool.
+    
+    Arguments:
+        M2 {[M2Sim]} -- M2 simulator.
+        zAngleInRad {[float]} -- Zenith angle in radian.
+        M2TzGrad {[float]} -- Temperature gradient along z direction in degree C.
+        M2TrGrad {[float]} -- Temperature gradient along r direction in degree C.
+        numTerms {[int]} -- Number of Zernike terms.
+        surfaceGridN {[int]} -- Surface grid number.
+    
+    Returns:
+        [ndarray] -- Zk in mm.
+        [str] -- Grid residue map related data.
+        [ndarray] -- Mirror surface along z in um.
+    """
+
+    # Do the gravity correction
+    printthzInUm = M2.getPrintthz(zAngleInRad)
+
+    # Do the temperature correction
+    tempCorrInUm = M2.getTempCorr(M2TzGrad, M2TrGrad)
+
+    # Set the mirror surface in mm
+    mirrorSurfInUm = printthzInUm + tempCorrInUm
+    M2.setSurfAlongZ(mirrorSurfInUm)
+
+    zkInMm, resContent = M2.getMirZkAndGridResInZemax(surfaceGridN=surfaceGridN, numTerms=numTerms)
+
+    return zkInMm, resContent, mirrorSurfInUm
+
+def calcCamPert(cam, zAngleInRad, distTypeList, surfNameList):
+    """
+    
+    Calculate the camera perturbation. This is a module function to be able to run in the 
+    process pool.
+    
+    Arguments:
+        cam {[CamSim]} -- Camera simulator.
+        zAngleInRad {[float]} -- Zenith angle in radian.
+        distTypeList {[list]} -- Distortion types of lens.
+        surfNameList {[list]} -- PhoSim surface names related to the distortion types.
+    
+    Returns:
+        [list] -- List of (PhoSim surface name, Zk in mm).
+    """
+
+    zkList = []
+    for distType, surfName in zip(distTypeList, surfNameList):
+        zkInMm = cam.getCamDistortionInMm(zAngleInRad, distType)
+        zkList.append((surfName, zkInMm))
+
+    return zkList
+
+def calcSweepPoint(tele, pointIdx, point, pointDir):
+    """
+    
+    Calculate the perturbation of one point of parameter sweep.
+    
+    Arguments:
+        tele {[TeleFacade]} -- TeleFacade object.
+        pointIdx {[int]} -- Index of point.
+        point {[dict]} -- Conditions of point.
+        pointDir {[str]} -- Directory to write the perturbation files.
+    
+    Returns:
+        [list] -- Rows of result table.
+    """
+
+    # Set the configuration of point
+    configData = tele.getConfigData()
+    kwargs = dict()
+    for varName, value in point.items():
+        if varName in tele.sweepArgList:
+            kwargs[varName] = value
+        else:
+            configData[varName] = [value] + list(configData[varName][1:])
+    tele.setConfigData(configData)
+
+    tele.writePertBaseOnConfigFile(pointDir, **kwargs)
+
+    # Collect the Zk of surfaces
+    zkList = []
+    for subSysName in ["M1M3", "M2"]:
+        if (subSysName in tele.pertCache):
+            zkList.append((subSysName, tele.pertCache[subSysName]["zkInMm"]))
+
+    if ("cam" in tele.pertCache):
+        zkList += tele.pertCache["cam"]["zkList"]
+
+    rowList = []
+    for surfName, zkInMm in zkList:
+        for zkIdx, value in enumerate(zkInMm):
+            row = {"pointIdx": pointIdx}
+            row.update(point)
+            row.update({"surface": surfName, "zkIdx": zkIdx+1, "zkInMm": float(value)})
+            rowList.append(row)
+
+    return rowList
+
+def initSweepWorker(tele):
+    """
+    
+    Initiate the worker process of parameter sweep with the TeleFacade object whose subsystem 
+    data is loaded already.
+    
+    Arguments:
+        tele {[TeleFacade]} -- TeleFacade object.
+    """
+
+    global sweepTele
+    sweepTele = tele
+
+def calcSweepPointInWorker(pointIdx, point, pointDir):
+    """
+    
+    Calculate the perturbation of one point of parameter sweep in the worker process.
+    
+    Arguments:
+        pointIdx {[int]} -- Index of point.
+        point {[dict]} -- Conditions of point.
+        pointDir {[str]} -- Directory to write the perturbation files.
+    
+    Returns:
+        [list] -- Rows of result table.
+    """
+
+    return calcSweepPoint(sweepTele, pointIdx, point, pointDir)
+
 class TeleFacadeTest(unittest.TestCase):
     
     """
@@ -601,6 +1620,11 @@ class TeleFacadeTest(unittest.TestCase):
         self.starInstSettingFile = os.path.join("..", "data", "instFile", "starDefault.inst")
         self.opdInstSettingFile = os.path.join("..", "data", "instFile", "opdDefault.inst")
 
+    def tearDown(self):
+
+        if os.path.exists(self.outputDir):
+            shutil.rmtree(self.outputDir)
+
     def testFunc(self):
         
         # Instantiate the needed objects
@@ -623,6 +1647,10 @@ class TeleFacadeTest(unittest.TestCase):
         ansArgString = "%s -i lsst -e 1" % os.path.abspath(instFilePath)
         self.assertEqual(argString, ansArgString)
 
+        argList = tele.getPhoSimArgList(instFilePath, sensorName="R22_S11|R22_S12")
+        ansArgList = [os.path.abspath(instFilePath), "-i", "lsst", "-e", "1", "-s", "R22_S11|R22_S12"]
+        self.assertEqual(argList, ansArgList)
+
         instruFile = "comcam10"
         tele.setInstName(instruFile)
         self.assertEqual(tele.instName, "comcam")
@@ -644,6 +1672,23 @@ class TeleFacadeTest(unittest.TestCase):
         varName = "M1M3TxGrad"
         value = tele.getConfigValue(varName)
         self.assertEqual(value, -0.0894)
+        self.assertEqual(tele.getConfigValue("iqBudget", index=3), 80)
+        self.assertEqual(tele.getConfigValue("camRotation", index=2), "radian")
+        self.assertEqual(tele.getConfigValue("noSuchVar"), None)
+
+        valueDict = tele.getConfigValues(["znPert", "surfaceGridN"])
+        self.assertEqual(valueDict, {"znPert": 28, "surfaceGridN": 200})
+
+        configData = tele.getConfigData()
+        teleWorker = TeleFacade()
+        teleWorker.setConfigData(configData)
+        self.assertEqual(teleWorker.getConfigValue(varName), -0.0894)
+        self.assertEqual(teleWorker.getConfigValue(varName, index=0), varName)
+
+        # The configuration in use is not changed by the caller
+        configData[varName][0] = 0
+        self.assertEqual(tele.getConfigValue(varName), -0.0894)
+        self.assertEqual(teleWorker.getConfigValue(varName), -0.0894)
 
         dofFilePath = tele.writeAccDofFile(self.outputDir)
         self.assertLess(np.sum(np.abs(np.loadtxt(dofFilePath)-dofInUm)), 1e-7)
@@ -659,6 +1704,56 @@ class TeleFacadeTest(unittest.TestCase):
         cmdFile.close()
         self.assertEqual(len(lines), 256)
 
+        # Only the camera perturbation is regenerated
+        M1resFilePath = os.path.join(self.outputDir, "M1res.txt")
+        mtime = os.stat(M1resFilePath).st_mtime_ns
+        pertCmdFilePath = tele.writePertBaseOnConfigFile(self.outputDir, zAngleInDeg=zAngleInDeg, 
+                                           rotAngInDeg=0, seedNum=iSim, saveResMapFig=False)
+        self.assertEqual(os.stat(M1resFilePath).st_mtime_ns, mtime)
+        self.assertEqual(tele.pertCache["cam"]["key"][2], 0)
+
+        # The cached mirror files are copied to another directory
+        newOutputDir = os.path.join(self.outputDir, "newPert")
+        os.makedirs(newOutputDir)
+        tele.writePertBaseOnConfigFile(newOutputDir, zAngleInDeg=zAngleInDeg, rotAngInDeg=0, 
+                                       seedNum=iSim, saveResMapFig=False)
+        self.assertEqual(tele.pertCache["M1M3"]["fileList"][0], 
+                         os.path.join(newOutputDir, "M1res.txt"))
+        self.assertEqual(os.stat(M1resFilePath).st_mtime_ns, mtime)
+        for fileName in ["M1res.txt", "M3res.txt", "M1M3zlist.txt", "M2res.txt", "M2zlist.txt"]:
+            self.assertTrue(filecmp.cmp(os.path.join(self.outputDir, fileName), 
+                                        os.path.join(newOutputDir, fileName), shallow=False))
+        shutil.rmtree(newOutputDir)
+
+        # Write the files in the background thread
+        tele.clearPertCache()
+        pertCmdFilePath = tele.writePertBaseOnConfigFile(self.outputDir, zAngleInDeg=zAngleInDeg, 
+                                           rotAngInDeg=rotAngInDeg, seedNum=iSim, saveResMapFig=False, 
+                                           writeInBackground=True)
+        tele.waitPertFileWriting()
+        self.assertNotEqual(os.stat(M1resFilePath).st_mtime_ns, mtime)
+        self.assertEqual(len(np.loadtxt(os.path.join(self.outputDir, "M2zlist.txt"))), 28)
+
+        # Calculate the subsystems in parallel
+        cmdFile = open(pertCmdFilePath, "r")
+        content = cmdFile.read()
+        cmdFile.close()
+        for parallelMode in ["thread", "process"]:
+            tele.clearPertCache()
+            pertCmdFilePath = tele.writePertBaseOnConfigFile(self.outputDir, zAngleInDeg=zAngleInDeg, 
+                                           rotAngInDeg=rotAngInDeg, seedNum=iSim, saveResMapFig=False, 
+                                           parallelMode=parallelMode)
+            cmdFile = open(pertCmdFilePath, "r")
+            self.assertEqual(cmdFile.read(), content)
+            cmdFile.close()
+
+        pertCmdFilePath = tele.writePertBaseOnConfigFile(self.outputDir, zAngleInDeg=zAngleInDeg, 
+                                           rotAngInDeg=rotAngInDeg, seedNum=iSim, saveResMapFig=False)
+        cmdFile = open(pertCmdFilePath, "r")
+        lines = cmdFile.readlines()
+        cmdFile.close()
+        self.assertEqual(len(lines), 256)
+
         cmdFilePath = tele.writeCmdFile(self.outputDir, cmdSettingFile=self.starCmdSettingFile, 
                                         pertFilePath=pertCmdFilePath, cmdFileName="star.cmd")
 
@@ -678,6 +1773,19 @@ class TeleFacadeTest(unittest.TestCase):
         opdInstFile.close()
         self.assertEqual(len(lines), 55)
 
+        metr.addFieldXYbyDeg([0.1, 0.2, 0.3], [0.1, 0.2, 0.3])
+        chunkList = tele.writeOpdInstFileInChunks(self.outputDir, metr, obsId, aFilter, wavelengthInNm, 3, 
+                                                  instSettingFile=self.opdInstSettingFile)
+        self.assertEqual(len(chunkList), 3)
+        self.assertEqual(chunkList[0]["fieldIdx"], [0, 1])
+        self.assertEqual(chunkList[2]["obsId"], obsId*100 + 2)
+        self.assertRaises(ValueError, tele.writeOpdInstFileInChunks, self.outputDir, metr, 21474837, 
+                          aFilter, wavelengthInNm, 3)
+        opdInstFile = open(chunkList[0]["instFilePath"], "r")
+        lines = opdInstFile.readlines()
+        opdInstFile.close()
+        self.assertEqual(len(lines), 56)
+
         skySim.addStarByRaDecInDeg(0, 1.0, 1.0, 17.0)
         boresight = (0.2, 0.3)
         instFilePath = tele.writeStarInstFile(self.outputDir, skySim, obsId, aFilter, boresight, 
@@ -688,8 +1796,79 @@ class TeleFacadeTest(unittest.TestCase):
         starInstFile.close()
         self.assertEqual(len(lines), 62)
 
+        # Sweep the camera perturbation over the conditions
+        camTele = TeleFacade(cam=CamSim(), phoSimCommu=phoSimCommu)
+        camTele.setConfigFile(self.configFilePath)
+        camTele.setSubSysConfigFile(camDataDir=self.camDataDir)
+
+        conditions = {"zAngleInDeg": [0, 27.0912], "camTB": [6.565, 10]}
+        pointList = camTele.getSweepPoints(conditions)
+        self.assertEqual(len(pointList), 4)
+        self.assertEqual(pointList[1], {"zAngleInDeg": 0, "camTB": 10})
+        self.assertRaises(ValueError, camTele.runPertSweep, self.outputDir, [{"unknown": 1}])
+
+        sweepDir = os.path.join(self.outputDir, "sweep")
+        rowList = camTele.runPertSweep(sweepDir, conditions, numWorker=2)
+        self.assertEqual(len(rowList), 4*6*28)
+        self.assertEqual(rowList[-1]["pointIdx"], 3)
+        self.assertEqual(camTele.getConfigValue("camTB"), 6.565)
+        self.assertTrue(os.path.isfile(os.path.join(sweepDir, "point3", "pert.cmd")))
+
+        serialRowList = camTele.runPertSweep(sweepDir, pointList, numWorker=1)
+        self.assertEqual(serialRowList, rowList)
+        resultFile = open(os.path.join(sweepDir, "sweep.csv"), "r")
+        self.assertEqual(len(resultFile.readlines()), len(rowList)+1)
+        resultFile.close()
+
         shutil.rmtree(self.outputDir)
 
+    def testRunOpdChunks(self):
+
+        # Fake PhoSim that writes the field x of each OPD source into the OPD file. The chunks of 
+        # observation ID ending with 9 fail.
+        phosimDir = os.path.join(self.outputDir, "phosim")
+        os.makedirs(os.path.join(phosimDir, "data", "sky"))
+
+        content = "import os, sys\n"
+        content += "args = sys.argv[1:]\n"
+        content += "outputDir = args[args.index(\"-o\") + 1]\n"
+        content += "assert os.path.isdir(args[args.index(\"-w\") + 1])\n"
+        content += "with open(args[0], \"r\") as instFile:\n"
+        content += "    lines = [line.split() for line in instFile.readlines()]\n"
+        content += "obsId = [line[1] for line in lines if line[0] == \"Opsim_obshistid\"][0]\n"
+        content += "if obsId[:-2].endswith(\"9\"):\n"
+        content += "    sys.exit(1)\n"
+        content += "for line in lines:\n"
+        content += "    if (line[0] == \"opd\"):\n"
+        content += "        opdFile = os.path.join(outputDir, \"opd_%s_%s.fits.gz\" % (obsId, line[1]))\n"
+        content += "        with open(opdFile, \"w\") as outFile:\n"
+        content += "            outFile.write(line[2])\n"
+
+        phoSimCommu = PhosimCommu(phosimDir=phosimDir)
+        phoSimCommu.writeToFile(os.path.join(phosimDir, "phosim.py"), content=content, mode="w")
+
+        tele = TeleFacade(phoSimCommu=phoSimCommu)
+        metr = OpdMetrology()
+        metr.addFieldXYbyDeg([0.1, 0.2, 0.3, 0.4, 0.5], [0, 0, 0, 0, 0])
+
+        obsId = 9006000
+        chunkList = tele.writeOpdInstFileInChunks(self.outputDir, metr, obsId, "g", 500, 2)
+        opdFileList = tele.runOpdChunks(chunkList, obsId, self.outputDir, numWorker=2)
+
+        # The OPD outputs are in the order of field index
+        self.assertEqual(len(opdFileList), 5)
+        for fieldIdx, opdFile in enumerate(opdFileList):
+            self.assertEqual(opdFile, os.path.join(self.outputDir, "opd_%d_%d.fits.gz" % (obsId, fieldIdx)))
+            with open(opdFile, "r") as inFile:
+                self.assertAlmostEqual(float(inFile.read()), metr.fieldX[fieldIdx])
+        self.assertFalse(os.path.exists(os.path.join(self.outputDir, "opdWork0")))
+
+        # The work directories are removed if the chunk fails
+        obsId = 9006009
+        chunkList = tele.writeOpdInstFileInChunks(self.outputDir, metr, obsId, "g", 500, 2)
+        self.assertRaises(RuntimeError, tele.runOpdChunks, chunkList, obsId, self.outputDir)
+        self.assertFalse(os.path.exists(os.path.join(self.outputDir, "opdWork0")))
+
 if __name__ == "__main__":
 
     # Do the unit test
@@ -0,0 +1,306 @@
+import os, hashlib, pickle, threading, unittest
+import numpy as np
+from astropy.io import fits
+
+from lsst.ts.wep.cwfs.Tool import ZernikeAnnularFit, ZernikeAnnularEval
+from wepPhoSim.MetroTool import ArrayCache
+
+class ZernikeFitter(object):
+
+    def __init__(self, maxCacheSize=8):
+        """
+
+        Initiate the ZernikeFitter object. This class fits the optical path difference (OPD)
+        map with the annular Zernike polynomials (Zk). The Zk basis on the pupil pixels and
+        its pseudo-inverse are cached by the map size, pupil mask, obscuration, and number of
+        terms. The PhoSim OPD of all field points and iterations shares the same grid and
+        pupil, so the fitting is one matrix product after the first map.
+
+        Keyword Arguments:
+            maxCacheSize {int} -- Maximum number of bases kept in memory. (default: {8})
+        """
+
+        # Cache of Zk basis and its pseudo-inverse
+        self.maxCacheSize = int(maxCacheSize)
+        self.basisCache = ArrayCache(maxSize=self.maxCacheSize)
+        self.pinvCache = ArrayCache(maxSize=self.maxCacheSize)
+
+        # x-, y-coordinate of OPD map: {opdSize: (opdx, opdy)}
+        self.gridData = dict()
+
+        # Lock to access the coordinate from several threads
+        self.lock = threading.Lock()
+
+    def getGrid(self, opdSize):
+        """
+
+        Get the x-, y-coordinate of OPD map in [-1, 1].
+
+        Arguments:
+            opdSize {[int]} -- Pixel size of OPD map.
+
+        Returns:
+            [ndarray] -- Meshgrid x in OPD map (read-only).
+            [ndarray] -- Meshgrid y in OPD map (read-only).
+        """
+
+        opdSize = int(opdSize)
+        with self.lock:
+            grid = self.gridData.get(opdSize)
+
+        if (grid is None):
+            opdGrid1d = np.linspace(-1, 1, opdSize)
+            opdx, opdy = np.meshgrid(opdGrid1d, opdGrid1d)
+            opdx.setflags(write=False)
+            opdy.setflags(write=False)
+            grid = (opdx, opdy)
+
+            with self.lock:
+                self.gridData[opdSize] = grid
+
+        return grid
+
+    def getBasis(self, pupil, znTerms, obscuration):
+        """
+
+        Get the Zk basis on the pupil pixels.
+
+        Arguments:
+            pupil {[ndarray]} -- Pupil mask of OPD map.
+            znTerms {[int]} -- Number of terms of annular Zk.
+            obscuration {[float]} -- Obscuration of annular Zernike polynomial.
+
+        Returns:
+            [ndarray] -- Zk basis in the shape of (nPixel in pupil, znTerms) (read-only).
+        """
+
+        pupil = np.ascontiguousarray(pupil, dtype=bool)
+        key = self.__getKey(pupil, znTerms, obscuration)
+
+        return self.basisCache.get(key, self.__calcBasis, pupil, int(znTerms), obscuration)
+
+    def getPinv(self, pupil, znTerms, obscuration):
+        """
+
+        Get the pseudo-inverse of Zk basis on the pupil pixels.
+
+        Arguments:
+            pupil {[ndarray]} -- Pupil mask of OPD map.
+            znTerms {[int]} -- Number of terms of annular Zk.
+            obscuration {[float]} -- Obscuration of annular Zernike polynomial.
+
+        Returns:
+            [ndarray] -- Pseudo-inverse in the shape of (znTerms, nPixel in pupil) (read-only).
+        """
+
+        pupil = np.ascontiguousarray(pupil, dtype=bool)
+        key = self.__getKey(pupil, znTerms, obscuration)
+
+        return self.pinvCache.get(key, self.__calcPinv, pupil, int(znTerms), obscuration)
+
+    def fit(self, opd, znTerms=22, obscuration=0.61):
+        """
+
+        Fit the OPD map with the annular Zk. The pixels of zero value are outside of pupil.
+
+        Arguments:
+            opd {[ndarray]} -- OPD map.
+
+        Keyword Arguments:
+            znTerms {int} -- Number of terms of annular Zk. (default: {22})
+            obscuration {float} -- Obscuration of annular Zernike polynomial. (default: {0.61})
+
+        Returns:
+            [ndarray] -- Annular Zk.
+        """
+
+        idx = (opd != 0)
+
+        return self.getPinv(idx, znTerms, obscuration).dot(opd[idx])
+
+    def fitStack(self, opdStack, znTerms=22, obscuration=0.61):
+        """
+
+        Fit the stack of OPD maps with the annular Zk. The maps sharing the same pupil are
+        fitted by one matrix product.
+
+        Arguments:
+            opdStack {[ndarray]} -- OPD maps in the shape of (nOpd, N, N).
+
+        Keyword Arguments:
+            znTerms {int} -- Number of terms of annular Zk. (default: {22})
+            obscuration {float} -- Obscuration of annular Zernike polynomial. (default: {0.61})
+
+        Returns:
+            [ndarray] -- Annular Zk in the shape of (nOpd, znTerms).
+        """
+
+        opdStack = np.asarray(opdStack)
+
+        zk = np.zeros((opdStack.shape[0], int(znTerms)))
+        for idx, idxList in self.groupByPupil(opdStack):
+            zk[idxList] = opdStack[idxList][:, idx].dot(self.getPinv(idx, znTerms, obscuration).T)
+
+        return zk
+
+    def groupByPupil(self, opdStack):
+        """
+
+        Group the stack of OPD maps by the pupil. The pixels of zero value are outside of pupil.
+
+        Arguments:
+            opdStack {[ndarray]} -- OPD maps in the shape of (nOpd, N, N).
+
+        Returns:
+            [list] -- Groups of (pupil mask, list of index of OPD) in the order of first OPD.
+        """
+
+        # {pupil: (pupil mask, [index of OPD])}
+        pupil = (np.asarray(opdStack) != 0)
+        groupDict = dict()
+        for ii in range(pupil.shape[0]):
+            groupDict.setdefault(pupil[ii].tobytes(), (pupil[ii], []))[1].append(ii)
+
+        return list(groupDict.values())
+
+    def __getstate__(self):
+        """
+
+        Get the state to pickle. The lock and cached arrays are not pickled, so the object can
+        be sent to the worker processes.
+
+        Returns:
+            [dict] -- State to pickle.
+        """
+
+        state = self.__dict__.copy()
+        state["lock"] = None
+        state["basisCache"] = None
+        state["pinvCache"] = None
+        state["gridData"] = dict()
+
+        return state
+
+    def __setstate__(self, state):
+        """
+
+        Set the state from pickle.
+
+        Arguments:
+            state {[dict]} -- Pickled state.
+        """
+
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.basisCache = ArrayCache(maxSize=self.maxCacheSize)
+        self.pinvCache = ArrayCache(maxSize=self.maxCacheSize)
+
+    def __getKey(self, pupil, znTerms, obscuration):
+        """
+
+        Get the key of cache.
+
+        Arguments:
+            pupil {[ndarray]} -- Pupil mask of OPD map.
+            znTerms {[int]} -- Number of terms of annular Zk.
+            obscuration {[float]} -- Obscuration of annular Zernike polynomial.
+
+        Returns:
+            [tuple] -- Key of cache.
+        """
+
+        pupilHash = hashlib.md5(pupil.tobytes()).hexdigest()
+
+        return ("zkBasis", pupil.shape, pupilHash, float(obscuration), int(znTerms))
+
+    def __calcBasis(self, pupil, znTerms, obscuration):
+        """
+
+        Calculate the Zk basis on the pupil pixels.
+
+        Arguments:
+            pupil {[ndarray]} -- Pupil mask of OPD map.
+            znTerms {[int]} -- Number of terms of annular Zk.
+            obscuration {[float]} -- Obscuration of annular Zernike polynomial.
+
+        Returns:
+            [ndarray] -- Zk basis in the shape of (nPixel in pupil, znTerms).
+        """
+
+        opdx, opdy = self.getGrid(pupil.shape[0])
+
+        basis = np.zeros((np.sum(pupil), znTerms))
+        for ii in range(znTerms):
+            z = np.zeros(znTerms)
+            z[ii] = 1
+            basis[:, ii] = ZernikeAnnularEval(z, opdx[pupil], opdy[pupil], obscuration)
+
+        return basis
+
+    def __calcPinv(self, pupil, znTerms, obscuration):
+        """
+
+        Calculate the pseudo-inverse of Zk basis on the pupil pixels.
+
+        Arguments:
+            pupil {[ndarray]} -- Pupil mask of OPD map.
+            znTerms {[int]} -- Number of terms of annular Zk.
+            obscuration {[float]} -- Obscuration of annular Zernike polynomial.
+
+        Returns:
+            [ndarray] -- Pseudo-inverse in the shape of (znTerms, nPixel in pupil).
+        """
+
+        return np.linalg.pinv(self.getBasis(pupil, znTerms, obscuration))
+
+class ZernikeFitterTest(unittest.TestCase):
+
+    """
+    Test functions in ZernikeFitter.
+    """
+
+    def setUp(self):
+
+        self.opdFitsFile = os.path.join("..", "testData", "testOpdFunc", "sim6_iter0_opd0.fits.gz")
+
+    def testFunc(self):
+
+        opd = fits.getdata(self.opdFitsFile)
+        opd = opd.astype(opd.dtype.newbyteorder("="))
+
+        zkFitter = ZernikeFitter()
+        opdx, opdy = zkFitter.getGrid(opd.shape[0])
+        self.assertFalse(opdx.flags.writeable)
+
+        # Same as ZernikeAnnularFit() on the pupil pixels
+        idx = (opd != 0)
+        ansZk = ZernikeAnnularFit(opd[idx], opdx[idx], opdy[idx], 22, 0.61)
+        zk = zkFitter.fit(opd, znTerms=22, obscuration=0.61)
+        self.assertLess(np.max(np.abs(zk - ansZk)), 1e-10*np.max(np.abs(ansZk)))
+
+        basis = zkFitter.getBasis(idx, 22, 0.61)
+        self.assertEqual(basis.shape, (np.sum(idx), 22))
+        self.assertTrue(np.allclose(basis.dot(zk), ZernikeAnnularEval(zk, opdx[idx], opdy[idx], 0.61)))
+
+        # The basis is reused for the maps of same pupil
+        opdCut = opd.copy()
+        opdCut[opd.shape[0]//2, :] = 0
+        zkStack = zkFitter.fitStack(np.array([opd, opd*2, opdCut]), znTerms=22, obscuration=0.61)
+        self.assertEqual(zkStack.shape, (3, 22))
+        self.assertTrue(np.allclose(zkStack[0], zk))
+        self.assertTrue(np.allclose(zkStack[1], 2*zk))
+        self.assertTrue(np.allclose(zkStack[2], zkFitter.fit(opdCut)))
+        self.assertEqual(zkFitter.pinvCache.numMiss, 2)
+        self.assertEqual(zkFitter.pinvCache.numHit, 2)
+        self.assertEqual([idxList for idx, idxList in zkFitter.groupByPupil([opd, opdCut, opd*2])], 
+                         [[0, 2], [1]])
+
+        # The fitter can be sent to the worker processes
+        newZkFitter = pickle.loads(pickle.dumps(zkFitter))
+        self.assertEqual(newZkFitter.pinvCache.numMiss, 0)
+        self.assertTrue(np.allclose(newZkFitter.fit(opd), zk))
+
+if __name__ == "__main__":
+
+    # Do the unit test
+    unittest.main()